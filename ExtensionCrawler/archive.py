@@ -20,11 +20,15 @@ Module for handling archives of the Browser Extension Crawler.
 """
 
 import os
-import glob
 import re
 import json
 import random
-from concurrent.futures import TimeoutError
+import heapq
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import TimeoutError, wait, FIRST_COMPLETED
 from pebble import ProcessPool, ProcessExpired
 from functools import partial
 import shutil
@@ -33,19 +37,30 @@ import time
 import traceback
 import tarfile
 import datetime
+import hashlib
 import dateutil
 import dateutil.parser
-import requests
 from itertools import groupby
 
 from ExtensionCrawler.config import (
     const_review_payload, const_review_search_url, const_download_url,
     get_local_archive_dir, const_overview_url, const_support_url,
-    const_support_payload, const_review_search_payload, const_review_url, const_mysql_config_file)
+    const_support_payload, const_review_search_payload, const_review_url, const_mysql_config_file,
+    const_rate_log_interval, const_comment_page_size, const_max_comment_pages, const_max_retries,
+    const_retry_delay, const_retry_max_delay, const_min_parallel_downloads)
 from ExtensionCrawler.dbbackend.mysql_process import MysqlProcessBackend
 from ExtensionCrawler.util import value_of, log_info, log_warning, log_exception, setup_logger, set_logger_tag
 from ExtensionCrawler.db import update_db_incremental
 from ExtensionCrawler.request_manager import RequestManager
+from ExtensionCrawler.autoscale import ConcurrencyController
+from ExtensionCrawler.reply_search import ReplySearchBatcher
+from ExtensionCrawler.registry import Registry
+from ExtensionCrawler.lease import LeaseError, range_of
+from ExtensionCrawler.preload import log_worker_startup
+from ExtensionCrawler.tar_append import append_to_tar
+from ExtensionCrawler.tar_staging import TarStaging, remove_spilled
+from ExtensionCrawler.tar_index import crx_entries, first_crx_entry, last_crx_entry, load_index
+from ExtensionCrawler.session_manager import SessionManager
 
 
 class Error(Exception):
@@ -61,10 +76,16 @@ class CrawlError(Error):
 
 
 class RequestResult:
-    def __init__(self, response=None, exception=None):
+    def __init__(self, response=None, exception=None, saved_requests=0, http_status=None, unchanged=False,
+                 downloads=None):
         if response is not None:
             self.http_status = response.status_code
+        elif http_status is not None:
+            self.http_status = http_status
         self.exception = exception
+        self.saved_requests = saved_requests
+        self.unchanged = unchanged
+        self.downloads = downloads
 
     def is_ok(self):
         return (self.exception is None) and (self.http_status == 200)
@@ -104,7 +125,7 @@ class UpdateResult:
 
     def is_ok(self):
         return ((self.worker_exception is None)
-                and self.res_overview.is_ok()
+                and (self.res_overview.is_ok() or self.res_overview.not_modified())
                 and (self.res_crx.is_ok() or self.res_crx.not_modified())
                 and ((self.res_reviews is None) or self.res_reviews.is_ok())
                 and ((self.res_support is None) or self.res_support.is_ok()))
@@ -140,6 +161,18 @@ class UpdateResult:
     def not_modified(self):
         return self.res_crx is None or self.res_crx.not_modified()
 
+    def downloads(self):
+        return self.res_overview.downloads if self.res_overview is not None else None
+
+    def overview_unchanged(self):
+        return self.res_overview is not None and self.res_overview.unchanged
+
+    def crx_saved_requests(self):
+        return self.res_crx.saved_requests if self.res_crx is not None else 0
+
+    def forum_saved_requests(self):
+        return sum(res.saved_requests for res in [self.res_reviews, self.res_support] if res is not None)
+
     def corrupt_tar(self):
         return self.exception is not None
 
@@ -149,6 +182,25 @@ class UpdateResult:
     def sql_success(self):
         return self.sql_update
 
+    def failed_phases(self):
+        """The phases (overview, crx, reviews, support) that raised an
+           exception, or None if the whole update needs to be repeated as
+           the downloaded data was not stored."""
+        if self.worker_exception is not None or self.corrupt_tar() or self.res_overview is None:
+            return None
+        return {phase for phase, res in [("overview", self.res_overview), ("crx", self.res_crx),
+                                         ("reviews", self.res_reviews), ("support", self.res_support)]
+                if res is not None and res.has_exception()}
+
+    def merge(self, previous):
+        """Combine the result of a retry of some phases with the result of
+           the previous attempt."""
+        return UpdateResult(
+            self.ext_id, self.new or previous.new, self.exception,
+            value_of(self.res_overview, previous.res_overview), value_of(self.res_crx, previous.res_crx),
+            value_of(self.res_reviews, previous.res_reviews), value_of(self.res_support, previous.res_support),
+            self.res_sql, self.sql_update, self.worker_exception)
+
 
 def write_text(tardir, date, fname, text):
     directory = os.path.join(tardir, date)
@@ -157,15 +209,15 @@ def write_text(tardir, date, fname, text):
         f.write(text)
 
 
-def store_request_metadata(tar, date, fname, request):
-    write_text(tar, date, fname + ".headers", str(request.headers))
-    write_text(tar, date, fname + ".status", str(request.status_code))
-    write_text(tar, date, fname + ".url", str(request.url))
+def store_request_metadata(staging, date, fname, request):
+    staging.write_text(date, fname + ".headers", str(request.headers))
+    staging.write_text(date, fname + ".status", str(request.status_code))
+    staging.write_text(date, fname + ".url", str(request.url))
 
 
-def store_request_text(tar, date, fname, request):
-    write_text(tar, date, fname, request.text)
-    store_request_metadata(tar, date, fname, request)
+def store_request_text(staging, date, fname, request):
+    staging.write_text(date, fname, request.text)
+    store_request_metadata(staging, date, fname, request)
 
 
 def httpdate(dt):
@@ -191,98 +243,148 @@ def last_modified_http_date(path):
     return httpdate(dateutil.parser.parse(last_modified_utc_date(path)))
 
 
-def last_crx(archivedir, extid, date=None):
-    last_crx_path = ""
-    last_crx_etag = ""
-
+def read_etag_file(archivedir, extid):
+    """Contents of the .etag file of an extension, or None."""
     etag_file = os.path.join(archivedir, get_local_archive_dir(extid),
                              extid + ".etag")
-    if date is None and os.path.exists(etag_file):
+    if os.path.exists(etag_file):
         try:
             with open(etag_file, 'r') as f:
                 d = json.load(f)
-                return d["last_crx"], d["last_crx_etag"]
+                if "last_crx" not in d or "last_crx_etag" not in d:
+                    raise ValueError("etag file lacks last_crx or last_crx_etag")
+                return d
         except Exception:
             log_exception("Something was wrong with the etag file {}, deleting it ...".format(etag_file))
             try:
                 os.remove(etag_file)
             except Exception:
                 log_exception("Could not remove etag file {}!".format(etag_file))
+    return None
+
 
-    # If we do not yet have an .etag file present, open the tarfile and look
-    # there for one. After having done that once, the crawler creates the .etag
-    # file to avoid opening the tar file in the future.
+def write_etag_file(archivedir, extid, last_crx_path, last_crx_etag, crx_version=None):
+    etag_file = os.path.join(archivedir, get_local_archive_dir(extid),
+                             extid + ".etag")
+    d = {"last_crx": last_crx_path, "last_crx_etag": last_crx_etag}
+    if crx_version is not None:
+        d["last_crx_version"] = crx_version.version
+        d["last_crx_hash_sha256"] = crx_version.hash_sha256
+    with open(etag_file, 'w') as f:
+        json.dump(d, f)
+
+
+def crx_index(archivedir, extid):
+    """The index entries of the (non-empty) crxs in the tar archive of an
+       extension (see tar_index.crx_entries)."""
     tar = os.path.join(archivedir, get_local_archive_dir(extid),
                        extid + ".tar")
-    if os.path.exists(tar):
-        with tarfile.open(tar, 'r') as t:
-            old_crxs = sorted([
-                x.name for x in t.getmembers()
-                if x.name.endswith(".crx") and x.size > 0 and (
-                    date is None or (dateutil.parser.parse(
-                        os.path.split(os.path.split(x.name)[0])[1]) <= date))
-            ])
-            if old_crxs:
-                last_crx_path = old_crxs[-1]
-                headers_content = t.extractfile(
-                    last_crx_path + ".headers").read().decode().replace(
-                        '"', '\\"').replace("'", '"')
-                headers_json = json.loads(headers_content)
-                last_crx_etag = headers_json["ETag"]
-
-                if date is None:
-                    with open(etag_file, 'w') as f:
-                        json.dump({"last_crx": last_crx_path, "last_crx_etag": last_crx_etag}, f)
+    if not os.path.exists(tar):
+        return []
+    return crx_entries(load_index(tar))
+
+
+def last_crx(archivedir, extid, date=None):
+    last_crx_path = ""
+    last_crx_etag = ""
+
+    if date is None:
+        d = read_etag_file(archivedir, extid)
+        if d is not None:
+            return d["last_crx"], d["last_crx_etag"]
+
+    # If we do not yet have an .etag file present, look up the last crx in the
+    # index of the tar file. After having done that once, the crawler creates
+    # the .etag file to avoid loading the index in the future.
+    entry = last_crx_entry(crx_index(archivedir, extid), date)
+    if entry is not None:
+        last_crx_path = entry["name"]
+        last_crx_etag = entry["etag"]
+
+        if date is None:
+            write_etag_file(archivedir, extid, last_crx_path, last_crx_etag)
 
     return last_crx_path, last_crx_etag
 
 
 def first_crx(archivedir, extid, date=None):
-    first_crx_path = ""
-    tar = os.path.join(archivedir, get_local_archive_dir(extid),
-                       extid + ".tar")
-    if os.path.exists(tar):
-        t = tarfile.open(tar, 'r')
-        old_crxs = sorted([
-            x.name for x in t.getmembers()
-            if x.name.endswith(".crx") and x.size > 0 and (
-                date is None or (date <= dateutil.parser.parse(
-                    os.path.split(os.path.split(x.name)[0])[1])))
-        ])
-        t.close()
-        if old_crxs:
-            first_crx_path = old_crxs[0]
-
-    return first_crx_path
+    entry = first_crx_entry(crx_index(archivedir, extid), date)
+    return entry["name"] if entry is not None else ""
 
 
 def all_crx(archivedir, extid, date=None):
-    tar = os.path.join(archivedir, get_local_archive_dir(extid),
-                       extid + ".tar")
-    all_crxs = []
-    if os.path.exists(tar):
-        t = tarfile.open(tar, 'r')
-        all_crxs = sorted([
-            x.name for x in t.getmembers()
-            if x.name.endswith(".crx") and x.size > 0
-        ])
-        t.close()
-    return all_crxs
-
-
-def update_overview(tar, date, ext_id):
+    return [entry["name"] for entry in crx_index(archivedir, extid)]
+
+
+def read_overview_file(archivedir, extid):
+    """Contents of the .overview file of an extension, describing the last
+       archived overview page, or None."""
+    overview_file = os.path.join(archivedir, get_local_archive_dir(extid),
+                                 extid + ".overview")
+    if os.path.exists(overview_file):
+        try:
+            with open(overview_file, 'r') as f:
+                d = json.load(f)
+                if "date" not in d or "sha256" not in d:
+                    raise ValueError("overview file lacks date or sha256")
+                return d
+        except Exception:
+            log_exception("Something was wrong with the overview file {}, deleting it ...".format(overview_file))
+            try:
+                os.remove(overview_file)
+            except Exception:
+                log_exception("Could not remove overview file {}!".format(overview_file))
+    return None
+
+
+def write_overview_file(archivedir, extid, date, res):
+    overview_file = os.path.join(archivedir, get_local_archive_dir(extid),
+                                 extid + ".overview")
+    d = {"date": date, "sha256": hashlib.sha256(res.text.encode()).hexdigest(),
+         "etag": res.headers.get("ETag"), "last_modified": res.headers.get("Last-Modified")}
+    with open(overview_file, 'w') as f:
+        json.dump(d, f)
+
+
+def overview_downloads(contents):
+    match = re.search("""<meta itemprop="interactionCount" content="UserDownloads:((:?\d|,)+)""", contents)
+    return int(match.group(1).replace(",", '')) if match else None
+
+
+def update_overview(archivedir, staging, date, ext_id):
+    """Download the overview page of an extension. A page that is not
+       modified since the last archived one (according to the server, or to
+       the hash of its contents) is stored as a link to that one."""
     res = None
     try:
-        with request_manager.normal_request():
-            res = requests.get(const_overview_url(ext_id), timeout=10)
+        last_overview = read_overview_file(archivedir, ext_id)
+        headers = {}
+        if last_overview is not None:
+            if last_overview.get("etag"):
+                headers['If-None-Match'] = last_overview["etag"]
+            if last_overview.get("last_modified"):
+                headers['If-Modified-Since'] = last_overview["last_modified"]
+        with request_manager.normal_request("store") as egress:
+            res = session_manager.get(const_overview_url(ext_id), egress=egress, headers=headers, timeout=10)
+            request_manager.report("store", res.status_code, egress)
         log_info("* overview page: {}".format(str(res.status_code)), 2)
-        store_request_text(tar, date, 'overview.html', res)
+        if last_overview is not None and (res.status_code == 304 or (
+                res.status_code == 200
+                and hashlib.sha256(res.text.encode()).hexdigest() == last_overview["sha256"])):
+            log_info("- not modified since {}".format(last_overview["date"]), 3)
+            store_request_metadata(staging, date, 'overview.html', res)
+            staging.write_text(date, 'overview.html.link',
+                               os.path.join("..", last_overview["date"], 'overview.html') + "\n")
+            return RequestResult(res, unchanged=True)
+        store_request_text(staging, date, 'overview.html', res)
+        if res.status_code == 200:
+            write_overview_file(archivedir, ext_id, date, res)
     except Exception as e:
         log_exception("Exception when retrieving overview page", 2)
-        write_text(tar, date, 'overview.html.exception',
-                   traceback.format_exc())
+        staging.write_text(date, 'overview.html.exception',
+                           traceback.format_exc())
         return RequestResult(res, e)
-    return RequestResult(res)
+    return RequestResult(res, downloads=overview_downloads(res.text) if res.status_code == 200 else None)
 
 
 def validate_crx_response(res, extid, extfilename):
@@ -302,210 +404,247 @@ def validate_crx_response(res, extid, extfilename):
                 extfilename))
 
 
-def update_crx(archivedir, tmptardir, ext_id, date):
+def link_last_crx(staging, date, extfilename, last_crx_file):
+    staging.write_text(date, extfilename + ".link",
+                       os.path.join("..",
+                                    last_modified_utc_date(last_crx_file),
+                                    extfilename) + "\n")
+
+
+def update_crx(archivedir, staging, ext_id, date, crx_version=None):
+    """Download the crx file of an extension, unless it is not modified
+       since the last download. The crx_version (if known from a batched
+       update check) allows for skipping the request altogether."""
     res = None
     extfilename = "default_ext_archive.crx"
     last_crx_file, last_crx_etag = last_crx(archivedir, ext_id)
     last_crx_http_date = last_modified_http_date(last_crx_file)
     headers = ""
+    saved_requests = 0
     if last_crx_file is not "":
         headers = {'If-Modified-Since': last_crx_http_date}
+        if last_crx_etag:
+            headers['If-None-Match'] = last_crx_etag
     try:
-        log_info("* Checking If-Modified-Since", 2)
-        with request_manager.normal_request():
-            res = requests.get(
+        etag_file = read_etag_file(archivedir, ext_id) if crx_version is not None else None
+        if etag_file is not None and last_crx_file is not "" and crx_version.matches(
+                etag_file.get("last_crx_version"), etag_file.get("last_crx_hash_sha256")):
+            log_info("* crx archive (Last: {}): version {} not modified".format(
+                value_of(last_crx_http_date, "n/a"), crx_version.version), 2)
+            # Recorded like a 304 response, so that the db ingest treats
+            # both cases alike
+            extfilename = os.path.basename(last_crx_file)
+            staging.write_text(date, extfilename + ".status", "304")
+            staging.write_text(date, extfilename + ".etag", last_crx_etag)
+            link_last_crx(staging, date, extfilename, last_crx_file)
+            return RequestResult(saved_requests=1, http_status=304)
+
+        log_info("* Checking If-None-Match/If-Modified-Since", 2)
+        with request_manager.normal_request("download") as egress:
+            res = session_manager.get(
                 const_download_url().format(ext_id),
+                egress=egress,
                 stream=True,
                 headers=headers,
                 timeout=10)
+            request_manager.report("download", res.status_code, egress)
         log_info("* crx archive (Last: {}): {}".format(value_of(last_crx_http_date, "n/a"), str(res.status_code)), 2)
         extfilename = os.path.basename(res.url)
         if re.search('&', extfilename):
             extfilename = "default.crx"
 
         if res.status_code == 304:
-            with request_manager.normal_request():
-                etag = requests.head(
-                    const_download_url().format(ext_id),
-                    timeout=10,
-                    allow_redirects=True).headers.get('ETag')
-            write_text(tmptardir, date, extfilename + ".etag", etag)
+            # A 304 carrying an ETag already tells us the current version;
+            # only ask for it separately if the server did not send one.
+            etag = res.headers.get('ETag')
+            res.close()
+            if etag is None:
+                with request_manager.normal_request("download") as egress:
+                    res_head = session_manager.head(
+                        const_download_url().format(ext_id),
+                        egress=egress,
+                        timeout=10,
+                        allow_redirects=True)
+                    request_manager.report("download", res_head.status_code, egress)
+                etag = res_head.headers.get('ETag')
+            else:
+                saved_requests = 1
+            staging.write_text(date, extfilename + ".etag", etag)
             log_info("- checking etag, last: {}".format(last_crx_etag), 3)
             log_info("              current: {}".format(etag), 3)
 
             if (etag is not "") and (etag != last_crx_etag):
                 log_info("- downloading due to different etags", 3)
 
-                with request_manager.normal_request():
-                    res = requests.get(
+                with request_manager.normal_request("download") as egress:
+                    res = session_manager.get(
                         const_download_url().format(ext_id),
+                        egress=egress,
                         stream=True,
                         timeout=10)
+                    request_manager.report("download", res.status_code, egress)
             else:
-                write_text(tmptardir, date, extfilename + ".link",
-                           os.path.join("..",
-                                        last_modified_utc_date(last_crx_file),
-                                        extfilename) + "\n")
-        store_request_metadata(tmptardir, date, extfilename, res)
+                link_last_crx(staging, date, extfilename, last_crx_file)
+                if crx_version is not None:
+                    write_etag_file(archivedir, ext_id, last_crx_file, last_crx_etag, crx_version)
+        store_request_metadata(staging, date, extfilename, res)
         if res.status_code == 200:
             validate_crx_response(res, ext_id, extfilename)
-            with open(os.path.join(tmptardir, date, extfilename), 'wb') as f:
-                for chunk in res.iter_content(chunk_size=512 * 1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-            write_text(tmptardir, date, extfilename + ".etag",
-                       res.headers.get("ETag"))
-            etag_file = os.path.join(archivedir, get_local_archive_dir(ext_id), ext_id + ".etag")
-            with open(etag_file, 'w') as f:
-                json.dump({
-                              "last_crx": os.path.join(ext_id, date, extfilename),
-                              "last_crx_etag": res.headers.get("ETag")
-                          }, f)
+            staging.write_chunks(date, extfilename,
+                                 # filter out keep-alive new chunks
+                                 (chunk for chunk in res.iter_content(chunk_size=512 * 1024) if chunk))
+            staging.write_text(date, extfilename + ".etag",
+                               res.headers.get("ETag"))
+            write_etag_file(archivedir, ext_id, os.path.join(ext_id, date, extfilename),
+                            res.headers.get("ETag"), crx_version)
     except Exception as e:
         log_exception("Exception when updating crx", 3)
-        write_text(tmptardir, date, extfilename + ".exception",
-                   traceback.format_exc())
-        return RequestResult(res, e)
-    return RequestResult(res)
+        staging.write_text(date, extfilename + ".exception",
+                           traceback.format_exc())
+        return RequestResult(res, e, saved_requests)
+    return RequestResult(res, saved_requests=saved_requests)
+
+
+def page_annotations(page):
+    json_page = json.loads(page[page.index("{\""):page.rindex("}}},") + 1])
+    return json_page["annotations"]
 
 
 def iterate_authors(pages):
     for page in pages:
-        json_page = json.loads(page[page.index("{\""):page.rindex("}}},") + 1])
-        for annotation in json_page["annotations"]:
+        for annotation in page_annotations(page):
             if "attributes" in annotation:
                 if "replyExists" in annotation["attributes"]:
                     if annotation["attributes"]["replyExists"]:
                         yield (annotation["entity"]["author"], annotation["entity"]["groups"])
 
 
-def update_reviews(tar, date, ext_id):
+def update_comment_pages(staging, date, ext_id, url, payload, fname, label):
+    """Request pages of comments (reviews or support requests) until a page
+       is not full, or const_max_comment_pages() pages have been requested.
+       Returns the last response, the pages, and the number of restricted
+       requests saved compared to always requesting two pages."""
     res = None
-    try:
-        pages = []
-
-        with request_manager.restricted_request():
-            res = requests.post(
-                const_review_url(),
-                data=const_review_payload(ext_id, "0", "100"),
+    pages = []
+    page_size = const_comment_page_size()
+    requested = 0
+    for start in range(0, const_max_comment_pages() * page_size, page_size):
+        with request_manager.restricted_request("reviews") as egress:
+            res = session_manager.post(
+                url,
+                egress=egress,
+                data=payload(ext_id, str(start), str(page_size)),
                 timeout=10)
-        log_info("* review page   0-100: {}".format(str(res.status_code)), 2)
-        store_request_text(tar, date, 'reviews000-099.text', res)
+            request_manager.report("reviews", res.status_code, egress)
+        requested += 1
+        log_info("* {} page {:3d}-{}: {}".format(label, start, start + page_size, str(res.status_code)), 2)
+        store_request_text(staging, date, '{}{:03d}-{:03d}.text'.format(fname, start, start + page_size - 1), res)
         if res.status_code == 200:
             pages += [res.text]
-
-        with request_manager.restricted_request():
-            res = requests.post(
-                const_review_url(),
-                data=const_review_payload(ext_id, "100", "100"),
+            try:
+                if len(page_annotations(res.text)) < page_size:
+                    break
+            except ValueError:
+                # Without knowing the number of comments, we continue
+                # with the next page
+                pass
+    return res, pages, max(0, 2 - requested)
+
+
+def update_replies(staging, date, ext_id, pages, fname, label):
+    """Search the replies to the comments on pages, combined with the reply
+       searches of other extensions if possible."""
+    # Always start with reply number 0 and request 10 replies
+    ext_id_author_tups = [(ext_id, author, 0, 10, groups)
+                          for author, groups in iterate_authors(pages)]
+    if not ext_id_author_tups:
+        return None
+    res = reply_search.search(ext_id_author_tups) if reply_search is not None else None
+    if res is None:
+        with request_manager.restricted_request("reviews") as egress:
+            res = session_manager.post(
+                const_review_search_url(),
+                egress=egress,
+                data=const_review_search_payload(ext_id_author_tups),
                 timeout=10)
-        log_info("* review page   100-200: {}".format(str(res.status_code)), 2)
-        store_request_text(tar, date, 'reviews100-199.text', res)
-        if res.status_code == 200:
-            pages += [res.text]
+            request_manager.report("reviews", res.status_code, egress)
+    log_info("* {} page replies: {}".format(label, str(res.status_code)), 2)
+    store_request_text(staging, date, fname, res)
+    return res
 
-        # Always start with reply number 0 and request 10 replies
-        ext_id_author_tups = [(ext_id, author, 0, 10, groups)
-                              for author, groups in iterate_authors(pages)]
-        if ext_id_author_tups:
-            with request_manager.restricted_request():
-                res = requests.post(
-                    const_review_search_url(),
-                    data=const_review_search_payload(ext_id_author_tups),
-                    timeout=10)
-            log_info("* review page replies: {}".format(str(res.status_code)), 2)
-            store_request_text(tar, date, 'reviewsreplies.text', res)
+
+def update_reviews(staging, date, ext_id):
+    res = None
+    try:
+        res, pages, saved_requests = update_comment_pages(
+            staging, date, ext_id, const_review_url(), const_review_payload, 'reviews', 'review')
+        res = update_replies(staging, date, ext_id, pages, 'reviewsreplies.text', 'review') or res
     except Exception as e:
         log_exception("Exception when updating reviews", 2)
-        write_text(tar, date, 'reviews.html.exception', traceback.format_exc())
+        staging.write_text(date, 'reviews.html.exception', traceback.format_exc())
         return RequestResult(res, e)
-    return RequestResult(res)
+    return RequestResult(res, saved_requests=saved_requests)
 
 
-def update_support(tar, date, ext_id):
+def update_support(staging, date, ext_id):
     res = None
     try:
-        pages = []
-
-        with request_manager.restricted_request():
-            res = requests.post(
-                const_support_url(),
-                data=const_support_payload(ext_id, "0", "100"),
-                timeout=10)
-        log_info("* support page   0-100: {}".format(str(res.status_code)), 2)
-        store_request_text(tar, date, 'support000-099.text', res)
-        if res.status_code == 200:
-            pages += [res.text]
-
-        with request_manager.restricted_request():
-            res = requests.post(
-                const_support_url(),
-                data=const_support_payload(ext_id, "100", "100"),
-                timeout=10)
-        log_info("* support page 100-200: {}".format(str(res.status_code)), 2)
-        store_request_text(tar, date, 'support100-199.text', res)
-        if res.status_code == 200:
-            pages += [res.text]
-
-        # Always start with reply number 0 and request 10 replies
-        ext_id_author_tups = [(ext_id, author, 0, 10, groups)
-                              for author, groups in iterate_authors(pages)]
-        if ext_id_author_tups:
-            with request_manager.restricted_request():
-                res = requests.post(
-                    const_review_search_url(),
-                    data=const_review_search_payload(ext_id_author_tups),
-                    timeout=10)
-            log_info("* support page replies: {}".format(str(res.status_code)), 2)
-            store_request_text(tar, date, 'supportreplies.text', res)
+        res, pages, saved_requests = update_comment_pages(
+            staging, date, ext_id, const_support_url(), const_support_payload, 'support', 'support')
+        res = update_replies(staging, date, ext_id, pages, 'supportreplies.text', 'support') or res
     except Exception as e:
         log_exception("Exception when updating support pages", 2)
-        write_text(tar, date, 'support.html.exception', traceback.format_exc())
+        staging.write_text(date, 'support.html.exception', traceback.format_exc())
         return RequestResult(res, e)
-    return RequestResult(res)
+    return RequestResult(res, saved_requests=saved_requests)
 
 
-def update_extension(tup):
-    archivedir, con, ext_id, forums = tup
-    update_db = False
+def create_staging(archivedir, ext_id):
+    os.makedirs(
+        os.path.join(archivedir, get_local_archive_dir(ext_id)),
+        exist_ok=True)
+    return TarStaging(ext_id)
+
+
+def fetch_phases(archivedir, staging, date, ext_id, forums, crx_version=None, phases=None):
+    """The (phase, function) pairs downloading the pages of an extension
+       into staging, in order, or, when retrying an update, only those of
+       the given phases. Each function returns the RequestResult of its
+       phase."""
+    fetches = [("overview", partial(update_overview, archivedir, staging, date, ext_id))]
+    if forums:
+        fetches.append(("reviews", partial(update_reviews, staging, date, ext_id)))
+    fetches.append(("crx", partial(update_crx, archivedir, staging, ext_id, date, crx_version)))
+    if forums:
+        fetches.append(("support", partial(update_support, staging, date, ext_id)))
+    return [(phase, fetch) for phase, fetch in fetches if phases is None or phase in phases]
+
+
+def fetch_extension(archivedir, staging, date, ext_id, forums, crx_version=None, phases=None):
+    """Download all pages of an extension into staging (see
+       tar_staging.TarStaging), or, when retrying an update, only those of
+       the given phases."""
+    set_logger_tag(ext_id)
+    results = {phase: fetch() for phase, fetch in fetch_phases(
+        archivedir, staging, date, ext_id, forums, crx_version, phases)}
+    session_manager.update_stats()
+    return results.get("overview"), results.get("crx"), results.get("reviews"), results.get("support")
+
+
+def store_extension(archivedir, con, ext_id, date, staging):
+    """Append the downloaded data in staging to the archive of the
+       extension, optionally update the database, and remove the temporary
+       files of staging."""
     set_logger_tag(ext_id)
-    log_info("Updating extension {}".format(" (including forums)" if forums else ""), 1)
+    update_db = False
     is_new = False
     tar_exception = None
     sql_exception = None
     sql_success = False
-    tmptardir = ""
-    start = time.time()
-
-    date = datetime.datetime.now(datetime.timezone.utc).isoformat()
 
     tardir = os.path.join(archivedir, get_local_archive_dir(ext_id), ext_id)
     tar = (tardir + ".tar")
 
-    try:
-        tmpdir = tempfile.mkdtemp()
-        tmptardir = os.path.join(tmpdir, ext_id)
-        log_info("* tmptardir = {}".format(tmptardir), 2)
-        os.makedirs(
-            os.path.join(archivedir, get_local_archive_dir(ext_id)),
-            exist_ok=True)
-    except Exception as e:
-        log_exception("* FATAL: cannot create tmpdir", 3)
-        tar_exception = e
-        return UpdateResult(ext_id, is_new, tar_exception, None, None, None,
-                            None, sql_exception, False)
-
-    res_overview = update_overview(tmptardir, date, ext_id)
-    res_reviews = None
-    res_support = None
-    if forums:
-        res_reviews = update_reviews(tmptardir, date, ext_id)
-
-    res_crx = update_crx(archivedir, tmptardir, ext_id, date)
-
-    if forums:
-        res_support = update_support(tmptardir, date, ext_id)
-
     backup = False
     if backup:
         try:
@@ -532,10 +671,14 @@ def update_extension(tup):
     if not os.path.exists(tar):
         is_new = True
     try:
+        if leases is not None and not leases.holds(ext_id):
+            # Another crawler node might be appending to the archive
+            raise LeaseError("Lease of range {} not held".format(range_of(ext_id)))
         start = time.time()
-        with tarfile.open(tar, mode='a:') as ar:
-            ar.add(tmptardir, arcname=ext_id)
-        log_info("* Appending new data to tar took {:.2f}s".format(time.time() - start), 2)
+        scanned = append_to_tar(tar, staging)
+        log_info("* Appending new data to tar took {:.2f}s{}{}".format(
+            time.time() - start, " (scanned for its end)" if scanned else "",
+            " ({} files spilled to disk)".format(staging.spilled()) if staging.spilled() else ""), 2)
     except Exception as e:
         log_exception("* FATAL: cannot create tar archive", 3)
         tar_exception = e
@@ -546,7 +689,12 @@ def update_extension(tup):
             pass
     if update_db:
         try:
-            update_db_incremental(tmptardir, ext_id, date, con)
+            # The database update reads the data from files
+            tmpdir = tempfile.mkdtemp()
+            try:
+                update_db_incremental(staging.extract(tmpdir), ext_id, date, con)
+            finally:
+                shutil.rmtree(path=tmpdir)
             sql_success = True
         except Exception as e:
             log_exception("* Exception during update of db", 3)
@@ -559,11 +707,11 @@ def update_extension(tup):
                 pass
     else:
         log_info("* DB Update disabled")
-        
+
     try:
-        shutil.rmtree(path=tmpdir)
+        staging.cleanup()
     except Exception as e:
-        log_exception("* FATAL: cannot remove archive directory", 3)
+        log_exception("* FATAL: cannot remove temporary files", 3)
         tar_exception = e
         try:
             write_text(tardir, date, ext_id + ".dir.remove.exception",
@@ -571,12 +719,39 @@ def update_extension(tup):
         except Exception:
             pass
 
+    return is_new, tar_exception, sql_exception, sql_success
+
+
+def update_extension(tup):
+    archivedir, con, ext_id, forums, crx_version, phases, date = tup
+    set_logger_tag(ext_id)
+    log_info("Updating extension {}{}".format(" (including forums)" if forums else "",
+                                              " (retrying {})".format(", ".join(sorted(phases))) if phases else ""),
+             1)
+    start = time.time()
+
+    if date is None:
+        date = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    try:
+        staging = create_staging(archivedir, ext_id)
+    except Exception as e:
+        log_exception("* FATAL: cannot create archive directory", 3)
+        return UpdateResult(ext_id, False, e, None, None, None,
+                            None, None, False)
+
+    res_overview, res_crx, res_reviews, res_support = fetch_extension(
+        archivedir, staging, date, ext_id, forums, crx_version, phases)
+
+    is_new, tar_exception, sql_exception, sql_success = store_extension(
+        archivedir, con, ext_id, date, staging)
+
     log_info("* Duration: {}".format(datetime.timedelta(seconds=int(time.time() - start))), 2)
     return UpdateResult(ext_id, is_new, tar_exception, res_overview, res_crx,
                         res_reviews, res_support, sql_exception, sql_success)
 
 
-def init_process(verbose, start_pystuck, rm):
+def init_process(verbose, start_pystuck, rm, sm, rs=None, lm=None):
     if start_pystuck:
         import pystuck
         pystuck.run_server(port=((os.getpid() % 10000) + 10001))
@@ -584,8 +759,21 @@ def init_process(verbose, start_pystuck, rm):
     global request_manager
     request_manager = rm
 
+    global session_manager
+    session_manager = sm
+
+    global reply_search
+    reply_search = rs
+
+    global leases
+    leases = lm
+
+    if multiprocessing.current_process().name != "MainProcess":
+        log_worker_startup()
 
-def update_extensions(archivedir, parallel, forums_ext_ids, ext_ids, timeout, verbose, start_pystuck):
+
+def get_update_tups(forums_ext_ids, ext_ids):
+    """Pairs of extension id and forum flag, in random order."""
     ext_with_forums = list(set(forums_ext_ids))
     ext_without_forums = list(set(ext_ids) - set(forums_ext_ids))
 
@@ -594,41 +782,252 @@ def update_extensions(archivedir, parallel, forums_ext_ids, ext_ids, timeout, ve
 
     log_info("Updating {} extensions ({} including forums, {} excluding forums)".format(len(tups), len(ext_with_forums),
         len(ext_without_forums)))
+    return tups
+
+
+class UpdateQueue:
+    """Extensions to update: the ids of the iterable new_ext_ids (e.g., from
+       discovery) and the (ext_id, forums) pairs of the iterable feed (e.g.,
+       from the schedule of the crawl daemon), which are read by background
+       threads, are handed out before the remaining (ext_id, forums) pairs
+       of tups. Unlike new ids, fed extensions are updated again whenever
+       they are fed. Updates that raised exceptions are retried (only their
+       failed phases, if the downloaded data was stored) after an
+       exponential back-off. The date of an update is set when it is
+       handed out; retries of some phases keep the date of the first
+       attempt, so that all files of the update are stored under one
+       date."""
+
+    def __init__(self, tups, new_ext_ids=None, feed=None):
+        self.tups = deque(tups)
+        self.seen = {ext_id for ext_id, _ in tups}
+        self.new_ids = queue.Queue()
+        self.producing = 0
+        self.num_new = 0
+        self.in_progress = 0
+        # Heap of (due time, ext_id, forums, phases, date)
+        self.retries = []
+        # ext_id -> (result of the previous attempts, phases of the retry)
+        self.partial = {}
+        # ext_id -> date of the update handed out
+        self.dates = {}
+        # Attempts of the updates that are retried
+        self.attempts = {}
+        self.num_retries = 0
+        self.num_retried = 0
+        for items, new in [(new_ext_ids, True), (feed, False)]:
+            if items is not None:
+                self.producing += 1
+                threading.Thread(target=self._produce, args=(items, new), daemon=True).start()
+
+    def _produce(self, items, new):
+        try:
+            for item in items:
+                self.new_ids.put((item, False, True) if new else (item[0], item[1], False))
+        except Exception:
+            log_exception("Exception when reading new extension ids")
+        finally:
+            self.new_ids.put(None)
+
+    def _next(self, block):
+        if self.retries and self.retries[0][0] <= time.time():
+            _, ext_id, forums, phases, date = heapq.heappop(self.retries)
+            return ext_id, forums, phases, date
+        while self.producing:
+            try:
+                item = self.new_ids.get(block=block and not self.tups, timeout=1)
+            except queue.Empty:
+                break
+            if item is None:
+                self.producing -= 1
+                continue
+            ext_id, forums, new = item
+            if not new:
+                return ext_id, forums, None, None
+            if ext_id not in self.seen:
+                self.seen.add(ext_id)
+                self.num_new += 1
+                return ext_id, False, None, None
+        if self.tups:
+            ext_id, forums = self.tups.popleft()
+            return ext_id, forums, None, None
+        if block and self.retries:
+            time.sleep(min(1.0, max(0.0, self.retries[0][0] - time.time())))
+        return None
+
+    def get(self, block=False):
+        """Next (ext_id, forums, phases, date) tuple, where phases is None
+           unless retrying, or None if there is none (yet). If block is set,
+           waits (a second at most) for new ids or retries."""
+        tup = self._next(block)
+        if tup is None:
+            return None
+        ext_id, forums, phases, date = tup
+        if date is None:
+            date = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.dates[ext_id] = date
+        self.in_progress += 1
+        return ext_id, forums, phases, date
+
+    def finish(self, result, forums):
+        """The final UpdateResult of an update handed out by get(), or None
+           if the update is retried."""
+        self.in_progress -= 1
+        ext_id = result.ext_id
+        date = self.dates.pop(ext_id, None)
+        previous, phases = self.partial.pop(ext_id, (None, None))
+        if previous is not None:
+            result = result.merge(previous)
+        if not result.has_exception() or self.attempts.get(ext_id, 0) >= const_max_retries():
+            self.attempts.pop(ext_id, None)
+            return result
+
+        if result.worker_exception is not None and previous is not None:
+            # Retry the phases of the failed retry
+            retry_phases = phases
+        else:
+            retry_phases = result.failed_phases()
+        attempt = self.attempts.get(ext_id, 0) + 1
+        self.attempts[ext_id] = attempt
+        self.num_retries += 1
+        if attempt == 1:
+            self.num_retried += 1
+        delay = min(const_retry_max_delay(), const_retry_delay() * 2**(attempt - 1)) * random.uniform(0.5, 1.0)
+        set_logger_tag(ext_id)
+        log_info("Retrying {} in {:.0f}s (attempt {} of {})".format(
+            ", ".join(sorted(retry_phases)) if retry_phases is not None else "update", delay, attempt,
+            const_max_retries()), 1)
+        set_logger_tag("-" * 32)
+        self.partial[ext_id] = (result, retry_phases)
+        # A retry of the whole update is stored under a new date
+        heapq.heappush(self.retries, (time.time() + delay, ext_id, forums, retry_phases,
+                                      date if retry_phases is not None else None))
+        return None
+
+    def pending(self):
+        """Number of updates (and retries) not handed out yet."""
+        return len(self.tups) + len(self.retries)
+
+    def retries_summary(self):
+        return "{} retries of {} extensions".format(self.num_retries, self.num_retried)
+
+    def done(self):
+        return not self.producing and not self.tups and not self.retries and self.in_progress == 0
+
+
+def update_result(future, ext_id):
+    """The UpdateResult of a future scheduled on a ProcessPool. When the
+       worker failed (or was killed), the files it spilled to disk are
+       removed."""
+    try:
+        return future.result()
+    except TimeoutError as error:
+        log_warning("WorkerException: Processing of %s took longer than %d seconds" % (ext_id, error.args[1]))
+        worker_exception = error
+    except ProcessExpired as error:
+        log_warning("WorkerException: %s (%s), exit code: %d" % (error, ext_id, error.exitcode))
+        worker_exception = error
+    except Exception as error:
+        log_warning("WorkerException: Processing %s raised %s" % (ext_id, error))
+        log_warning(error.traceback)  # Python's traceback of remote process
+        worker_exception = error
+    remove_spilled(ext_id)
+    return UpdateResult(ext_id, False, None, None, None, None, None, None, None, worker_exception)
+
+
+def update_extensions(archivedir, parallel, forums_ext_ids, ext_ids, timeout, verbose, start_pystuck,
+                      crx_versions=None, egresses=None, new_ext_ids=None, on_result=None, leases=None,
+                      feed=None, max_parallel=None, rm=None):
+    """Update the extensions ext_ids (and, including their forums,
+       forums_ext_ids). New ids from the iterable new_ext_ids are updated
+       as soon as they are read. The UpdateResults are passed to on_result
+       as soon as they are available, if given, and returned otherwise. If
+       leases (a LeaseManager) is given, only extensions of ranges it holds
+       are appended to their archives. The (ext_id, forums) pairs of the
+       iterable feed are updated as they are fed, until it is exhausted. If
+       max_parallel is given, the number of concurrent updates is adjusted
+       at runtime, starting with parallel (see ConcurrencyController). The
+       requests are scheduled by rm (a RequestManager for at least
+       max(parallel, max_parallel) workers), if given, e.g., to share it
+       with the batched update check."""
+    if crx_versions is None:
+        crx_versions = {}
+    tups = get_update_tups(forums_ext_ids, ext_ids)
+    update_queue = UpdateQueue(tups, new_ext_ids, feed)
+    max_workers = max(parallel, max_parallel) if max_parallel is not None else parallel
 
     with MysqlProcessBackend(
             None,
             read_default_file=const_mysql_config_file(),
             charset='utf8mb4') as con:
         results = []
-        with ProcessPool(max_workers=parallel, initializer=init_process,
-                         initargs=(verbose, start_pystuck, RequestManager(parallel))) as pool:
-            future = pool.map(update_extension, [(archivedir, con, extid, archive) for extid, archive in tups], chunksize=1, timeout=timeout)
-            iterator = future.result()
-            for ext_id in ext_ids:
-                try:
-                    results.append(next(iterator))
-                except StopIteration:
-                    break
-                except TimeoutError as error:
-                    log_warning("WorkerException: Processing of %s took longer than %d seconds" % (ext_id, error.args[1]))
-                    results.append(UpdateResult(ext_id, False, None, None, None, None, None, None, None, error))
-                except ProcessExpired as error:
-                    log_warning("WorkerException: %s (%s), exit code: %d" % (error, ext_id, error.exitcode))
-                    results.append(UpdateResult(ext_id, False, None, None, None, None, None, None, None, error))
-                except Exception as error:
-                    log_warning("WorkerException: Processing %s raised %s" % (ext_id, error))
-                    log_warning(error.traceback)  # Python's traceback of remote process
-                    results.append(UpdateResult(ext_id, False, None, None, None, None, None, None, None, error))
-
+        if rm is None:
+            rm = RequestManager(max_workers, egresses=egresses)
+        sm = SessionManager(egresses=egresses)
+        concurrency = None
+        if max_parallel is not None:
+            concurrency = ConcurrencyController(parallel, min(const_min_parallel_downloads(), max_parallel),
+                                                max_parallel, rm)
+        last_rate_log = time.time()
+        with ReplySearchBatcher(rm, sm) as rs, \
+                ProcessPool(max_workers=max_workers, initializer=init_process,
+                            initargs=(verbose, start_pystuck, rm, sm, rs, leases)) as pool:
+            # Only a few tasks are queued in the pool at any time, so that
+            # new ids do not wait for all others to be processed (and, when
+            # adjusting the concurrency, none beyond the current limit)
+            in_flight = {}
+            while in_flight or not update_queue.done():
+                while len(in_flight) < (concurrency.limit if concurrency is not None else 2 * parallel):
+                    tup = update_queue.get(block=not in_flight)
+                    if tup is None:
+                        break
+                    ext_id, forums, phases, date = tup
+                    future = pool.schedule(update_extension,
+                                           args=[(archivedir, con, ext_id, forums, crx_versions.get(ext_id),
+                                                  phases, date)],
+                                           timeout=timeout)
+                    in_flight[future] = (ext_id, forums, time.time())
+                if time.time() - last_rate_log > const_rate_log_interval():
+                    log_info("Request rates: {}".format(rm.rates_summary()))
+                    last_rate_log = time.time()
+                if concurrency is not None:
+                    concurrency.update(len(in_flight))
+                done, _ = wait(list(in_flight), timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ext_id, forums, start = in_flight.pop(future)
+                    result = update_result(future, ext_id)
+                    if concurrency is not None:
+                        concurrency.finished(time.time() - start,
+                                             result.worker_exception is not None or result.has_exception())
+                    result = update_queue.finish(result, forums)
+                    if result is None:
+                        continue
+                    if on_result is not None:
+                        on_result(result)
+                    else:
+                        results.append(result)
+
+    log_info("Connection reuse: {}".format(sm.stats_summary()))
+    log_info("Request rates: {}".format(rm.rates_summary()))
+    for lane_summary in rm.lanes_summary():
+        log_info("Request lane {}".format(lane_summary))
+    log_info("Reply searches: {}".format(rs.stats_summary()))
+    log_info("Retries: {}".format(update_queue.retries_summary()))
+    if concurrency is not None:
+        log_info("Concurrency: {}".format(concurrency.summary()))
+    if new_ext_ids is not None:
+        log_info("Updated {} new extensions".format(update_queue.num_new))
     return results
 
 
-def get_existing_ids(archivedir):
-    byte = '[0-9a-z][0-9a-z][0-9a-z][0-9a-z][0-9a-z][0-9a-z][0-9a-z][0-9a-z]'
-    word = byte + byte + byte + byte
-    return list(
-        map(lambda d: re.sub(".tar$", "", re.sub(r"^.*\/", "", d)),
-            glob.glob(os.path.join(archivedir, "*", word + ".tar"))))
+def get_existing_ids(archivedir, node=None):
+    """Ids of the archived extensions, from the registries (which are built,
+       as the registry of node, from the archive directory if they are
+       empty)."""
+    with Registry(archivedir, node) as registry:
+        if registry.is_empty():
+            registry.rebuild()
+        return registry.ids()
 
 
 def get_forum_ext_ids(confdir):
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+Event-loop based crawl engine: instead of one process per extension, a
+single process keeps many extension updates in flight. The downloads use
+the blocking requests library, so they still run on a thread pool of -p
+threads, appending to the tar archives (and updating the database) on a
+small one. Each phase of an update (overview, reviews, crx, support) is
+awaited separately, i.e., an extension takes a download thread only while
+one of its requests is in flight, and an abandoned (timed out) update stops
+after its current phase.
+"""
+
+import asyncio
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from ExtensionCrawler.archive import (UpdateResult, UpdateQueue, create_staging, fetch_phases,
+                                      store_extension, get_update_tups, init_process)
+from ExtensionCrawler.autoscale import ConcurrencyController
+from ExtensionCrawler.config import (const_mysql_config_file, const_async_store_workers, const_rate_log_interval,
+                                     const_min_parallel_downloads)
+from ExtensionCrawler.dbbackend.mysql_process import MysqlProcessBackend
+from ExtensionCrawler.request_manager import RequestManager
+from ExtensionCrawler.reply_search import ReplySearchBatcher
+from ExtensionCrawler.session_manager import SessionManager
+from ExtensionCrawler.util import log_info, log_warning, log_exception, set_logger_tag
+
+
+def prepare_extension(archivedir, ext_id, forums, phases):
+    set_logger_tag(ext_id)
+    log_info("Updating extension {}{}".format(" (including forums)" if forums else "",
+                                              " (retrying {})".format(", ".join(sorted(phases))) if phases else ""),
+             1)
+    return create_staging(archivedir, ext_id)
+
+
+def fetch_phase(ext_id, fetch):
+    set_logger_tag(ext_id)
+    return fetch()
+
+
+async def update_extension(loop, fetch_pool, store_pool, archivedir, con, ext_id, forums, crx_version, phases,
+                           date, abandoned):
+    """Update an extension; returns None if the update was abandoned (timed
+       out, see abandoned) before it was stored."""
+    start = time.time()
+
+    try:
+        staging = await loop.run_in_executor(fetch_pool, prepare_extension, archivedir, ext_id, forums, phases)
+    except Exception as e:
+        set_logger_tag(ext_id)
+        log_exception("* FATAL: cannot create archive directory", 3)
+        return UpdateResult(ext_id, False, e, None, None, None,
+                            None, None, False)
+
+    results = {}
+    for phase, fetch in fetch_phases(archivedir, staging, date, ext_id, forums, crx_version, phases):
+        if ext_id in abandoned:
+            break
+        results[phase] = await loop.run_in_executor(fetch_pool, fetch_phase, ext_id, fetch)
+    if ext_id in abandoned:
+        staging.cleanup()
+        return None
+
+    is_new, tar_exception, sql_exception, sql_success = await loop.run_in_executor(
+        store_pool, store_extension, archivedir, con, ext_id, date, staging)
+
+    set_logger_tag(ext_id)
+    log_info("* Duration: {}".format(datetime.timedelta(seconds=int(time.time() - start))), 2)
+    set_logger_tag("-" * 32)
+    return UpdateResult(ext_id, is_new, tar_exception, results.get("overview"), results.get("crx"),
+                        results.get("reviews"), results.get("support"), sql_exception, sql_success)
+
+
+async def run_update_extensions(archivedir, parallel, update_queue, timeout, con, crx_versions, rm, on_result,
+                                concurrency=None):
+    loop = asyncio.get_event_loop()
+    results = []
+    last_rate_log = time.time()
+    active = 0
+    # The ids of the extensions whose update timed out, but whose thread
+    # (which cannot be cancelled) is still running; they are neither stored
+    # nor retried until it has finished
+    abandoned = set()
+
+    with ThreadPoolExecutor(max_workers=parallel) as fetch_pool, \
+            ThreadPoolExecutor(max_workers=const_async_store_workers()) as store_pool:
+
+        def report(result, forums):
+            result = update_queue.finish(result, forums)
+            if result is None:
+                return
+            if on_result is not None:
+                on_result(result)
+            else:
+                results.append(result)
+
+        def abandoned_finished(ext_id, result, forums, task):
+            abandoned.discard(ext_id)
+            if task.exception() is not None:
+                log_warning("WorkerException: Abandoned update of %s raised %s" % (ext_id, task.exception()))
+            report(result, forums)
+
+        async def worker():
+            nonlocal last_rate_log, active
+            while not update_queue.done():
+                if concurrency is not None:
+                    concurrency.update(active)
+                    if active >= concurrency.limit:
+                        await asyncio.sleep(1)
+                        continue
+                tup = update_queue.get()
+                if tup is None:
+                    # Waiting for new ids or retries
+                    await asyncio.sleep(1)
+                    continue
+                ext_id, forums, phases, date = tup
+                if time.time() - last_rate_log > const_rate_log_interval():
+                    log_info("Request rates: {}".format(rm.rates_summary()))
+                    last_rate_log = time.time()
+                active += 1
+                start = time.time()
+                task = asyncio.ensure_future(
+                    update_extension(loop, fetch_pool, store_pool, archivedir, con, ext_id, forums,
+                                     crx_versions.get(ext_id), phases, date, abandoned))
+                try:
+                    result = await asyncio.wait_for(asyncio.shield(task), timeout)
+                except asyncio.TimeoutError as error:
+                    log_warning("WorkerException: Processing of %s took longer than %d seconds" % (ext_id, timeout))
+                    result = UpdateResult(ext_id, False, None, None, None, None, None, None, None, error)
+                    abandoned.add(ext_id)
+                    active -= 1
+                    if concurrency is not None:
+                        concurrency.finished(time.time() - start, True)
+                    task.add_done_callback(partial(abandoned_finished, ext_id, result, forums))
+                    continue
+                except Exception as error:
+                    log_warning("WorkerException: Processing %s raised %s" % (ext_id, error))
+                    result = UpdateResult(ext_id, False, None, None, None, None, None, None, None, error)
+                active -= 1
+                if concurrency is not None:
+                    concurrency.finished(time.time() - start,
+                                         result.worker_exception is not None or result.has_exception())
+                report(result, forums)
+
+        await asyncio.gather(*[worker() for _ in range(parallel)])
+
+    return results
+
+
+def update_extensions_async(archivedir, parallel, forums_ext_ids, ext_ids, timeout, verbose, start_pystuck,
+                            crx_versions=None, egresses=None, new_ext_ids=None, on_result=None,
+                            leases=None, feed=None, max_parallel=None, rm=None):
+    """Drop-in replacement for archive.update_extensions, where parallel is
+       the number of extensions in flight within this process, each taking
+       a download thread while one of its requests is in flight. An extension that times out is retried only
+       after its thread has finished (without storing it)."""
+    if crx_versions is None:
+        crx_versions = {}
+    tups = get_update_tups(forums_ext_ids, ext_ids)
+    update_queue = UpdateQueue(tups, new_ext_ids, feed)
+    max_workers = max(parallel, max_parallel) if max_parallel is not None else parallel
+
+    if rm is None:
+        rm = RequestManager(max_workers, egresses=egresses)
+    sm = SessionManager(threads=max_workers, egresses=egresses)
+    concurrency = None
+    if max_parallel is not None:
+        concurrency = ConcurrencyController(parallel, min(const_min_parallel_downloads(), max_parallel),
+                                            max_parallel, rm)
+    with ReplySearchBatcher(rm, sm) as rs, MysqlProcessBackend(
+            None,
+            read_default_file=const_mysql_config_file(),
+            charset='utf8mb4') as con:
+        # The pystuck server of the main process covers all threads
+        init_process(verbose, False, rm, sm, rs, leases)
+        results = asyncio.run(run_update_extensions(archivedir, max_workers, update_queue, timeout, con, crx_versions,
+                                                    rm, on_result, concurrency))
+
+    sm.update_stats()
+    log_info("Connection reuse: {}".format(sm.stats_summary()))
+    log_info("Request rates: {}".format(rm.rates_summary()))
+    for lane_summary in rm.lanes_summary():
+        log_info("Request lane {}".format(lane_summary))
+    log_info("Reply searches: {}".format(rs.stats_summary()))
+    log_info("Retries: {}".format(update_queue.retries_summary()))
+    if concurrency is not None:
+        log_info("Concurrency: {}".format(concurrency.summary()))
+    if new_ext_ids is not None:
+        log_info("Updated {} new extensions".format(update_queue.num_new))
+    return results
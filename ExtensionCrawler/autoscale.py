@@ -0,0 +1,138 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for adjusting the number of concurrent extension updates
+   of the crawl engines at runtime."""
+
+import time
+
+from ExtensionCrawler.config import (const_autoscale_interval, const_autoscale_increase, const_autoscale_decrease,
+                                     const_autoscale_max_errors, const_autoscale_max_cpu,
+                                     const_autoscale_max_iowait)
+from ExtensionCrawler.util import log_info
+
+
+def read_cpu_times():
+    """Total and idle/iowait jiffies of all CPUs (from /proc/stat), or None
+       if not available."""
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(field) for field in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    return sum(fields), fields[3], fields[4] if len(fields) > 4 else 0
+
+
+def cpu_load(previous, current):
+    """Busy and iowait fraction of the CPUs between two read_cpu_times()."""
+    if previous is None or current is None or current[0] <= previous[0]:
+        return None, None
+    total = current[0] - previous[0]
+    idle = current[1] - previous[1]
+    iowait = current[2] - previous[2]
+    return (total - idle - iowait) / total, iowait / total
+
+
+class ConcurrencyController:
+    """Number of concurrent extension updates (limit) between min_limit and
+       max_limit, adjusted every const_autoscale_interval() seconds like the
+       request rates: additively up while the updates are limited by it and
+       throughput does not drop, and multiplicatively down when the store
+       throttles requests (429/503 responses counted by the RequestManager
+       rm), many updates fail, the latency of updates grows without gaining
+       throughput, or the CPUs are busy or waiting for I/O."""
+
+    def __init__(self, limit, min_limit, max_limit, rm):
+        self.limit = max(min_limit, min(max_limit, limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.rm = rm
+        self.lowest = self.limit
+        self.highest = self.limit
+        self.changes = 0
+        self.last_throughput = None
+        self.best_latency = None
+        self._start_window()
+
+    def _start_window(self):
+        self.window_start = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.latency = 0.0
+        self.max_in_flight = 0
+        self.throttled = self.rm.throttled()
+        self.cpu_times = read_cpu_times()
+
+    def finished(self, duration, failed=False):
+        """An update (attempt) took duration seconds."""
+        self.completed += 1
+        self.latency += duration
+        if failed:
+            self.failed += 1
+
+    def _set_limit(self, limit, reason, stats):
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        if limit != self.limit:
+            log_info("Concurrency {} -> {}: {} ({})".format(self.limit, limit, reason, stats))
+            self.limit = limit
+            self.changes += 1
+            self.lowest = min(self.lowest, limit)
+            self.highest = max(self.highest, limit)
+
+    def update(self, in_flight):
+        """Called by the engine with the number of updates in flight; adjusts
+           limit at the end of each interval."""
+        self.max_in_flight = max(self.max_in_flight, in_flight)
+        elapsed = time.time() - self.window_start
+        if elapsed < const_autoscale_interval():
+            return
+        if self.completed == 0:
+            self._start_window()
+            return
+
+        throughput = self.completed / elapsed
+        latency = self.latency / self.completed
+        errors = self.failed / self.completed
+        throttled = self.rm.throttled() - self.throttled
+        cpu, iowait = cpu_load(self.cpu_times, read_cpu_times())
+        stats = "{:.2f} updates/s, {:.1f}s each, {:.0%} failed, {} throttled{}".format(
+            throughput, latency, errors, throttled,
+            ", CPU {:.0%} busy, {:.0%} iowait".format(cpu, iowait) if cpu is not None else "")
+
+        decreased = int(self.limit * const_autoscale_decrease())
+        if throttled > 0:
+            self._set_limit(decreased, "store throttles requests", stats)
+        elif errors > const_autoscale_max_errors():
+            self._set_limit(decreased, "updates fail", stats)
+        elif cpu is not None and iowait > const_autoscale_max_iowait():
+            self._set_limit(decreased, "waiting for I/O", stats)
+        elif cpu is not None and cpu > const_autoscale_max_cpu():
+            self._set_limit(decreased, "CPUs busy", stats)
+        elif (self.best_latency is not None and latency > 2 * self.best_latency
+              and self.last_throughput is not None and throughput <= self.last_throughput):
+            self._set_limit(decreased, "latency grows", stats)
+        elif self.max_in_flight >= self.limit and (self.last_throughput is None
+                                                   or throughput >= 0.95 * self.last_throughput):
+            self._set_limit(self.limit + const_autoscale_increase(), "throughput holds", stats)
+
+        self.last_throughput = throughput
+        self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+        self._start_window()
+
+    def summary(self):
+        return "{} changes, between {} and {} concurrent updates (bounds {}-{}), now {}".format(
+            self.changes, self.lowest, self.highest, self.min_limit, self.max_limit, self.limit)
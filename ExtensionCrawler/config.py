@@ -20,9 +20,20 @@ import os
 import json
 
 
+def const_store_base_url():
+    """Scheme and host of the Chrome store (can be pointed to a local
+    stand-in, e.g., scripts/testing/store-standin)."""
+    return os.environ.get("EXTENSION_STORE_BASE_URL", "https://chrome.google.com")
+
+
+def const_update_base_url():
+    """Scheme and host of the extension update service."""
+    return os.environ.get("EXTENSION_UPDATE_BASE_URL", "https://clients2.google.com")
+
+
 def const_sitemap_url():
     """Sitemap URL."""
-    return "https://chrome.google.com/webstore/sitemap"
+    return const_store_base_url() + "/webstore/sitemap"
 
 
 def const_sitemap_scheme():
@@ -32,36 +43,59 @@ def const_sitemap_scheme():
 
 def const_overview_url(ext_id):
     """URL template for the overview page of an extension."""
-    return 'https://chrome.google.com/webstore/detail/{}'.format(ext_id)
+    return const_store_base_url() + '/webstore/detail/{}'.format(ext_id)
 
 
 def const_store_url():
     """Main URL of the Chrome store."""
-    return 'https://chrome.google.com/webstore'
+    return const_store_base_url() + '/webstore'
 
 
 def const_review_url():
     """Base URL of the review page of an extension."""
-    return 'https://chrome.google.com/reviews/components'
+    return const_store_base_url() + '/reviews/components'
 
 
 def const_review_search_url():
     """Base URL for review search."""
-    return 'https://chrome.google.com/reviews/json/search'
+    return const_store_base_url() + '/reviews/json/search'
 
 
 def const_support_url():
     """Base URL for support pages."""
-    return 'https://chrome.google.com/reviews/components'
+    return const_store_base_url() + '/reviews/components'
 
 
 def const_download_url():
     """Base download URL."""
-    return ('https://clients2.google.com/service/update2/' +
+    return (const_update_base_url() + '/service/update2/' +
             'crx?response=redirect&nacl_arch=x86-64&' +
             'prodversion=9999.0.9999.0&x=id%3D{}%26uc')
 
 
+def const_update_check_url():
+    """Base URL for checking the versions of several extensions at once;
+    one const_update_check_param() is appended per extension."""
+    return (const_update_base_url() + '/service/update2/' +
+            'crx?response=updatecheck&acceptformat=crx2,crx3&nacl_arch=x86-64&' +
+            'prodversion=9999.0.9999.0')
+
+
+def const_update_check_param():
+    """Per-extension parameter of an update check."""
+    return 'x=id%3D{}%26uc'
+
+
+def const_update_check_batch_size():
+    """Number of extensions per update check request."""
+    return 100
+
+
+def const_update_check_scheme():
+    """XML namespace of update check responses."""
+    return "http://www.google.com/update2/response"
+
+
 def const_categories():
     """List of known categories."""
     return [
@@ -96,6 +130,16 @@ def const_review_payload(ext_id, start, end):
             ext_id, start, end)
 
 
+def const_comment_page_size():
+    """Number of reviews/support requests per requested page."""
+    return 100
+
+
+def const_max_comment_pages():
+    """Maximal number of pages of reviews/support requests per extension."""
+    return 2
+
+
 def const_review_search_payload(params):
     """Payload for searches."""
     pre = """req={"applicationId":94,"searchSpecs":["""
@@ -114,6 +158,24 @@ def const_review_search_payload(params):
     return pre + ",".join(args) + post
 
 
+def const_review_search_batch_size():
+    """Maximal number of search specs combined into one review search
+    request (from the reply searches of several extensions)."""
+    return 100
+
+
+def const_review_search_batch_delay():
+    """Maximal number of seconds a reply search waits for others to be
+    combined with."""
+    return 5.0
+
+
+def const_review_search_wait():
+    """Number of seconds (besides the batch delay) after which a worker stops
+    waiting for a combined reply search, and searches on its own."""
+    return 120.0
+
+
 def get_local_archive_dir(ext_id):
     """Local archive dir of extension."""
     return "{}".format(ext_id[:3])
@@ -138,11 +200,190 @@ def const_parallel_downloads():
     return 36
 
 
+def const_min_parallel_downloads():
+    """Lower bound of the number of parallel downloads when it is adjusted
+    at runtime (see --max-parallel of the crawler)."""
+    return 4
+
+
+def const_autoscale_interval():
+    """Interval (in seconds) at which the number of parallel downloads is
+    adjusted at runtime."""
+    return 60
+
+
+def const_autoscale_increase():
+    """Additive increase of the number of parallel downloads per interval
+    while throughput holds."""
+    return 2
+
+
+def const_autoscale_decrease():
+    """Multiplicative decrease of the number of parallel downloads when the
+    store throttles requests, updates fail, latency grows, or the machine
+    is busy."""
+    return 0.75
+
+
+def const_autoscale_max_errors():
+    """Fraction of failed extension updates (per interval) from which on
+    the number of parallel downloads is decreased."""
+    return 0.2
+
+
+def const_autoscale_max_cpu():
+    """Fraction of busy CPU time (per interval) from which on the number of
+    parallel downloads is decreased."""
+    return 0.9
+
+
+def const_autoscale_max_iowait():
+    """Fraction of CPU time waiting for I/O (per interval), e.g., for
+    appending to the archives, from which on the number of parallel
+    downloads is decreased."""
+    return 0.3
+
+
 def const_verbose():
     """Default verbosity."""
     return True
 
 
+def const_engine():
+    """Default crawl engine: 'process' (one process per extension),
+    'async' (many extensions in flight within one process), or 'pipeline'
+    (separate processes for downloading and for appending to archives)."""
+    return "process"
+
+
+def const_async_store_workers():
+    """Number of threads appending to archives in the async engine."""
+    return 4
+
+
+def const_pipeline_store_workers():
+    """Number of processes appending to archives (and updating the
+    database) in the pipeline engine."""
+    return 4
+
+
+def const_pipeline_backlog():
+    """Maximum number of downloaded extensions waiting to be appended to
+    their archives in the pipeline engine; downloads pause while it is
+    reached."""
+    return 64
+
+
+def const_schedule():
+    """Default for crawling only the extensions due according to their
+    crawl history (instead of all)."""
+    return False
+
+
+def const_daily_budget():
+    """Maximal number of extensions crawled per run when scheduling (None
+    for no limit)."""
+    return None
+
+
+def const_recrawl_interval():
+    """Shortest time (in seconds) between two crawls of an extension."""
+    return 24 * 60 * 60
+
+
+def const_recrawl_max_interval():
+    """Longest time (in seconds) between two crawls of an extension that
+    is in the store."""
+    return 14 * 24 * 60 * 60
+
+
+def const_recrawl_max_missing_interval():
+    """Longest time (in seconds) between two crawls of an extension that
+    is not in the store anymore."""
+    return 90 * 24 * 60 * 60
+
+
+def const_recrawl_popular_downloads():
+    """Number of downloads from which on an extension is crawled every
+    const_recrawl_interval()."""
+    return 10000
+
+
+def const_recrawl_slack():
+    """Time (in seconds) an extension may be crawled before it is due, as
+    runs do not start at exactly the same time every day."""
+    return 6 * 60 * 60
+
+
+def const_daemon_interval():
+    """Length (in seconds) of a scheduling round of the crawl daemon: the
+    extensions due are scheduled (and a summary is logged) once per round,
+    and their updates are spread over it."""
+    return 15 * 60
+
+
+def const_daemon_in_flight():
+    """Maximal number of extensions the crawl daemon (or the feed of a
+    crawler node) feeds to the crawl engine ahead of their completion, per
+    concurrent download."""
+    return 2
+
+
+def const_egresses():
+    """Local addresses to bind to, or proxy URLs (e.g., http://host:3128),
+    the requests of the crawler are distributed over; None uses the default
+    route."""
+    return [None]
+
+
+def const_http_pool_sizes():
+    """Number of kept-alive connections per host (URL prefix) and worker
+    thread."""
+    return {
+        const_store_base_url(): 2,
+        const_update_base_url(): 2,
+        'https://clients2.googleusercontent.com': 2
+    }
+
+
+def const_rate_limits():
+    """Initial, minimal and maximal rate (requests/s) and burst size of the
+    token buckets for the store pages, the download host and the review
+    and support endpoints."""
+    return {
+        'store': (20.0, 1.0, 100.0, 10),
+        'download': (20.0, 1.0, 100.0, 10),
+        'reviews': (1.5, 0.1, 5.0, 1)
+    }
+
+
+def const_restricted_lane_slots():
+    """Number of restricted requests (reviews and support pages) that may
+    be in flight at the same time, independent of the normal requests."""
+    return 1
+
+
+def const_rate_increase():
+    """Additive increase of a request rate (requests/s) per second of
+    healthy responses."""
+    return 0.05
+
+
+def const_rate_decrease():
+    """Multiplicative decrease of a request rate after a 503/429 response."""
+    return 0.5
+
+
+def const_rate_decrease_cooldown():
+    """Minimal time (in seconds) between two decreases of a request rate."""
+    return 10.0
+
+
+def const_rate_log_interval():
+    """Interval (in seconds) for logging the current request rates."""
+    return 300
+
+
 def const_use_process_pool():
     """Use ProcessPool (from module 'pebble') for concurrency."""
     return False
@@ -157,11 +398,58 @@ def const_discover():
     return False
 
 
+def const_update_check():
+    """Default configuration of the batched crx update check"""
+    return True
+
+
 def const_ext_timeout():
     """Timeout for downloading an individual extension (2 hours)."""
     return 2*60*60
 
 
+def const_max_retries():
+    """Number of times the failed parts of an extension update (e.g., the
+    crx download after a connection reset) are retried."""
+    return 3
+
+
+def const_retry_delay():
+    """Delay (in seconds) before the first retry of an extension update,
+    which doubles with every further retry (with jitter)."""
+    return 30
+
+
+def const_retry_max_delay():
+    """Maximum delay (in seconds) before a retry of an extension update."""
+    return 10*60
+
+
+def const_lease_prefix_length():
+    """Length of the id prefixes that crawler nodes sharing an archive
+    lease, i.e., a lease covers 16**(3 - n) archive directories."""
+    return 2
+
+
+def const_lease_duration():
+    """Number of seconds a lease of a crawler node is valid without being
+    renewed (which happens after a third of it)."""
+    return 10*60
+
+
+def const_lease_grace():
+    """Number of seconds after its expiry before a lease is taken over by
+    another crawler node, allowing for clock skew."""
+    return 60
+
+
+def const_staging_spill_size():
+    """Size (in bytes) above which a download (e.g., a crx file) is written
+    to a temporary file instead of being kept in memory until it is
+    appended to the archive."""
+    return 8*1024*1024
+
+
 def const_mysql_config_file():
     return os.path.expanduser("~/.my.cnf")
 
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for crawling continuously: one crawl engine keeps running
+   (with its processes and connections), and is fed the extensions that are
+   due according to the crawl history, round by round, spread evenly over
+   each round."""
+
+import math
+import os
+import threading
+import time
+
+from ExtensionCrawler.archive import get_forum_ext_ids
+from ExtensionCrawler.config import const_daemon_interval, const_recrawl_interval
+from ExtensionCrawler.util import log_info
+
+
+class CrawlDaemon:
+    """Feed (see UpdateQueue) of a continuously running crawl engine. Every
+       round of interval seconds, the extensions due (of known_ids, the ones
+       discovered, and the ones in forums.conf of conf_dir, which is read
+       again when it changed) are scheduled, at most budget per day, and fed
+       at most max_in_flight ahead of their results. The callbacks on_round
+       (with the start of the new round) and on_result (of the engine, see
+       finished) are serialized."""
+
+    def __init__(self, conf_dir, history, known_ids, max_in_flight, on_round, on_result, interval=None,
+                 budget=None, discover=None, check_versions=None):
+        self.conf_dir = conf_dir
+        self.forums_mtime = None
+        self.forum_ext_ids = set()
+        self.history = history
+        self.known_ids = set(known_ids)
+        self.max_in_flight = max_in_flight
+        self.on_round = on_round
+        self.on_result = on_result
+        self.interval = interval if interval is not None else const_daemon_interval()
+        self.budget = budget
+        # Functions returning the new ids (given the known ones), and the
+        # crx versions of ext_ids
+        self.discover = discover
+        self.last_discovery = None
+        self.check_versions = check_versions
+        # Passed to the crawl engine, and updated every round
+        self.crx_versions = {}
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def stop(self, *_):
+        """Stop feeding (e.g., as signal handler); the crawl engine returns
+           after the extensions in flight are updated."""
+        if not self.stopping.is_set():
+            log_info("Stopping after {} extensions in flight".format(len(self.in_flight)))
+        self.stopping.set()
+
+    def reload_forums(self):
+        mtime = os.path.getmtime(os.path.join(self.conf_dir, "forums.conf"))
+        if mtime == self.forums_mtime:
+            return
+        forum_ext_ids = set(get_forum_ext_ids(self.conf_dir))
+        if self.forums_mtime is not None:
+            log_info("Reloaded forums.conf: {} extensions ({} added, {} removed)".format(
+                len(forum_ext_ids), len(forum_ext_ids - self.forum_ext_ids),
+                len(self.forum_ext_ids - forum_ext_ids)))
+        self.forums_mtime = mtime
+        self.forum_ext_ids = forum_ext_ids
+        self.known_ids |= forum_ext_ids
+
+    def schedule(self, now):
+        """The (ext_id, forums) pairs due in the round starting at now. The
+           forums are crawled every const_recrawl_interval(), independent
+           of the budget."""
+        self.reload_forums()
+        ext_ids = [ext_id for ext_id in self.known_ids if ext_id not in self.in_flight]
+        forum_ext_ids = [ext_id for ext_id in ext_ids if ext_id in self.forum_ext_ids
+                         and self.history.elapsed(ext_id, now) + self.interval >= const_recrawl_interval()]
+        budget = None
+        if self.budget is not None:
+            budget = math.ceil(self.budget * self.interval / const_recrawl_interval())
+        ext_ids = self.history.due([ext_id for ext_id in ext_ids if ext_id not in self.forum_ext_ids], budget,
+                                   now=now, slack=self.interval)
+        return [(ext_id, True) for ext_id in forum_ext_ids] + [(ext_id, False) for ext_id in ext_ids]
+
+    def _wait_for_slot(self, until=None):
+        """Wait until the time until (if given), and until fewer than
+           max_in_flight extensions are in flight; False if stopped."""
+        if until is not None and not self.stopping.is_set():
+            self.stopping.wait(max(0.0, until - time.time()))
+        while len(self.in_flight) >= self.max_in_flight and not self.stopping.is_set():
+            self.stopping.wait(1)
+        return not self.stopping.is_set()
+
+    def _new_ids(self, now):
+        if self.discover is None or (self.last_discovery is not None
+                                     and now - self.last_discovery < const_recrawl_interval()):
+            return
+        self.last_discovery = now
+        for ext_id in self.discover(set(self.known_ids)):
+            if not self._wait_for_slot():
+                return
+            self.known_ids.add(ext_id)
+            self.in_flight.add(ext_id)
+            yield ext_id, False
+
+    def feed(self):
+        """The (ext_id, forums) pairs to update, until stopped."""
+        while not self.stopping.is_set():
+            start = time.time()
+            end = start + self.interval
+            with self.lock:
+                self.on_round(start)
+                tups = self.schedule(start)
+            log_info("Feeding {} extensions ({} including forums) over the next {}s".format(
+                len(tups), sum(1 for _, forums in tups if forums), self.interval))
+            if self.check_versions is not None and tups:
+                self.crx_versions.update(self.check_versions([ext_id for ext_id, _ in tups]))
+            yield from self._new_ids(start)
+
+            for i, (ext_id, forums) in enumerate(tups):
+                # Spread evenly over the round; the extensions not fed when
+                # the engine falls behind are scheduled again next round
+                if not self._wait_for_slot(start + i * self.interval / len(tups)):
+                    break
+                if time.time() >= end:
+                    log_info("Round ended with {} of {} extensions fed".format(i, len(tups)))
+                    break
+                self.in_flight.add(ext_id)
+                yield ext_id, forums
+            self.stopping.wait(max(0.0, end - time.time()))
+
+    def finished(self, result):
+        """The UpdateResult of a fed extension (on_result of the engine)."""
+        with self.lock:
+            self.in_flight.discard(result.ext_id)
+            self.crx_versions.pop(result.ext_id, None)
+            self.on_result(result)
@@ -98,8 +98,23 @@ def get_crx_status(datepath):
 
 
 def parse_and_insert_overview(ext_id, date, datepath, con):
-    log_debug("- parsing overview file", 3)
     overview_path = os.path.join(datepath, "overview.html")
+    if os.path.exists(overview_path + ".link"):
+        # The page is unchanged since the linked date
+        with open(overview_path + ".link") as f:
+            link = f.read().strip()
+        linked_path = os.path.normpath(os.path.join(datepath, link))
+        if not os.path.exists(linked_path):
+            # Only the files of date were extracted (e.g., when updating
+            # the database incrementally), so the rows of the linked date
+            # are copied
+            linked_date = link[3:].split("/")[0]
+            log_debug("- copying overview of {}".format(linked_date), 3)
+            for table in ["extension", "category"]:
+                con.copy_rows(table, ext_id, convert_date(linked_date), convert_date(date))
+            return
+        overview_path = linked_path
+    log_debug("- parsing overview file", 3)
     if os.path.exists(overview_path):
         with open(overview_path) as overview_file:
             contents = overview_file.read()
@@ -192,6 +192,18 @@ class MysqlBackend:
     def insert(self, table, **kwargs):
         self.insertmany(table, [kwargs])
 
+    def copy_rows(self, table, extid, date, new_date):
+        """Copy the rows of extid on date in table to new_date (e.g., of an
+           unchanged overview page)."""
+        # The rows of date might still be cached
+        self._do_insert(table, self.cache.get(table, []))
+        self.cache[table] = []
+        columns = [c for c in self.retry(lambda: self._get_column_names(table)) if c not in ("date", "last_modified")]
+        query = ("INSERT IGNORE INTO {table}(date,{columns}) "
+                 "SELECT %s,{columns} FROM {table} WHERE extid=%s AND date=%s").format(
+                     table=table, columns=",".join(columns))
+        self.retry(lambda: self.cursor.execute(query, (new_date, extid, date)))
+
     def get_etag(self, extid, date):
         if (extid, date) in self.crx_etag_cache:
             return self.crx_etag_cache[(extid, date)]
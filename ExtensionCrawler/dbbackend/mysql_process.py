@@ -30,6 +30,9 @@ class MysqlProxy:
     def insert(self, table, **kwargs):
         self.insertmany(table, [kwargs])
 
+    def copy_rows(self, table, extid, date, new_date):
+        self.q.put((MysqlProcessBackend.COPY, (table, extid, date, new_date)))
+
     def get_cdnjs_info(self, md5):
         return None
 
@@ -47,6 +50,8 @@ def run(mysql_kwargs, q):
                     break
                 if cmd == MysqlProcessBackend.INSERT:
                     db.insertmany(*data)
+                if cmd == MysqlProcessBackend.COPY:
+                    db.copy_rows(*data)
     except:
         log_exception("Stopping Mysql backend and emptying queue...")
         if not finished:
@@ -61,6 +66,7 @@ def run(mysql_kwargs, q):
 class MysqlProcessBackend:
     STOP = "stop"
     INSERT = "insert"
+    COPY = "copy"
 
     def __init__(self, ext_id, **mysql_kwargs):
         self.mysql_kwargs = mysql_kwargs
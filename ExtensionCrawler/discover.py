@@ -17,11 +17,16 @@
 """Python mnodule providing methods for discovering extensions in the
    Chrome extension store."""
 
-from xml.etree.ElementTree import fromstring
+from xml.etree.ElementTree import fromstring, iterparse
+import json
+import os
 import re
-import requests
+from functools import partial
 from pebble import ThreadPool
 from ExtensionCrawler import config
+from ExtensionCrawler.request_manager import RequestManager
+from ExtensionCrawler.session_manager import SessionManager
+from ExtensionCrawler.util import log_info, log_exception
 
 
 def get_inner_elems(doc):
@@ -40,36 +45,129 @@ def is_generic_url(url):
         config.const_sitemap_url()), url)
 
 
-def iterate_shard(shard_url):
-    if is_generic_url(shard_url):
-        shard = requests.get(shard_url, timeout=10).text
-        for inner_elem in get_inner_elems(shard):
-            overview_url = inner_elem.text
-            yield re.search("[a-z]{32}", overview_url).group(0)
+def load_sitemap_state(path):
+    """Validators (ETag, Last-Modified) and extension ids of the sitemap
+       shards, as of the last discovery."""
+    if path is None or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except Exception:
+        log_exception("Could not read sitemap state {}, fetching all shards".format(path))
+        return {}
 
 
-def process_shard(shard_url):
-    return list(iterate_shard(shard_url))
+def save_sitemap_state(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
 
 
-def get_new_ids(known_ids, max_ids=None):
-    """Crawl extension ids available in Chrome store."""
+def iterate_shard(res):
+    """Extension ids of a sitemap shard, parsed while it is downloaded."""
+    res.raw.decode_content = True
+    loc = r"{{{}}}loc".format(config.const_sitemap_scheme())
+    for _, elem in iterparse(res.raw):
+        if elem.tag == loc:
+            match = re.search("[a-z]{32}", elem.text or "")
+            if match:
+                yield match.group(0)
+        elem.clear()
 
+
+def get_sitemap(session_manager, request_manager, url, **kwargs):
+    """Request url of the sitemap via an egress slot of request_manager."""
+    with request_manager.normal_request("store") as egress:
+        res = session_manager.get(url, egress=egress, timeout=10, **kwargs)
+        request_manager.report("store", res.status_code, egress)
+    return res
+
+
+def process_shard(session_manager, request_manager, state, shard_url):
+    """Extension ids of a sitemap shard, and whether the shard changed
+       since the last discovery (None if the shard is skipped)."""
+    if not is_generic_url(shard_url):
+        return [], None
+    last = state.get(shard_url)
+    headers = {}
+    if last is not None:
+        if last.get("etag"):
+            headers['If-None-Match'] = last["etag"]
+        if last.get("last_modified"):
+            headers['If-Modified-Since'] = last["last_modified"]
+    res = get_sitemap(session_manager, request_manager, shard_url, headers=headers, stream=True)
+    if res.status_code == 304 and last is not None:
+        res.close()
+        # The ids are stored concatenated, as they all have 32 characters
+        ids = last["ids"]
+        return [ids[i:i + 32] for i in range(0, len(ids), 32)], False
+    res.raise_for_status()
+    ids = list(iterate_shard(res))
+    state[shard_url] = {"etag": res.headers.get("ETag"), "last_modified": res.headers.get("Last-Modified"),
+                        "ids": "".join(ids)}
+    return ids, True
+
+
+def get_new_ids(known_ids, max_ids=None, session_manager=None, state_path=None, request_manager=None):
+    """Crawl extension ids available in Chrome store. Shards not modified
+       since the last discovery (as recorded in state_path) are not
+       downloaded again. The requests are paced by request_manager (like
+       the store pages of the crawl it is shared with)."""
+
+    if session_manager is None:
+        session_manager = SessionManager(threads=16)
+    if request_manager is None:
+        request_manager = RequestManager(16, egresses=session_manager.egresses)
+    if not isinstance(known_ids, set):
+        known_ids = set(known_ids)
+    state = load_sitemap_state(state_path)
     shard_urls = [shard_elem.text for shard_elem in get_inner_elems(
-        requests.get(config.const_sitemap_url(), timeout=10).text)]
-    with ThreadPool(16) as pool:
-        future = pool.map(process_shard, shard_urls, chunksize=1)
-        iterator = future.result()
+        get_sitemap(session_manager, request_manager, config.const_sitemap_url()).text)]
+    num_changed = 0
+    num_unchanged = 0
+    num_ids = 0
+    returned_ids = 0
+    try:
+        with ThreadPool(16) as pool:
+            future = pool.map(partial(process_shard, session_manager, request_manager, state), shard_urls, chunksize=1)
+            iterator = future.result()
 
-        returned_ids = 0
-        while True:
+            for shard_url in shard_urls:
+                try:
+                    ids, changed = next(iterator)
+                except StopIteration:
+                    return
+                except Exception:
+                    log_exception("Exception when reading shard {}".format(shard_url), 1)
+                    continue
+                if changed is None:
+                    continue
+                new_ids = [extid for extid in ids if extid not in known_ids]
+                if changed:
+                    num_changed += 1
+                else:
+                    num_unchanged += 1
+                num_ids += len(ids)
+                log_info("* shard {}: {}, {} ids, {} new".format(
+                    shard_url[len(config.const_sitemap_url()):], "changed" if changed else "unchanged",
+                    len(ids), len(new_ids)), 1)
+                for extid in new_ids:
+                    if extid in known_ids:
+                        # Listed in several shards
+                        continue
+                    known_ids.add(extid)
+                    yield extid
+                    returned_ids += 1
+                    if max_ids is not None and returned_ids >= max_ids:
+                        pool.stop()
+                        return
+    finally:
+        log_info("Sitemap: {} shards changed, {} unchanged, {} ids, {} new".format(
+            num_changed, num_unchanged, num_ids, returned_ids), 1)
+        if state_path is not None:
             try:
-                for extid in next(iterator):
-                    if extid not in known_ids:
-                        yield extid
-                        returned_ids += 1
-                        if max_ids is not None and returned_ids >= max_ids:
-                            pool.stop()
-                            return
-            except StopIteration:
-                return
+                save_sitemap_state(state_path, state)
+            except Exception:
+                log_exception("Could not save sitemap state {}".format(state_path), 1)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for the journal of a crawl, which records every completed
+   extension update as soon as it is done, so that a crawl that died can be
+   resumed."""
+
+import json
+import os
+
+from ExtensionCrawler.archive import RequestResult, UpdateResult
+from ExtensionCrawler.util import log_info, log_warning
+
+
+class JournalException(Exception):
+    """An exception of a journaled update, of which only the message is
+       known."""
+    pass
+
+
+def exception_to_json(exception):
+    return str(exception) if exception is not None else None
+
+
+def exception_from_json(message):
+    return JournalException(message) if message is not None else None
+
+
+def request_result_to_json(res):
+    if res is None:
+        return None
+    return {"http_status": getattr(res, "http_status", None), "exception": exception_to_json(res.exception),
+            "saved_requests": res.saved_requests, "unchanged": res.unchanged, "downloads": res.downloads}
+
+
+def request_result_from_json(d):
+    if d is None:
+        return None
+    return RequestResult(http_status=d["http_status"], exception=exception_from_json(d["exception"]),
+                         saved_requests=d["saved_requests"], unchanged=d["unchanged"], downloads=d["downloads"])
+
+
+def result_to_json(result):
+    return json.dumps({
+        "ext_id": result.ext_id,
+        "new": result.new,
+        "exception": exception_to_json(result.exception),
+        "overview": request_result_to_json(result.res_overview),
+        "crx": request_result_to_json(result.res_crx),
+        "reviews": request_result_to_json(result.res_reviews),
+        "support": request_result_to_json(result.res_support),
+        "sql_exception": exception_to_json(result.res_sql),
+        "sql_update": result.sql_update,
+        "worker_exception": exception_to_json(result.worker_exception)})
+
+
+def result_from_json(line):
+    d = json.loads(line)
+    return UpdateResult(d["ext_id"], d["new"], exception_from_json(d["exception"]),
+                        request_result_from_json(d["overview"]), request_result_from_json(d["crx"]),
+                        request_result_from_json(d["reviews"]), request_result_from_json(d["support"]),
+                        exception_from_json(d["sql_exception"]), d["sql_update"],
+                        exception_from_json(d["worker_exception"]))
+
+
+def iter_journal(path):
+    """The UpdateResults in the journal path. A line that was not completely
+       written, when the crawler died, is skipped."""
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        for line in f:
+            try:
+                yield result_from_json(line)
+            except (ValueError, KeyError):
+                log_warning("Skipping incomplete line of journal {}".format(path))
+
+
+def rotate_journal(path):
+    """Rename the journal path to the first free path.N (before its
+       extension), so that a new crawl does not overwrite it."""
+    base, ext = os.path.splitext(path)
+    n = 1
+    while os.path.exists("{}.{}{}".format(base, n, ext)):
+        n += 1
+    rotated = "{}.{}{}".format(base, n, ext)
+    os.rename(path, rotated)
+    return rotated
+
+
+class CrawlJournal:
+    """Append-only journal of the UpdateResults of a crawl, one json line
+       per extension, written (and synced) as soon as an extension update
+       is completed. When resuming, the journal of the crawl that died is
+       continued; otherwise, an existing journal is rotated (see
+       rotate_journal)."""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.completed = {result.ext_id for result in iter_journal(path)} if resume else set()
+        if resume:
+            log_info("Resuming crawl: {} extensions already updated according to {}".format(
+                len(self.completed), path))
+        elif os.path.exists(path) and os.path.getsize(path) > 0:
+            log_warning("Not resuming crawl: keeping journal {} as {}".format(path, rotate_journal(path)))
+        self.file = open(path, 'a' if resume else 'w')
+        if resume and self.file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # Terminate the line that was not completely written
+                    self.file.write("\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, result):
+        self.file.write(result_to_json(result) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def completed_results(self):
+        """The UpdateResults of the crawl that is resumed."""
+        if not self.completed:
+            return
+        for result in iter_journal(self.path):
+            if result.ext_id in self.completed:
+                yield result
@@ -23,6 +23,7 @@ import re
 import json
 import zlib
 from enum import Enum
+from functools import lru_cache
 from ExtensionCrawler.js_mincer import mince_js
 from ExtensionCrawler.file_identifiers import get_file_identifiers, is_binary_resource
 from ExtensionCrawler.dbbackend.mysql_backend import MysqlBackend
@@ -73,8 +74,10 @@ class FileClassification(Enum):
     ERROR = "error"
 
 
+@lru_cache(maxsize=None)
 def load_lib_identifiers():
-    """Initialize identifiers for known libraries from JSON file."""
+    """Initialize identifiers for known libraries from JSON file (read
+    once per process, the result must not be modified)."""
     regex_file = os.path.join(
         os.path.dirname(os.path.realpath(__file__)), '../resources/',
         'js_identifier.json')
@@ -92,6 +95,7 @@ def is_ressource(file_info):
     return False
 
 
+@lru_cache(maxsize=None)
 def unknown_filename_identifier():
     """Identifier for extracting version information from unknown/generic file names."""
     return re.compile(
@@ -99,6 +103,7 @@ def unknown_filename_identifier():
         re.IGNORECASE)
 
 
+@lru_cache(maxsize=None)
 def unknown_lib_identifiers():
     """List of identifiers for generic library version headers."""
     return ([
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for coordinating several crawler nodes sharing one
+   archive: a node only updates the extensions of the ranges of archive
+   prefixes (see get_local_archive_dir) it holds a lease for. Leases are
+   files in a directory on the shared file system, which are renewed while
+   the node is alive, and taken over by other nodes when they expired."""
+
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+from ExtensionCrawler.config import const_lease_duration, const_lease_grace, const_lease_prefix_length
+from ExtensionCrawler.util import log_info, log_warning
+
+
+class LeaseError(Exception):
+    """The lease for the range of an extension is not held (any more)."""
+    pass
+
+
+def all_ranges():
+    """All ranges, i.e., prefixes of extension ids (a-p) of length
+       const_lease_prefix_length()."""
+    return ["".join(chars) for chars in itertools.product("abcdefghijklmnop", repeat=const_lease_prefix_length())]
+
+
+def range_of(ext_id):
+    return ext_id[:const_lease_prefix_length()]
+
+
+class LeaseManager:
+    """The leases of one node. Creating a lease file (with O_EXCL) is
+       atomic; an expired lease is taken over by renaming it away first,
+       which only one node succeeds in. While the node is crawling (within
+       the context), a thread renews its leases."""
+
+    def __init__(self, lease_dir, node, duration=None):
+        self.lease_dir = lease_dir
+        self.node = node
+        self.duration = duration if duration is not None else const_lease_duration()
+        self.held = {}
+        os.makedirs(lease_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __getstate__(self):
+        # Worker processes only check leases
+        state = self.__dict__.copy()
+        state["held"] = {}
+        state["_lock"] = None
+        state["_stop"] = None
+        state["_thread"] = None
+        return state
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._renew_periodically, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        for prefix_range in list(self.held):
+            self.release(prefix_range)
+
+    def _path(self, prefix_range):
+        return os.path.join(self.lease_dir, prefix_range + ".lease")
+
+    def _done_path(self, prefix_range, date):
+        return os.path.join(self.lease_dir, date, prefix_range + ".done")
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, path, lease):
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as f:
+            json.dump(lease, f)
+        os.replace(tmp_path, path)
+
+    def _new_lease(self):
+        return {"node": self.node, "token": uuid.uuid4().hex, "expires": time.time() + self.duration}
+
+    def acquire(self, prefix_range):
+        """Try to get the lease for prefix_range."""
+        path = self._path(prefix_range)
+        lease = self._read(path)
+        if lease is not None:
+            if lease["expires"] + const_lease_grace() > time.time():
+                return False
+            # Take over the expired lease, unless another node is faster
+            tomb = "{}.{}.expired".format(path, uuid.uuid4().hex)
+            try:
+                os.rename(path, tomb)
+            except FileNotFoundError:
+                return False
+            if self._read(tomb) != lease:
+                # Renamed a lease that was taken over in the meantime: put
+                # it back (unless yet another node created one)
+                try:
+                    os.link(tomb, path)
+                except FileExistsError:
+                    pass
+                os.remove(tomb)
+                return False
+            os.remove(tomb)
+            log_warning("Taking over expired lease of {} from {}".format(prefix_range, lease["node"]))
+        lease = self._new_lease()
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump(lease, f)
+        with self._lock:
+            self.held[prefix_range] = lease
+        return True
+
+    def renew(self):
+        """Extend all held leases; leases that were lost (e.g., as the node
+           did not renew them in time) are dropped."""
+        with self._lock:
+            for prefix_range, lease in list(self.held.items()):
+                path = self._path(prefix_range)
+                if self._read(path) != lease:
+                    log_warning("Lost lease of {}".format(prefix_range))
+                    del self.held[prefix_range]
+                    continue
+                lease = dict(lease, expires=time.time() + self.duration)
+                self._write(path, lease)
+                self.held[prefix_range] = lease
+
+    def _renew_periodically(self):
+        while not self._stop.wait(self.duration / 3):
+            try:
+                self.renew()
+            except Exception as e:
+                log_warning("Exception when renewing leases: {}".format(e))
+
+    def release(self, prefix_range):
+        with self._lock:
+            lease = self.held.pop(prefix_range, None)
+            if lease is not None and self._read(self._path(prefix_range)) == lease:
+                os.remove(self._path(prefix_range))
+
+    def has(self, prefix_range):
+        """Whether this node (still) holds the lease for prefix_range."""
+        with self._lock:
+            return prefix_range in self.held
+
+    def holds(self, ext_id):
+        """Whether this node holds a valid lease for the range of ext_id
+           (checked against the lease file, as the node might have lost
+           it)."""
+        lease = self._read(self._path(range_of(ext_id)))
+        return lease is not None and lease["node"] == self.node and lease["expires"] > time.time()
+
+    def mark_done(self, prefix_range, date):
+        os.makedirs(os.path.join(self.lease_dir, date), exist_ok=True)
+        with open(self._done_path(prefix_range, date), 'w') as f:
+            f.write(self.node + "\n")
+
+    def next_range(self, date):
+        """Lease a range that is not crawled yet on date, waiting for ranges
+           leased by other nodes to be done (or their leases to expire).
+           None if all ranges are done, or still held by this node."""
+        while True:
+            with self._lock:
+                held = set(self.held)
+            pending = [prefix_range for prefix_range in all_ranges()
+                       if prefix_range not in held and not os.path.exists(self._done_path(prefix_range, date))]
+            if not pending:
+                return None
+            random.shuffle(pending)
+            for prefix_range in pending:
+                if self.acquire(prefix_range):
+                    if os.path.exists(self._done_path(prefix_range, date)):
+                        # Completed by another node in the meantime
+                        self.release(prefix_range)
+                        continue
+                    log_info("Leased range {} ({} ranges left)".format(prefix_range, len(pending) - 1))
+                    return prefix_range
+            log_info("Waiting for {} ranges leased by other nodes".format(len(pending)))
+            time.sleep(self.duration / 3)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for crawling as one of several nodes sharing an archive:
+   one crawl engine keeps running (with its processes, connections, and
+   rate limits), and is fed the extensions of the ranges the node leases
+   (see lease.LeaseManager), range by range."""
+
+import threading
+
+from ExtensionCrawler.lease import range_of
+from ExtensionCrawler.util import log_info, log_warning, log_exception
+
+
+class LeasedFeed:
+    """Feed (see UpdateQueue) of the crawl engine of a node. Ranges not
+       crawled yet on date are leased one at a time, and their extensions
+       (of ext_ids and forum_ext_ids, and the ones of discovered_ids read so
+       far) are fed at most max_in_flight ahead of their results. A range is
+       marked done and released once the results of all its extensions
+       arrived. Extensions discovered after their range was crawled by this
+       node are fed under a new lease of the range when all ranges are
+       done; the ones of ranges crawled by other nodes are left to them."""
+
+    def __init__(self, leases, date, ext_ids, forum_ext_ids, max_in_flight, on_result, discovered_ids=None,
+                 check_versions=None):
+        self.leases = leases
+        self.date = date
+        self.max_in_flight = max_in_flight
+        self.on_result = on_result
+        # Function returning the crx versions of ext_ids
+        self.check_versions = check_versions
+        # Passed to the crawl engine, and updated for every range
+        self.crx_versions = {}
+        # Range -> (ext_id, forums) pairs not fed yet
+        self.tups = {}
+        for ext_id in set(forum_ext_ids):
+            self.tups.setdefault(range_of(ext_id), []).append((ext_id, True))
+        for ext_id in set(ext_ids) - set(forum_ext_ids):
+            self.tups.setdefault(range_of(ext_id), []).append((ext_id, False))
+        # Range -> discovered ids not fed yet
+        self.discovered = {}
+        self.discovering = discovered_ids is not None
+        # Ranges fed by this node, and the number of their extensions fed
+        # without result
+        self.crawled = set()
+        self.pending = {}
+        self.feeding = None
+        self.in_flight = 0
+        self.lock = threading.Condition()
+        if discovered_ids is not None:
+            threading.Thread(target=self._discover, args=(discovered_ids,), daemon=True).start()
+
+    def _discover(self, discovered_ids):
+        try:
+            for ext_id in discovered_ids:
+                with self.lock:
+                    self.discovered.setdefault(range_of(ext_id), []).append(ext_id)
+        except Exception:
+            log_exception("Exception when reading new extension ids")
+        finally:
+            with self.lock:
+                self.discovering = False
+                self.lock.notify_all()
+
+    def _wait_for_slot(self):
+        with self.lock:
+            while self.in_flight >= self.max_in_flight:
+                self.lock.wait(1)
+
+    def _complete(self, prefix_range):
+        """Mark prefix_range done and release it, if all its extensions are
+           fed and their results arrived (called with the lock held)."""
+        if self.feeding == prefix_range or self.pending.get(prefix_range, 0) > 0:
+            return
+        self.pending.pop(prefix_range, None)
+        self.leases.renew()
+        if self.leases.has(prefix_range):
+            self.leases.mark_done(prefix_range, self.date)
+            self.leases.release(prefix_range)
+        else:
+            log_warning("Lost lease of range {} while crawling it".format(prefix_range))
+
+    def _feed_range(self, prefix_range):
+        with self.lock:
+            tups = self.tups.pop(prefix_range, []) + [(ext_id, False)
+                                                      for ext_id in self.discovered.pop(prefix_range, [])]
+            self.crawled.add(prefix_range)
+            self.pending[prefix_range] = self.pending.get(prefix_range, 0) + len(tups)
+            self.feeding = prefix_range
+        log_info("Feeding {} extensions of range {}".format(len(tups), prefix_range))
+        if self.check_versions is not None and tups:
+            self.crx_versions.update(self.check_versions([ext_id for ext_id, _ in tups]))
+        for tup in tups:
+            self._wait_for_slot()
+            with self.lock:
+                self.in_flight += 1
+            yield tup
+        with self.lock:
+            self.feeding = None
+            self._complete(prefix_range)
+
+    def feed(self):
+        """The (ext_id, forums) pairs to update, until all ranges are
+           done."""
+        while True:
+            self._wait_for_slot()
+            prefix_range = self.leases.next_range(self.date)
+            if prefix_range is None:
+                break
+            yield from self._feed_range(prefix_range)
+
+        with self.lock:
+            while self.discovering:
+                self.lock.wait(1)
+            late = sorted(prefix_range for prefix_range in self.discovered if prefix_range in self.crawled)
+        for prefix_range in late:
+            if not self.leases.acquire(prefix_range):
+                log_warning("Cannot lease range {} again for {} extensions discovered after it was crawled".format(
+                    prefix_range, len(self.discovered[prefix_range])))
+                continue
+            yield from self._feed_range(prefix_range)
+
+    def finished(self, result):
+        """The UpdateResult of a fed extension (on_result of the engine)."""
+        with self.lock:
+            self.in_flight -= 1
+            self.crx_versions.pop(result.ext_id, None)
+            self.on_result(result)
+            prefix_range = range_of(result.ext_id)
+            self.pending[prefix_range] -= 1
+            self._complete(prefix_range)
+            self.lock.notify_all()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""
+Pipelined crawl engine: one pool of processes downloads the extensions into
+memory (see tar_staging.TarStaging, which spills large downloads to
+temporary files), and a separately sized pool appends them to the tar
+archives (and updates the database), so that slow disks do not hold
+network slots and slow responses do not hold disk bandwidth. At most
+const_pipeline_backlog() downloaded extensions wait between both stages.
+"""
+
+import datetime
+import time
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from pebble import ProcessPool
+
+from ExtensionCrawler.archive import (UpdateResult, UpdateQueue, create_staging, fetch_extension,
+                                      store_extension, get_update_tups, init_process, update_result)
+from ExtensionCrawler.autoscale import ConcurrencyController
+from ExtensionCrawler.config import (const_mysql_config_file, const_rate_log_interval,
+                                     const_pipeline_store_workers, const_pipeline_backlog,
+                                     const_min_parallel_downloads)
+from ExtensionCrawler.dbbackend.mysql_process import MysqlProcessBackend
+from ExtensionCrawler.request_manager import RequestManager
+from ExtensionCrawler.reply_search import ReplySearchBatcher
+from ExtensionCrawler.session_manager import SessionManager
+from ExtensionCrawler.util import log_info, log_exception, set_logger_tag
+
+
+class StagedUpdate:
+    """An extension downloaded into staging (see tar_staging.TarStaging,
+       passed from the fetch to the store process with the contents kept in
+       memory), waiting to be stored."""
+
+    def __init__(self, ext_id, date, staging, res_overview, res_crx, res_reviews, res_support, fetch_time):
+        self.ext_id = ext_id
+        self.date = date
+        self.staging = staging
+        self.res_overview = res_overview
+        self.res_crx = res_crx
+        self.res_reviews = res_reviews
+        self.res_support = res_support
+        self.fetch_time = fetch_time
+
+    def has_exception(self):
+        return any(res is not None and res.exception is not None
+                   for res in [self.res_overview, self.res_crx, self.res_reviews, self.res_support])
+
+
+class StageStats:
+    """Throughput and backlog of one stage of the pipeline."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.completed = 0
+        self.busy_time = 0.0
+        self.max_backlog = 0
+
+    def add(self, duration):
+        self.completed += 1
+        self.busy_time += duration
+
+    def waiting(self, backlog):
+        self.max_backlog = max(self.max_backlog, backlog)
+
+    def summary(self, in_flight, backlog):
+        elapsed = time.time() - self.start
+        return "{}: {} done ({:.2f}/s, {:.2f}s each on average), {} in flight, backlog {} (max. {})".format(
+            self.name, self.completed, self.completed / elapsed if elapsed > 0 else 0.0,
+            self.busy_time / self.completed if self.completed else 0.0, in_flight, backlog, self.max_backlog)
+
+
+def fetch_stage(tup):
+    archivedir, ext_id, forums, crx_version, phases, date = tup
+    set_logger_tag(ext_id)
+    log_info("Updating extension {}{}".format(" (including forums)" if forums else "",
+                                              " (retrying {})".format(", ".join(sorted(phases))) if phases else ""),
+             1)
+    start = time.time()
+
+    try:
+        staging = create_staging(archivedir, ext_id)
+    except Exception as e:
+        log_exception("* FATAL: cannot create archive directory", 3)
+        return UpdateResult(ext_id, False, e, None, None, None,
+                            None, None, False)
+
+    res_overview, res_crx, res_reviews, res_support = fetch_extension(
+        archivedir, staging, date, ext_id, forums, crx_version, phases)
+    return StagedUpdate(ext_id, date, staging, res_overview, res_crx, res_reviews, res_support, time.time() - start)
+
+
+def store_stage(tup):
+    archivedir, con, staged = tup
+    start = time.time()
+    is_new, tar_exception, sql_exception, sql_success = store_extension(
+        archivedir, con, staged.ext_id, staged.date, staged.staging)
+    log_info("* Duration: {} (download), {} (store)".format(
+        datetime.timedelta(seconds=int(staged.fetch_time)), datetime.timedelta(seconds=int(time.time() - start))),
+             2)
+    return UpdateResult(staged.ext_id, is_new, tar_exception, staged.res_overview, staged.res_crx,
+                        staged.res_reviews, staged.res_support, sql_exception, sql_success), time.time() - start
+
+
+def update_extensions_pipelined(archivedir, parallel, forums_ext_ids, ext_ids, timeout, verbose, start_pystuck,
+                                crx_versions=None, egresses=None, new_ext_ids=None, on_result=None,
+                                leases=None, feed=None, max_parallel=None, store_workers=None, rm=None):
+    """Drop-in replacement for archive.update_extensions, where parallel is
+       the number of processes downloading extensions and store_workers the
+       number of processes appending them to the archives. The timeout
+       applies to the download, and max_parallel (if given) bounds the
+       number of downloads adjusted at runtime."""
+    if crx_versions is None:
+        crx_versions = {}
+    if store_workers is None:
+        store_workers = const_pipeline_store_workers()
+    backlog = const_pipeline_backlog()
+    tups = get_update_tups(forums_ext_ids, ext_ids)
+    update_queue = UpdateQueue(tups, new_ext_ids, feed)
+    max_workers = max(parallel, max_parallel) if max_parallel is not None else parallel
+    fetch_stats = StageStats("download")
+    store_stats = StageStats("store")
+
+    def finish(result, forums):
+        result = update_queue.finish(result, forums)
+        if result is None:
+            return
+        if on_result is not None:
+            on_result(result)
+        else:
+            results.append(result)
+
+    with MysqlProcessBackend(
+            None,
+            read_default_file=const_mysql_config_file(),
+            charset='utf8mb4') as con:
+        results = []
+        if rm is None:
+            rm = RequestManager(max_workers, egresses=egresses)
+        sm = SessionManager(egresses=egresses)
+        concurrency = None
+        if max_parallel is not None:
+            concurrency = ConcurrencyController(parallel, min(const_min_parallel_downloads(), max_parallel),
+                                                max_parallel, rm)
+        last_rate_log = time.time()
+        with ReplySearchBatcher(rm, sm) as rs, \
+                ProcessPool(max_workers=max_workers, initializer=init_process,
+                            initargs=(verbose, start_pystuck, rm, sm, rs, leases)) as fetch_pool, \
+                ProcessPool(max_workers=store_workers, initializer=init_process,
+                            initargs=(verbose, start_pystuck, rm, sm, rs, leases)) as store_pool:
+            fetching = {}
+            staged = deque()
+            storing = {}
+            while fetching or staged or storing or not update_queue.done():
+                # Downloads pause while the backlog of the store stage is full
+                downloads = concurrency.limit if concurrency is not None else parallel
+                while len(fetching) < downloads and len(fetching) + len(staged) < backlog:
+                    tup = update_queue.get(block=not (fetching or staged or storing))
+                    if tup is None:
+                        break
+                    ext_id, forums, phases, date = tup
+                    future = fetch_pool.schedule(fetch_stage,
+                                                 args=[(archivedir, ext_id, forums, crx_versions.get(ext_id),
+                                                        phases, date)],
+                                                 timeout=timeout)
+                    fetching[future] = (ext_id, forums, time.time())
+                while staged and len(storing) < store_workers:
+                    staged_update, forums = staged.popleft()
+                    future = store_pool.schedule(store_stage, args=[(archivedir, con, staged_update)])
+                    storing[future] = (staged_update.ext_id, forums)
+                fetch_stats.waiting(update_queue.pending())
+                store_stats.waiting(len(staged))
+                if time.time() - last_rate_log > const_rate_log_interval():
+                    log_info("Request rates: {}".format(rm.rates_summary()))
+                    log_info("Pipeline {}".format(fetch_stats.summary(len(fetching), update_queue.pending())))
+                    log_info("Pipeline {}".format(store_stats.summary(len(storing), len(staged))))
+                    last_rate_log = time.time()
+                if concurrency is not None:
+                    concurrency.update(len(fetching))
+                done, _ = wait(list(fetching) + list(storing), timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in fetching:
+                        ext_id, forums, start = fetching.pop(future)
+                        staged_update = update_result(future, ext_id)
+                        if concurrency is not None:
+                            concurrency.finished(time.time() - start, not isinstance(staged_update, StagedUpdate)
+                                                 or staged_update.has_exception())
+                        if isinstance(staged_update, StagedUpdate):
+                            fetch_stats.add(staged_update.fetch_time)
+                            staged.append((staged_update, forums))
+                        else:
+                            finish(staged_update, forums)
+                    else:
+                        ext_id, forums = storing.pop(future)
+                        result = update_result(future, ext_id)
+                        if isinstance(result, tuple):
+                            result, store_time = result
+                            store_stats.add(store_time)
+                        finish(result, forums)
+
+    log_info("Connection reuse: {}".format(sm.stats_summary()))
+    log_info("Request rates: {}".format(rm.rates_summary()))
+    for lane_summary in rm.lanes_summary():
+        log_info("Request lane {}".format(lane_summary))
+    log_info("Reply searches: {}".format(rs.stats_summary()))
+    log_info("Retries: {}".format(update_queue.retries_summary()))
+    log_info("Pipeline {}".format(fetch_stats.summary(0, 0)))
+    log_info("Pipeline {}".format(store_stats.summary(0, 0)))
+    if concurrency is not None:
+        log_info("Concurrency: {}".format(concurrency.summary()))
+    if new_ext_ids is not None:
+        log_info("Updated {} new extensions".format(update_queue.num_new))
+    return results
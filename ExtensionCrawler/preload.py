@@ -0,0 +1,115 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for preloading the modules and data used by worker
+   processes once, in the process they are forked from (the forkserver, or
+   the main process when forking directly), instead of in every worker."""
+
+import gc
+import importlib
+import multiprocessing
+import os
+import time
+
+from ExtensionCrawler.util import log_info, log_warning
+
+PRELOAD_MODULES = [
+    "bs4", "magic", "cchardet", "simhash", "MySQLdb", "Cryptodome.PublicKey.RSA", "dateutil.parser",
+    "ExtensionCrawler.archive", "ExtensionCrawler.db", "ExtensionCrawler.crx", "ExtensionCrawler.js_decomposer",
+    "ExtensionCrawler.file_identifiers", "ExtensionCrawler.dbbackend.mysql_backend"
+]
+
+
+def preload():
+    """Import PRELOAD_MODULES, load the library identifiers (and compile
+       their regexes) and the magic database, and move all objects to the
+       permanent generation of the garbage collector (gc.freeze), so that
+       collections in forked workers do not write to (and copy) the pages
+       they share. Modules that cannot be imported are skipped (the workers
+       fail on them as they would without preloading). Returns the time it
+       took."""
+    start = time.time()
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            log_warning("Cannot preload module {}: {}".format(module, e))
+
+    try:
+        import magic
+        from ExtensionCrawler.js_decomposer import (load_lib_identifiers, unknown_filename_identifier,
+                                                    unknown_lib_identifiers)
+    except ImportError as e:
+        log_warning("Cannot preload the library identifiers and the magic database: {}".format(e))
+    else:
+        load_lib_identifiers()
+        unknown_filename_identifier()
+        unknown_lib_identifiers()
+        magic.from_buffer(b"", mime=True)
+        magic.from_buffer(b"")
+
+    gc.freeze()
+    return time.time() - start
+
+
+def use_forkserver():
+    """Start worker processes from a forkserver that preloaded (see
+       ExtensionCrawler.preloaded)."""
+    multiprocessing.set_start_method("forkserver")
+    multiprocessing.set_forkserver_preload(["ExtensionCrawler.preloaded"])
+
+
+def process_age():
+    """Seconds since this process was started (forked), or None if
+       unknown."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Field 22 (starttime, in clock ticks after boot), counting after
+            # the command name, which may contain spaces
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def memory_usage():
+    """RSS and PSS (resident memory, with shared pages divided by the
+       number of processes sharing them) of this process in bytes, each None
+       if unknown."""
+    usage = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    usage[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    return usage.get("Rss"), usage.get("Pss")
+
+
+def log_worker_startup():
+    """Log the startup time and memory usage of a worker process (in its
+       initializer)."""
+    age = process_age()
+    rss, pss = memory_usage()
+    log_info("Worker {} started in {}, RSS {}, PSS {}".format(
+        os.getpid(), "{:.2f}s".format(age) if age is not None else "unknown",
+        "{:.1f} MiB".format(rss / 2**20) if rss is not None else "unknown",
+        "{:.1f} MiB".format(pss / 2**20) if pss is not None else "unknown"))
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for the registry of the archived extensions (sqlite
+   databases in the archive directory), which is much faster to read than
+   scanning the archive directory. Crawler nodes sharing the archive (e.g.,
+   on NFS, where the locking of sqlite is not reliable) each write a
+   registry of their own, and readers merge all registries."""
+
+import datetime
+import glob
+import os
+import re
+import sqlite3
+import time
+from collections import Counter
+
+from ExtensionCrawler.config import get_local_archive_dir
+from ExtensionCrawler.util import log_info, log_warning
+
+
+# Name of a generation of the tar archive of an extension, as created by
+# scripts/maintainance/maintain_archive (and compressed later)
+GENERATION = re.compile(r"^([a-p]{32})\.([0-9]{3})\.tar(\.xz)?$")
+
+
+def registry_file(archivedir, node=None):
+    """The registry written by the crawler node node, or by crawls that are
+       not run as a node."""
+    return os.path.join(archivedir, "registry.sqlite" if node is None else "registry-{}.sqlite".format(node))
+
+
+def registry_files(archivedir):
+    """All registries in archivedir."""
+    try:
+        names = os.listdir(archivedir)
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(archivedir, name) for name in names
+                  if name == "registry.sqlite" or (name.startswith("registry-") and name.endswith(".sqlite")))
+
+
+def _merge(row, other):
+    """Merge two rows (dicts) of the same extension from different
+       registries: the last crawl decides, the first crawl is the earliest
+       one, and the generations are recorded in one registry only."""
+    if (other["last_crawl"] or "") > (row["last_crawl"] or ""):
+        row, other = dict(other), row
+    else:
+        row = dict(row)
+    first_crawls = [date for date in [row["first_crawl"], other["first_crawl"]] if date is not None]
+    row["first_crawl"] = min(first_crawls) if first_crawls else None
+    row["generations"] = max(row["generations"], other["generations"])
+    return row
+
+
+def result_status(result):
+    """Short description of an UpdateResult."""
+    if result.worker_exception is not None:
+        return "worker-exception"
+    if result.corrupt_tar():
+        return "corrupt-tar"
+    if result.not_in_store():
+        return "not-in-store"
+    if result.not_authorized():
+        return "not-authorized"
+    if result.raised_google_ddos():
+        return "ddos"
+    if result.has_exception():
+        return "exception"
+    if result.is_ok():
+        return "not-modified" if result.not_modified() else "updated"
+    return "failed"
+
+
+class Registry:
+    """Extension ids with the path of their tar archive (relative to the
+       archive directory), the dates of their first and last crawl, the
+       size of the tar archive, the status of the last crawl, and the number
+       of older generations of the tar archive (see record_generations).
+       Updates are written to the registry of node (see registry_file),
+       while ids and paths are read from all registries."""
+
+    def __init__(self, archivedir, node=None):
+        self.archivedir = archivedir
+        self.path = registry_file(archivedir, node)
+        self.con = sqlite3.connect(self.path, timeout=60)
+        self.pending = []
+        self.last_flush = time.time()
+        self.con.execute("""CREATE TABLE IF NOT EXISTS extension (
+                              extid TEXT PRIMARY KEY,
+                              path TEXT NOT NULL,
+                              first_crawl TEXT,
+                              last_crawl TEXT,
+                              tar_size INTEGER,
+                              last_status TEXT,
+                              generations INTEGER NOT NULL DEFAULT 0)""")
+        columns = [row[1] for row in self.con.execute("PRAGMA table_info(extension)")]
+        if "generations" not in columns:
+            self.con.execute("ALTER TABLE extension ADD COLUMN generations INTEGER NOT NULL DEFAULT 0")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        self.con.commit()
+        self.con.close()
+
+    def _other_cons(self):
+        """Read-only connections to the registries of other nodes (or of
+           crawls not run as a node)."""
+        for path in registry_files(self.archivedir):
+            if os.path.abspath(path) == os.path.abspath(self.path):
+                continue
+            try:
+                con = sqlite3.connect("file:{}?mode=ro".format(path), uri=True, timeout=60)
+            except sqlite3.Error as e:
+                log_warning("Cannot read registry {}: {}".format(path, e))
+                continue
+            try:
+                yield path, con
+            finally:
+                con.close()
+
+    def rows(self, pattern="*"):
+        """The rows (dicts) of the extensions whose id matches the glob
+           pattern, merged from all registries."""
+        query = ("SELECT extid, path, first_crawl, last_crawl, tar_size, last_status, generations "
+                 "FROM extension WHERE extid GLOB ?")
+        rows = {}
+
+        def add(cursor):
+            names = [column[0] for column in cursor.description]
+            for values in cursor:
+                row = dict(zip(names, values))
+                rows[row["extid"]] = _merge(rows[row["extid"]], row) if row["extid"] in rows else row
+
+        add(self.con.execute(query, (pattern,)))
+        for path, con in self._other_cons():
+            try:
+                add(con.execute(query, (pattern,)))
+            except sqlite3.Error as e:
+                log_warning("Cannot read registry {}: {}".format(path, e))
+        return rows
+
+    def is_empty(self):
+        return not self.rows()
+
+    def ids(self):
+        return list(self.rows())
+
+    def paths(self, pattern="*"):
+        """Paths of the tar archives of the extensions whose id matches the
+           glob pattern, each preceded by its recorded .NNN.tar.xz
+           generations (without accessing the archive directory)."""
+        paths = []
+        rows = self.rows(pattern)
+        for ext_id in sorted(rows):
+            path = os.path.join(self.archivedir, rows[ext_id]["path"])
+            paths += ["{}.{:03d}.tar.xz".format(path[:-len(".tar")], i) for i in range(rows[ext_id]["generations"])]
+            paths += [path]
+        return paths
+
+    def _update(self, ext_id, crawl_date, status):
+        path = os.path.join(get_local_archive_dir(ext_id), ext_id + ".tar")
+        tar_size = os.path.getsize(os.path.join(self.archivedir, path))
+        self.con.execute("INSERT OR IGNORE INTO extension (extid, path, first_crawl) VALUES (?, ?, ?)",
+                         (ext_id, path, crawl_date))
+        self.con.execute("UPDATE extension SET path = ?, last_crawl = ?, tar_size = ?, last_status = ? "
+                         "WHERE extid = ?", (path, crawl_date, tar_size, status, ext_id))
+
+    def flush(self):
+        """Write the pending updates in one transaction, so that crawler
+           nodes sharing the archive only hold the lock of the registry
+           briefly."""
+        if self.pending:
+            with self.con:
+                for ext_id, crawl_date, status in self.pending:
+                    self._update(ext_id, crawl_date, status)
+            self.pending = []
+        self.last_flush = time.time()
+
+    def add(self, result, crawl_date):
+        """Add the UpdateResult of a crawl (written every few seconds and
+           when closing)."""
+        if os.path.exists(os.path.join(self.archivedir, get_local_archive_dir(result.ext_id),
+                                       result.ext_id + ".tar")):
+            self.pending.append((result.ext_id, crawl_date, result_status(result)))
+        if len(self.pending) >= 1000 or time.time() - self.last_flush > 5:
+            self.flush()
+
+    def record(self, results, crawl_date):
+        """Add the UpdateResults of a crawl."""
+        for result in results:
+            self.add(result, crawl_date)
+        self.flush()
+
+    def rebuild(self, merge=False):
+        """Rebuild the registry from the tar archives in the archive
+           directory, keeping the dates and status known for them (in any
+           registry). The last crawl of newly found archives is the time of
+           their last modification. If merge is set, the other registries
+           are merged into this one, and removed (which must only be done
+           while no crawler is running)."""
+        byte = '[0-9a-z][0-9a-z][0-9a-z][0-9a-z][0-9a-z][0-9a-z][0-9a-z][0-9a-z]'
+        word = byte + byte + byte + byte
+        ext_ids = set(map(lambda d: re.sub(".tar$", "", re.sub(r"^.*\/", "", d)),
+                          glob.glob(os.path.join(self.archivedir, "*", word + ".tar"))))
+        known = self.rows()
+        self.con.execute("DELETE FROM extension")
+        for ext_id in ext_ids & set(known):
+            row = known[ext_id]
+            self.con.execute("INSERT INTO extension (extid, path, first_crawl, last_crawl, tar_size, last_status) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", (ext_id, row["path"], row["first_crawl"],
+                                                           row["last_crawl"], row["tar_size"], row["last_status"]))
+        for ext_id in ext_ids:
+            path = os.path.join(get_local_archive_dir(ext_id), ext_id + ".tar")
+            mtime = datetime.datetime.fromtimestamp(
+                os.path.getmtime(os.path.join(self.archivedir, path)), datetime.timezone.utc).isoformat()
+            self.con.execute("INSERT OR IGNORE INTO extension (extid, path, last_crawl) VALUES (?, ?, ?)",
+                             (ext_id, path, mtime))
+            self.con.execute("UPDATE extension SET path = ?, tar_size = ? WHERE extid = ?",
+                             (path, os.path.getsize(os.path.join(self.archivedir, path)), ext_id))
+        self.con.commit()
+        log_info("Rebuilt registry of {} extensions".format(len(ext_ids)))
+        self.record_generations()
+        if merge:
+            for path in registry_files(self.archivedir):
+                if os.path.abspath(path) != os.path.abspath(self.path):
+                    os.remove(path)
+                    log_info("Merged registry {}".format(path))
+
+    def record_generations(self):
+        """Record the number of generations (.NNN.tar, or .NNN.tar.xz once
+           compressed) of the tar archives, by scanning the archive
+           directory once, e.g., after maintain_archive moved the tar
+           archives to their next generation."""
+        generations = Counter()
+        for path in glob.glob(os.path.join(self.archivedir, "*", "*.[0-9][0-9][0-9].tar*")):
+            match = GENERATION.match(os.path.basename(path))
+            if match:
+                generations[match.group(1)] = max(generations[match.group(1)], int(match.group(2)) + 1)
+        with self.con:
+            self.con.execute("UPDATE extension SET generations = 0")
+            self.con.executemany("UPDATE extension SET generations = ? WHERE extid = ?",
+                                 [(n, ext_id) for ext_id, n in generations.items()])
+        log_info("Recorded generations of {} extensions".format(len(generations)))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for batching the searches for the replies to reviews and
+   support requests into combined requests."""
+
+import json
+import queue
+import threading
+import time
+import uuid
+from multiprocessing import Lock, Manager, Value
+
+from ExtensionCrawler.config import (const_review_search_url, const_review_search_payload,
+                                     const_review_search_batch_size, const_review_search_batch_delay,
+                                     const_review_search_wait)
+from ExtensionCrawler.util import log_info, log_exception
+
+
+class SearchReply:
+    """The part of a combined search response that belongs to one search,
+       used in place of the response of a single search request."""
+
+    def __init__(self, status_code, text, headers, url):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+        self.url = url
+
+
+class ReplySearchBatcher:
+    """Combines the reply searches of many extensions into few search
+       requests: workers (processes or threads) submit the search specs of
+       one extension and wait, while a thread of the main process sends the
+       combined requests and hands each worker its part of the results."""
+
+    def __init__(self, request_manager, session_manager, batch_size=None, delay=None):
+        self.request_manager = request_manager
+        self.session_manager = session_manager
+        self.batch_size = batch_size if batch_size is not None else const_review_search_batch_size()
+        self.delay = delay if delay is not None else const_review_search_batch_delay()
+        self.manager = Manager()
+        self.submitted = self.manager.Queue()
+        self.replies = self.manager.dict()
+        self.cond = self.manager.Condition()
+        self.lock = Lock()
+        self.num_searches = Value('l', 0, lock=False)
+        self.num_specs = Value('l', 0, lock=False)
+        self.num_requests = Value('l', 0, lock=False)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["manager"] = None
+        state["_stop"] = None
+        state["_thread"] = None
+        return state
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.manager.shutdown()
+
+    def search(self, specs):
+        """Search results for specs, or None if the combined search failed
+           and the caller needs to search on its own."""
+        token = uuid.uuid4().hex
+        self.submitted.put((token, specs))
+        deadline = time.time() + self.delay + const_review_search_wait()
+        with self.cond:
+            while token not in self.replies:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            reply = self.replies.pop(token)
+        return SearchReply(*reply) if reply is not None else None
+
+    def _run(self):
+        pending = []
+        first = None
+        while True:
+            try:
+                token, specs = self.submitted.get(timeout=0.5)
+                if not pending:
+                    first = time.time()
+                pending.append((token, specs))
+            except queue.Empty:
+                if self._stop.is_set():
+                    break
+            if pending and (sum(len(specs) for _, specs in pending) >= self.batch_size
+                            or time.time() - first >= self.delay):
+                self._send_all(pending)
+                pending = []
+        if pending:
+            self._send_all(pending)
+
+    def _send_all(self, pending):
+        batch = []
+        num_specs = 0
+        for token, specs in pending:
+            if batch and num_specs + len(specs) > self.batch_size:
+                self._send(batch)
+                batch = []
+                num_specs = 0
+            batch.append((token, specs))
+            num_specs += len(specs)
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch):
+        all_specs = [spec for _, specs in batch for spec in specs]
+        replies = [None] * len(batch)
+        try:
+            with self.request_manager.restricted_request("reviews") as egress:
+                res = self.session_manager.post(
+                    const_review_search_url(),
+                    egress=egress,
+                    data=const_review_search_payload(all_specs),
+                    timeout=10)
+                self.request_manager.report("reviews", res.status_code, egress)
+            self.session_manager.update_stats()
+            log_info("* Searched replies of {} extensions ({} specs): {}".format(
+                len(batch), len(all_specs), res.status_code), 1)
+            if res.status_code != 200:
+                # Every search would have been answered the same way
+                replies = [(res.status_code, res.text, str(res.headers), res.url)] * len(batch)
+            else:
+                doc = res.json()
+                results = doc["searchResults"]
+                if len(results) != len(all_specs):
+                    raise ValueError("{} search results for {} specs".format(len(results), len(all_specs)))
+                offset = 0
+                for i, (_, specs) in enumerate(batch):
+                    part = dict(doc)
+                    part["searchResults"] = results[offset:offset + len(specs)]
+                    replies[i] = (res.status_code, json.dumps(part), str(res.headers), res.url)
+                    offset += len(specs)
+        except Exception:
+            log_exception("Exception when searching replies of {} extensions".format(len(batch)), 1)
+            replies = [None] * len(batch)
+
+        with self.lock:
+            self.num_searches.value += len(batch)
+            self.num_specs.value += len(all_specs)
+            self.num_requests.value += 1
+        with self.cond:
+            for (token, _), reply in zip(batch, replies):
+                self.replies[token] = reply
+            self.cond.notify_all()
+
+    def stats_summary(self):
+        with self.lock:
+            return "{} searches ({} specs) in {} requests".format(
+                self.num_searches.value, self.num_specs.value, self.num_requests.value)
@@ -1,42 +1,194 @@
 import time
-import random
 from contextlib import contextmanager
 from multiprocessing import Lock, BoundedSemaphore, Value
 
+from ExtensionCrawler.config import (const_rate_limits, const_rate_increase, const_rate_decrease,
+                                     const_rate_decrease_cooldown, const_restricted_lane_slots)
+from ExtensionCrawler.util import log_warning
 
-class RequestManager:
-    def __init__(self, max_workers):
-        self.max_workers = max_workers
+
+class TokenBucket:
+    """Token bucket shared between processes, whose rate is adjusted with
+       additive increase and multiplicative decrease (AIMD)."""
+
+    def __init__(self, rate, min_rate, max_rate, burst):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.lock = Lock()
+        self.rate = Value('d', rate, lock=False)
+        self.tokens = Value('d', burst, lock=False)
+        self.last_refill = Value('d', time.time(), lock=False)
+        self.last_decrease = Value('d', 0.0, lock=False)
+
+    def acquire(self):
+        """Take a token, waiting until it is available. Tokens are
+           reserved, i.e., waiting requests are served in order."""
+        with self.lock:
+            now = time.time()
+            tokens = min(self.burst, self.tokens.value + (now - self.last_refill.value) * self.rate.value) - 1
+            self.tokens.value = tokens
+            self.last_refill.value = now
+            wait = -tokens / self.rate.value if tokens < 0 else 0.0
+        time.sleep(wait)
+
+    def increase(self, step):
+        """Increase the rate by step per second of healthy responses."""
+        with self.lock:
+            self.rate.value = min(self.max_rate, self.rate.value + step / self.rate.value)
+
+    def decrease(self, factor, cooldown):
+        """Decrease the rate by factor, at most once per cooldown seconds,
+           as responses to requests sent before the last decrease are
+           still arriving."""
+        with self.lock:
+            now = time.time()
+            if now - self.last_decrease.value < cooldown:
+                return False
+            self.last_decrease.value = now
+            self.rate.value = max(self.min_rate, self.rate.value * factor)
+            self.tokens.value = min(self.tokens.value, 0.0)
+            return True
+
+    def delay(self):
+        """Seconds until a token is available; negative if tokens are
+           spare, the more the longer the bucket has been idle."""
+        with self.lock:
+            tokens = min(self.burst,
+                         self.tokens.value + (time.time() - self.last_refill.value) * self.rate.value)
+            return (1 - tokens) / self.rate.value
+
+    def current_rate(self):
+        return self.rate.value
+
+
+class Lane:
+    """Requests sharing a number of slots, with statistics about the
+       requests waiting for a slot (and a token)."""
+
+    def __init__(self, slots):
+        self.sem = BoundedSemaphore(slots)
         self.lock = Lock()
-        self.sem = BoundedSemaphore(max_workers)
-        self.last_request = Value('d', 0.0)
-        self.last_restricted_request = Value('d', 0.0)
+        self.waiting = Value('i', 0, lock=False)
+        self.max_waiting = Value('i', 0, lock=False)
+        self.requests = Value('l', 0, lock=False)
+        self.wait_time = Value('d', 0.0, lock=False)
+        self.max_wait_time = Value('d', 0.0, lock=False)
 
     @contextmanager
-    def normal_request(self):
+    def request(self, bucket):
+        start = time.time()
         with self.lock:
-            self.sem.acquire()
-        time.sleep(max(0.0, self.last_restricted_request.value + 0.6 + (random.random() * 0.15) - time.time()))
+            self.waiting.value += 1
+            self.max_waiting.value = max(self.max_waiting.value, self.waiting.value)
+        self.sem.acquire()
         try:
+            try:
+                bucket.acquire()
+            finally:
+                waited = time.time() - start
+                with self.lock:
+                    self.waiting.value -= 1
+                    self.requests.value += 1
+                    self.wait_time.value += waited
+                    self.max_wait_time.value = max(self.max_wait_time.value, waited)
             yield
-        except Exception as e:
-            raise e
         finally:
-            self.last_request.value = time.time()
             self.sem.release()
 
-    @contextmanager
-    def restricted_request(self):
+    def summary(self):
         with self.lock:
-            for i in range(self.max_workers):
-                self.sem.acquire()
-        time.sleep(max(0.0, self.last_request.value + 0.6 + (random.random() * 0.15) - time.time()))
-        try:
-            yield
-        except Exception as e:
-            raise e
-        finally:
-            self.last_request.value = time.time()
-            self.last_restricted_request.value = time.time()
-            for i in range(self.max_workers):
-                self.sem.release()
+            requests = self.requests.value
+            return "{} requests, waited {:.2f}s on average (max. {:.2f}s), max. queue depth {}".format(
+                requests, self.wait_time.value / requests if requests else 0.0, self.max_wait_time.value,
+                self.max_waiting.value)
+
+
+def egress_name(egress):
+    return egress if egress is not None else "default"
+
+
+class EgressSlot:
+    """Rate limits (and back-off) of the requests leaving via one egress,
+       i.e., a local address or a proxy, as the store limits the requests
+       per client."""
+
+    def __init__(self, egress, rate_limits):
+        self.egress = egress
+        self.buckets = {host: TokenBucket(*limits) for host, limits in rate_limits.items()}
+        self.restricted_lane = Lane(const_restricted_lane_slots())
+        self.lock = Lock()
+        self.throttled = Value('l', 0, lock=False)
+
+    def name(self):
+        return egress_name(self.egress)
+
+
+class RequestManager:
+    """Schedules the requests of all workers: normal requests (store pages,
+       crx downloads) and restricted requests (reviews and support pages)
+       use separate lanes, so that the few restricted requests in flight do
+       not stall the normal ones. Each request is assigned to the egress
+       slot that can send it first, and paced by the token bucket of its
+       host in that slot. The request contexts yield the index of the slot,
+       which is passed on to the SessionManager and to report()."""
+
+    def __init__(self, max_workers, rate_limits=None, egresses=None):
+        self.max_workers = max_workers
+        if rate_limits is None:
+            rate_limits = const_rate_limits()
+        if not egresses:
+            egresses = [None]
+        self.normal_lane = Lane(max_workers)
+        self.slots = [EgressSlot(egress, rate_limits) for egress in egresses]
+
+    def _best_slot(self, host, restricted=False):
+        if len(self.slots) == 1:
+            return 0
+        if restricted:
+            return min(range(len(self.slots)), key=lambda i: (self.slots[i].restricted_lane.waiting.value,
+                                                              self.slots[i].buckets[host].delay()))
+        return min(range(len(self.slots)), key=lambda i: self.slots[i].buckets[host].delay())
+
+    @contextmanager
+    def normal_request(self, host):
+        slot = self._best_slot(host)
+        with self.normal_lane.request(self.slots[slot].buckets[host]):
+            yield slot
+
+    @contextmanager
+    def restricted_request(self, host):
+        slot = self._best_slot(host, restricted=True)
+        with self.slots[slot].restricted_lane.request(self.slots[slot].buckets[host]):
+            yield slot
+
+    def report(self, host, status_code, slot=0):
+        """Adjust the rate of host in slot to the status code of a response."""
+        egress_slot = self.slots[slot]
+        bucket = egress_slot.buckets[host]
+        if status_code in (429, 503):
+            with egress_slot.lock:
+                egress_slot.throttled.value += 1
+            if bucket.decrease(const_rate_decrease(), const_rate_decrease_cooldown()):
+                log_warning("* {} answered {} (via {}), backing off to {:.2f} requests/s".format(
+                    host, status_code, egress_slot.name(), bucket.current_rate()), 2)
+        elif status_code < 500:
+            bucket.increase(const_rate_increase())
+
+    def throttled(self):
+        """Number of throttled (429/503) responses of all egresses."""
+        return sum(egress_slot.throttled.value for egress_slot in self.slots)
+
+    def rates(self, slot=0):
+        """Current rates (requests/s) per host in slot."""
+        return {host: bucket.current_rate() for host, bucket in self.slots[slot].buckets.items()}
+
+    def rates_summary(self):
+        return "; ".join("{} ({} throttled): {}".format(egress_slot.name(), egress_slot.throttled.value, ", ".join(
+            "{}: {:.2f}/s".format(host, rate) for host, rate in sorted(self.rates(i).items())))
+                         for i, egress_slot in enumerate(self.slots))
+
+    def lanes_summary(self):
+        return ["normal: {}".format(self.normal_lane.summary())] + [
+            "restricted ({}): {}".format(egress_slot.name(), egress_slot.restricted_lane.summary())
+            for egress_slot in self.slots]
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for scheduling the recrawls of extensions based on their
+   crawl history."""
+
+import fcntl
+import json
+import os
+import time
+
+from ExtensionCrawler.config import (const_recrawl_interval, const_recrawl_max_interval,
+                                     const_recrawl_max_missing_interval, const_recrawl_popular_downloads,
+                                     const_recrawl_slack)
+from ExtensionCrawler.util import log_info, log_exception
+
+
+class CrawlHistory:
+    """Per-extension crawl history, stored as one json file:
+       last_crawl     time of the last crawl
+       last_change    time of the last crawl that downloaded a new crx
+       change_interval  average time between crx changes
+       downloads      number of downloads (from the overview page)
+       missing        number of consecutive crawls that found the
+                      extension not in store (or not authorized)
+       failed         if the last crawl failed"""
+
+    def __init__(self, path):
+        self.path = path
+        self.history = {}
+        self.recorded = set()
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.history = json.load(f)
+            except Exception:
+                log_exception("Could not read crawl history {}, starting a new one".format(path))
+
+    def save(self):
+        """Save the history, merged with the one saved by other crawler
+           nodes (sharing the archive) in the meantime."""
+        with open(self.path + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            history = {}
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    history = json.load(f)
+            for ext_id in self.recorded:
+                history[ext_id] = self.history[ext_id]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(history, f)
+            os.replace(tmp_path, self.path)
+
+    def record(self, result, now=None):
+        """Add the UpdateResult of a crawl to the history."""
+        if now is None:
+            now = time.time()
+        h = self.history.setdefault(result.ext_id, {})
+        self.recorded.add(result.ext_id)
+        h["last_crawl"] = now
+        h["failed"] = result.worker_exception is not None or result.has_exception()
+        if result.not_in_store() or result.not_authorized():
+            h["missing"] = h.get("missing", 0) + 1
+        elif result.res_overview is not None and (result.res_overview.is_ok()
+                                                  or result.res_overview.not_modified()):
+            h["missing"] = 0
+        if result.res_crx is not None and result.res_crx.is_ok():
+            if h.get("last_change") is not None:
+                interval = now - h["last_change"]
+                h["change_interval"] = interval if h.get("change_interval") is None else (
+                    (h["change_interval"] + interval) / 2)
+            h["last_change"] = now
+        downloads = result.downloads()
+        if downloads is not None:
+            h["downloads"] = downloads
+
+    def record_all(self, results, now=None):
+        if now is None:
+            now = time.time()
+        for result in results:
+            self.record(result, now)
+
+    def interval(self, ext_id):
+        """Time between two crawls of ext_id."""
+        base = const_recrawl_interval()
+        h = self.history.get(ext_id)
+        if h is None or h.get("failed"):
+            return base
+        if h.get("missing"):
+            # Exponential back-off for extensions that are gone
+            return min(base * 2**h["missing"], const_recrawl_max_missing_interval())
+        if h.get("downloads", 0) >= const_recrawl_popular_downloads():
+            return base
+        estimate = h.get("change_interval")
+        if h.get("last_change") is not None:
+            # Not having changed for a long time counts as well
+            estimate = max(estimate or 0, h["last_crawl"] - h["last_change"])
+        if estimate is None:
+            return base
+        return min(max(base, estimate / 2), const_recrawl_max_interval())
+
+    def elapsed(self, ext_id, now=None):
+        """Time since the last crawl of ext_id (infinite if never crawled)."""
+        if now is None:
+            now = time.time()
+        h = self.history.get(ext_id)
+        return now - h["last_crawl"] if h is not None else float("inf")
+
+    def due(self, ext_ids, budget=None, always=None, now=None, slack=None):
+        """The ext_ids due for a crawl (or in less than slack), the most
+           overdue (and, among equally overdue ones, the most popular)
+           first, at most budget many (besides the ones in always)."""
+        if now is None:
+            now = time.time()
+        if slack is None:
+            slack = const_recrawl_slack()
+        always = set(always) if always is not None else set()
+        due = []
+        for ext_id in ext_ids:
+            if ext_id in always:
+                continue
+            h = self.history.get(ext_id)
+            if h is None:
+                due.append((float("inf"), 0, ext_id))
+                continue
+            interval = self.interval(ext_id)
+            elapsed = now - h["last_crawl"]
+            if elapsed + slack >= interval:
+                due.append((elapsed / interval, h.get("downloads", 0), ext_id))
+        due.sort(reverse=True)
+        if budget is not None:
+            due = due[:budget]
+        scheduled = [ext_id for _, _, ext_id in due] + [ext_id for ext_id in ext_ids if ext_id in always]
+        log_info("Scheduled {} of {} extensions ({} always crawled{})".format(
+            len(scheduled), len(ext_ids), len(scheduled) - len(due),
+            ", budget {}".format(budget) if budget is not None else ""), 1)
+        return scheduled
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for the persistent, pooled HTTP sessions of the crawler
+   workers."""
+
+import itertools
+import os
+import threading
+from multiprocessing import Lock, Value
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ExtensionCrawler.config import const_http_pool_sizes
+
+
+class CountingAdapter(HTTPAdapter):
+    """HTTPAdapter that keeps the numbers of requests and connections of
+       the connection pools its pool managers evicted (e.g., as they keep
+       only pool_connections pools) or closed, which are lost with them
+       otherwise."""
+
+    def __init__(self, **kwargs):
+        self.evicted_lock = threading.Lock()
+        self.evicted_requests = 0
+        self.evicted_connections = 0
+        super().__init__(**kwargs)
+
+    def _dispose(self, pool):
+        with self.evicted_lock:
+            self.evicted_requests += pool.num_requests
+            self.evicted_connections += pool.num_connections
+        pool.close()
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pools.dispose_func = self._dispose
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        new = proxy not in self.proxy_manager
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if new:
+            manager.pools.dispose_func = self._dispose
+        return manager
+
+
+class SourceAddressAdapter(CountingAdapter):
+    """HTTPAdapter whose connections originate from a local address."""
+
+    def __init__(self, source_address, **kwargs):
+        self.source_address = source_address
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["source_address"] = (self.source_address, 0)
+        super().init_poolmanager(*args, **kwargs)
+
+
+def is_proxy(egress):
+    return egress is not None and "://" in egress
+
+
+class SessionManager:
+    """Keeps one persistent requests session per worker process (and
+       egress), so that kept-alive connections (and their TLS handshakes)
+       are shared by all requests of all extensions a worker processes.
+
+       An egress is either a local address to bind to, or the URL of a
+       proxy; None uses the default route."""
+
+    def __init__(self, threads=1, pool_sizes=None, egresses=None):
+        self.threads = threads
+        self.pool_sizes = pool_sizes if pool_sizes is not None else const_http_pool_sizes()
+        self.egresses = egresses if egresses else [None]
+        self.lock = Lock()
+        self.num_requests = Value('l', 0)
+        self.num_connections = Value('l', 0)
+        self._sessions = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+        self._next_egress = itertools.count()
+        self._reported = (0, 0)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_sessions"] = None
+        state["_session_pid"] = None
+        state["_session_lock"] = None
+        state["_next_egress"] = None
+        state["_reported"] = (0, 0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._session_lock = threading.Lock()
+        self._next_egress = itertools.count()
+
+    def _create_session(self, egress):
+        session = requests.Session()
+        for prefix, size in self.pool_sizes.items():
+            if egress is None or is_proxy(egress):
+                adapter = CountingAdapter(pool_connections=1, pool_maxsize=size * self.threads)
+            else:
+                adapter = SourceAddressAdapter(egress, pool_connections=1, pool_maxsize=size * self.threads)
+            session.mount(prefix, adapter)
+        if is_proxy(egress):
+            session.proxies = {"http": egress, "https": egress}
+        return session
+
+    def session(self, egress=None):
+        """Session for the egress with index egress, or for the next egress
+           in turn if egress is None."""
+        with self._session_lock:
+            # A forked worker must not share the sockets of its parent
+            if self._sessions is None or self._session_pid != os.getpid():
+                self._sessions = [None] * len(self.egresses)
+                self._session_pid = os.getpid()
+                self._reported = (0, 0)
+            if egress is None:
+                egress = next(self._next_egress) % len(self.egresses)
+            if self._sessions[egress] is None:
+                self._sessions[egress] = self._create_session(self.egresses[egress])
+            return self._sessions[egress]
+
+    def get(self, url, egress=None, **kwargs):
+        return self.session(egress).get(url, **kwargs)
+
+    def head(self, url, egress=None, **kwargs):
+        return self.session(egress).head(url, **kwargs)
+
+    def post(self, url, egress=None, **kwargs):
+        return self.session(egress).post(url, **kwargs)
+
+    def _adapters(self):
+        for session in self._sessions:
+            if session is None:
+                continue
+            yield from session.adapters.values()
+
+    def _pools(self):
+        for adapter in self._adapters():
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            for manager in managers:
+                pools = manager.pools
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool is not None:
+                        yield pool
+
+    def update_stats(self):
+        """Add the requests and connections of this process since the last
+           call to the shared statistics (including those of evicted
+           connection pools, see CountingAdapter)."""
+        with self._session_lock:
+            if self._sessions is None or self._session_pid != os.getpid():
+                return
+            num_requests = 0
+            num_connections = 0
+            for pool in self._pools():
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+            for adapter in self._adapters():
+                if not isinstance(adapter, CountingAdapter):
+                    continue
+                with adapter.evicted_lock:
+                    num_requests += adapter.evicted_requests
+                    num_connections += adapter.evicted_connections
+            last_requests, last_connections = self._reported
+            self._reported = (num_requests, num_connections)
+        with self.lock:
+            self.num_requests.value += max(0, num_requests - last_requests)
+            self.num_connections.value += max(0, num_connections - last_connections)
+
+    def stats(self):
+        """Number of requests and number of opened connections."""
+        with self.lock:
+            return self.num_requests.value, self.num_connections.value
+
+    def stats_summary(self):
+        num_requests, num_connections = self.stats()
+        reused = num_requests - num_connections
+        return "{} requests over {} connections ({:.1f}% reused)".format(
+            num_requests, num_connections, 100.0 * reused / num_requests if num_requests else 0.0)
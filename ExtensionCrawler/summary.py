@@ -0,0 +1,144 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for summarizing the results of a crawl while they
+   arrive, without keeping them in memory."""
+
+import datetime
+import os
+import subprocess
+from collections import Counter
+
+from ExtensionCrawler.util import log_info, log_warning
+
+# Categories of extensions listed in log files: (name of the log file,
+# predicate on UpdateResults)
+FAILURE_LOGS = [
+    ("not-authorized", lambda x: x.not_authorized()),
+    ("updated", lambda x: x.is_ok() and not x.not_modified()),
+    ("raised-exception", lambda x: x.has_exception()),
+    ("raised-ddos", lambda x: x.raised_google_ddos()),
+    ("not-in-store", lambda x: x.not_in_store()),
+    ("new-in-store", lambda x: x.is_new()),
+    ("file-corruption", lambda x: x.corrupt_tar()),
+    ("sql-exception", lambda x: x.sql_exception()),
+    ("worker-exception", lambda x: x.worker_exception),
+    ("sql-not-updated", lambda x: not x.sql_success()),
+]
+
+
+class CrawlSummary:
+    """Counters of the UpdateResults of a crawl, and the ids of each
+       category of FAILURE_LOGS, which are appended to their log files in
+       dirname (and sorted with sort(1), i.e., without reading them into
+       memory, when closing). If append is set, existing log files (e.g.,
+       of an earlier run on the same day) are continued."""
+
+    def __init__(self, dirname, today, append=False):
+        os.makedirs(dirname, exist_ok=True)
+        self.counts = Counter()
+        self.logs = {}
+        for name, _ in FAILURE_LOGS + [("file-corruption-exceptions", None)]:
+            path = os.path.join(dirname, (today + "-" + name + ".log").replace(":", "_"))
+            terminated = True
+            if append and os.path.exists(path) and os.path.getsize(path) > 0:
+                with open(path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    # Logs closed by earlier versions are not terminated by
+                    # a newline
+                    terminated = f.read() == b"\n"
+            self.logs[name] = open(path, 'a' if append else 'w')
+            if not terminated:
+                self.logs[name].write("\n")
+        # The corrupt tar archives (hopefully few) are listed with their
+        # exceptions in the summary
+        self.corrupt_tar_archives = self.logs.pop("file-corruption-exceptions")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, result):
+        self.counts["total"] += 1
+        for name, predicate in FAILURE_LOGS:
+            if predicate(result):
+                self.counts[name] += 1
+                self.logs[name].write(result.ext_id + "\n")
+        if result.is_ok():
+            self.counts["ok"] += 1
+        if result.sql_success():
+            self.counts["sql-updated"] += 1
+        if result.not_modified():
+            self.counts["not-modified"] += 1
+        if result.overview_unchanged():
+            self.counts["overview-unchanged"] += 1
+        self.counts["crx-saved-requests"] += result.crx_saved_requests()
+        self.counts["forum-saved-requests"] += result.forum_saved_requests()
+        if result.corrupt_tar():
+            self.corrupt_tar_archives.write("{}: {}\n".format(
+                result.ext_id, str(result.exception).replace("\n", " ")))
+
+    def progress(self):
+        """One line summary of the results so far."""
+        return "{} extensions ({} ok, {} updated, {} new, {} exceptions, {} worker exceptions)".format(
+            self.counts["total"], self.counts["ok"], self.counts["updated"], self.counts["new-in-store"],
+            self.counts["raised-exception"], self.counts["worker-exception"])
+
+    def log_summary(self, runtime=0):
+        """Log brief result summary."""
+        counts = self.counts
+        log_info("Summary:")
+        log_info("    Updated {} out of {} extensions successfully".format(counts["ok"], counts["total"]))
+        log_info("    Updated extensions:      {:8d}".format(counts["updated"]))
+        log_info("    Updated SQL databases:   {:8d}".format(counts["sql-updated"]))
+        log_info("    New extensions:          {:8d}".format(counts["new-in-store"]))
+        log_info("    Not authorized:          {:8d}".format(counts["not-authorized"]))
+        log_info("    Raised Google DDOS:      {:8d}".format(counts["raised-ddos"]))
+        log_info("    Not modified archives:   {:8d}".format(counts["not-modified"]))
+        log_info("    Unchanged overviews:     {:8d}".format(counts["overview-unchanged"]))
+        log_info("    Avoided crx requests:    {:8d}".format(counts["crx-saved-requests"]))
+        log_info("    Avoided forum requests:  {:8d}".format(counts["forum-saved-requests"]))
+        log_info("    Extensions not in store: {:8d}".format(counts["not-in-store"]))
+        log_info("    Unknown exception:       {:8d}".format(counts["raised-exception"]))
+        log_info("    Corrupt tar archives:    {:8d}".format(counts["file-corruption"]))
+        log_info("    SQL exception:           {:8d}".format(counts["sql-exception"]))
+        log_info("    Worker exception:        {:8d}".format(counts["worker-exception"]))
+        log_info("    Total runtime:            {}".format(str(datetime.timedelta(seconds=int(runtime)))))
+
+        if self.counts["file-corruption"] and not self.corrupt_tar_archives.closed:
+            self.corrupt_tar_archives.flush()
+            log_info("")
+            log_info("List of extensions with corrupted files/archives:")
+            with open(self.corrupt_tar_archives.name) as f:
+                for line in f:
+                    log_info(line.rstrip("\n"), 1)
+            log_info("")
+
+    def close(self):
+        """Close the log files, sorting them one at a time."""
+        self.corrupt_tar_archives.close()
+        for logfile in self.logs.values():
+            if logfile.closed:
+                continue
+            logfile.close()
+            try:
+                subprocess.run(["sort", "-o", logfile.name, logfile.name], check=True,
+                               env=dict(os.environ, LC_ALL="C"))
+            except Exception as e:
+                log_warning("Could not sort {}: {}".format(logfile.name, e))
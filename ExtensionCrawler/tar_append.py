@@ -0,0 +1,110 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for appending to the tar archives of extensions without
+   reading all their member headers first (as tarfile does in append mode):
+   the end of an archive, where the next member is written, is recorded in
+   a sidecar file next to it, which is validated before being trusted."""
+
+import json
+import os
+import tarfile
+
+from ExtensionCrawler.tar_index import extend_index, index_is_current
+
+# Size of the buffer the members are appended through, so that the (staged)
+# data of an update is written sequentially, usually in one write
+WRITE_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def end_file(tar):
+    return tar + ".end"
+
+
+def _stat_key(st):
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino}
+
+
+def read_end(tar):
+    """The offset of the end of tar (i.e., of its first zero block), if the
+       sidecar matches tar (which has not been modified or replaced since),
+       the block at the offset is empty, and the header of the last member
+       is valid; None otherwise."""
+    try:
+        with open(end_file(tar)) as f:
+            end = json.load(f)
+        if {key: end.get(key) for key in ["size", "mtime_ns", "ino"]} != _stat_key(os.stat(tar)):
+            return None
+        with open(tar, 'rb') as f:
+            f.seek(end["offset"])
+            if f.read(tarfile.BLOCKSIZE) != tarfile.NUL * tarfile.BLOCKSIZE:
+                return None
+            if end["last_header"] is not None:
+                f.seek(end["last_header"])
+                tarfile.TarInfo.frombuf(f.read(tarfile.BLOCKSIZE), tarfile.ENCODING, "surrogateescape")
+    except (OSError, ValueError, KeyError, tarfile.HeaderError):
+        return None
+    return end["offset"], end["last_header"]
+
+
+def write_end(tar, offset, last_header):
+    end = dict(_stat_key(os.stat(tar)), offset=offset, last_header=last_header)
+    tmp_path = end_file(tar) + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(end, f)
+    os.replace(tmp_path, end_file(tar))
+
+
+class _OffsetTarFile(tarfile.TarFile):
+    """TarFile setting the offsets of the members it adds (which only the
+       members it reads have)."""
+
+    def addfile(self, tarinfo, fileobj=None):
+        offset = self.offset
+        super().addfile(tarinfo, fileobj)
+        member = self.members[-1]
+        data_blocks = -(-member.size // tarfile.BLOCKSIZE) if member.isreg() else 0
+        member.offset = offset
+        member.offset_data = self.offset - data_blocks * tarfile.BLOCKSIZE
+
+
+def append_to_tar(tar, staging):
+    """Add the members of staging (see tar_staging.TarStaging) to tar,
+       which is created if it does not exist, and to its index (see
+       tar_index). The members are written at the end recorded in the
+       sidecar (if valid) through one buffer, otherwise tar is scanned for
+       its end. Returns whether it was scanned."""
+    end = read_end(tar) if os.path.exists(tar) else None
+    index_current = index_is_current(tar)
+    if end is not None:
+        with open(tar, 'r+b', buffering=WRITE_BUFFER_SIZE) as f:
+            f.seek(end[0])
+            with _OffsetTarFile.open(fileobj=f, mode='w') as ar:
+                staging.add_to(ar)
+                offset = ar.offset
+                members = ar.members
+                last_header = ar.members[-1].offset if ar.members else end[1]
+    else:
+        with _OffsetTarFile.open(tar, mode='a:') as ar:
+            existing = len(ar.members)
+            staging.add_to(ar)
+            offset = ar.offset
+            members = ar.members[existing:]
+            last_header = ar.members[-1].offset if ar.members else None
+    write_end(tar, offset, last_header)
+    extend_index(tar, members, offset, staging.read, index_current)
+    return end is None
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for indexing the members of the tar archives of extensions
+   (and of their .NNN.tar.xz generations) in a sidecar file next to them,
+   so that members can be looked up without reading all member headers, and
+   read at their offset. The index is extended when appending, and rebuilt
+   (by scanning the archive once) when it is missing or does not match the
+   archive."""
+
+import ast
+import bisect
+import datetime
+import json
+import os
+import tarfile
+
+import dateutil.parser
+
+from ExtensionCrawler.util import log_info, log_warning
+
+
+def index_file(tar):
+    return tar + ".idx"
+
+
+def _stat_key(st):
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino}
+
+
+def member_kind(name):
+    """Kind of a member by its file name, e.g., crx, crx.headers,
+       overview.html, or overview.html.status."""
+    basename = os.path.basename(name)
+    if basename.endswith(".crx"):
+        return "crx"
+    if ".crx." in basename:
+        return "crx." + basename.split(".crx.", 1)[1]
+    return basename
+
+
+def _etag(headers):
+    """ETag from the contents of a .headers member, or None."""
+    if headers is None:
+        return None
+    try:
+        return ast.literal_eval(headers.decode()).get("ETag")
+    except Exception:
+        return None
+
+
+def index_entries(members, read_headers):
+    """Index entries of tarfile.TarInfo members (with their offsets);
+       read_headers returns the contents of a .crx.headers member by name
+       (or None), for the ETag of crxs."""
+    dates = {}
+    entries = []
+    for member in members:
+        parts = member.name.split("/")
+        date = None
+        if len(parts) > 1:
+            if parts[1] not in dates:
+                try:
+                    dates[parts[1]] = dateutil.parser.parse(parts[1]).isoformat()
+                except (ValueError, OverflowError):
+                    dates[parts[1]] = None
+            date = dates[parts[1]]
+        kind = member_kind(member.name) if member.isfile() else ("dir" if member.isdir() else "other")
+        entries.append({
+            "name": member.name,
+            "offset": member.offset,
+            "offset_data": member.offset_data,
+            "size": member.size,
+            "date": date,
+            "kind": kind,
+            "etag": _etag(read_headers(member.name + ".headers")) if kind == "crx" else None
+        })
+    return entries
+
+
+def _end_record(tar, offset):
+    return dict(_stat_key(os.stat(tar)), end=offset)
+
+
+def _last_line(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 1024))
+        return f.read().rstrip(b"\n").rsplit(b"\n", 1)[-1]
+
+
+def index_is_current(tar):
+    """Whether the index of tar ends with a record matching tar (which has
+       not been modified or replaced since the index was written)."""
+    try:
+        end = json.loads(_last_line(index_file(tar)))
+        return "end" in end and {key: end.get(key)
+                                 for key in ["size", "mtime_ns", "ino"]} == _stat_key(os.stat(tar))
+    except (OSError, ValueError):
+        return False
+
+
+def read_index(tar):
+    """The index entries of tar, in the order of the members, or None if
+       the index is missing or not current."""
+    entries = []
+    end = None
+    try:
+        with open(index_file(tar)) as f:
+            for line in f:
+                record = json.loads(line)
+                if "end" in record:
+                    end = record
+                else:
+                    entries.append(record)
+        if end is None or {key: end.get(key) for key in ["size", "mtime_ns", "ino"]} != _stat_key(os.stat(tar)):
+            return None
+    except (OSError, ValueError):
+        return None
+    return entries
+
+
+def _write_entries(tar, entries, offset, mode):
+    with open(index_file(tar) + (".tmp" if mode == 'w' else ""), mode) as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+        f.write(json.dumps(_end_record(tar, offset)) + "\n")
+    if mode == 'w':
+        os.replace(index_file(tar) + ".tmp", index_file(tar))
+
+
+def build_index(tar):
+    """Index tar by scanning it (in one pass, also for compressed
+       generations), and write the index next to it if possible. Returns the
+       entries."""
+    members = []
+    headers = {}
+    with tarfile.open(tar, 'r') as t:
+        for member in t:
+            members.append(member)
+            if member.name.endswith(".crx.headers"):
+                headers[member.name] = t.extractfile(member).read()
+        offset = t.offset
+    entries = index_entries(members, headers.get)
+    try:
+        _write_entries(tar, entries, offset, 'w')
+    except OSError:
+        log_warning("Cannot write index of {}".format(tar))
+    return entries
+
+
+def load_index(tar):
+    """The index entries of tar, rebuilt if necessary."""
+    entries = read_index(tar)
+    if entries is None:
+        log_info("Indexing {}".format(tar))
+        entries = build_index(tar)
+    return entries
+
+
+def extend_index(tar, members, offset, read_headers, was_current):
+    """Add the members just appended to tar (ending at offset) to its index
+       if it was current before appending, otherwise rebuild it. A failure
+       only leaves the index to be rebuilt when it is next loaded."""
+    try:
+        if was_current:
+            _write_entries(tar, index_entries(members, read_headers), offset, 'a')
+        else:
+            build_index(tar)
+    except (OSError, tarfile.TarError):
+        log_warning("Cannot update index of {}".format(tar))
+
+
+def crx_entries(entries):
+    """The entries of the (non-empty) crxs, sorted by name (and thus
+       date)."""
+    return sorted((entry for entry in entries if entry["kind"] == "crx" and entry["size"] > 0
+                   and entry["date"] is not None), key=lambda entry: entry["name"])
+
+
+class _Dates:
+    """The dates of crxs as a sequence for bisect, parsing only the ones
+       compared."""
+
+    def __init__(self, crxs):
+        self.crxs = crxs
+
+    def __len__(self):
+        return len(self.crxs)
+
+    def __getitem__(self, i):
+        return datetime.datetime.fromisoformat(self.crxs[i]["date"])
+
+
+def last_crx_entry(crxs, date=None):
+    """The last of crxs (see crx_entries) crawled at or before date, or
+       None."""
+    if date is None:
+        return crxs[-1] if crxs else None
+    i = bisect.bisect_right(_Dates(crxs), date)
+    return crxs[i - 1] if i > 0 else None
+
+
+def first_crx_entry(crxs, date=None):
+    """The first of crxs (see crx_entries) crawled at or after date, or
+       None."""
+    if date is None:
+        return crxs[0] if crxs else None
+    i = bisect.bisect_left(_Dates(crxs), date)
+    return crxs[i] if i < len(crxs) else None
+
+
+def find_entry(entries, name):
+    """The (last) entry of the member name, or None."""
+    return next((entry for entry in reversed(entries) if entry["name"] == name), None)
+
+
+def tarinfo_at(t, entry):
+    """The tarfile.TarInfo of an entry of the open tarfile t, read at its
+       offset (e.g., for t.extractfile)."""
+    t.fileobj.seek(entry["offset"])
+    return tarfile.TarInfo.fromtarfile(t)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for staging the files downloaded when updating an
+   extension as members of its tar archive, in memory rather than in a
+   temporary directory."""
+
+import glob
+import grp
+import io
+import os
+import pwd
+import shutil
+import tarfile
+import tempfile
+import time
+
+from ExtensionCrawler.config import const_staging_spill_size
+
+
+def _owner():
+    uid, gid = os.getuid(), os.getgid()
+    try:
+        uname = pwd.getpwuid(uid).pw_name
+    except KeyError:
+        uname = ""
+    try:
+        gname = grp.getgrgid(gid).gr_name
+    except KeyError:
+        gname = ""
+    return uid, gid, uname, gname
+
+
+def _spill_prefix(ext_id):
+    return ext_id + ".staging."
+
+
+def remove_spilled(ext_id):
+    """Remove the temporary files of the stagings of ext_id, e.g., left
+       behind by a worker that was killed when it timed out."""
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), glob.escape(_spill_prefix(ext_id)) + "*")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _tarinfo(name, mtime, owner, directory=False, size=0):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.mtime = mtime
+    tarinfo.uid, tarinfo.gid, tarinfo.uname, tarinfo.gname = owner
+    if directory:
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o755
+    else:
+        tarinfo.mode = 0o644
+        tarinfo.size = size
+    return tarinfo
+
+
+class TarStaging:
+    """The files downloaded when updating an extension, as the members
+       ext_id/date/fname of its archive, kept in memory until they are
+       appended to the archive in one sequential write (see
+       tar_append.append_to_tar). Streamed downloads larger than spill_size
+       are written to a temporary file instead, which is removed by
+       cleanup. Writing a file again replaces it."""
+
+    def __init__(self, ext_id, spill_size=None):
+        self.ext_id = ext_id
+        self.spill_size = spill_size if spill_size is not None else const_staging_spill_size()
+        # Member name -> (contents, or path of the temporary file, and mtime)
+        self.files = {}
+
+    def _name(self, date, fname):
+        return "/".join([self.ext_id, date, fname])
+
+    def _discard(self, name):
+        if name in self.files and isinstance(self.files[name][0], str):
+            os.remove(self.files[name][0])
+        self.files.pop(name, None)
+
+    def write(self, date, fname, data):
+        name = self._name(date, fname)
+        self._discard(name)
+        self.files[name] = (bytes(data), time.time())
+
+    def write_text(self, date, fname, text):
+        self.write(date, fname, text.encode())
+
+    def write_chunks(self, date, fname, chunks):
+        """Write a streamed download chunk by chunk, spilling it to a
+           temporary file once it is larger than spill_size. The chunks
+           written before an exception are kept."""
+        name = self._name(date, fname)
+        self._discard(name)
+        buf = io.BytesIO()
+        f = None
+        try:
+            for chunk in chunks:
+                if f is not None:
+                    f.write(chunk)
+                    continue
+                buf.write(chunk)
+                if buf.tell() > self.spill_size:
+                    fd, path = tempfile.mkstemp(prefix=_spill_prefix(self.ext_id), suffix="." + fname)
+                    f = os.fdopen(fd, 'wb')
+                    self.files[name] = (path, time.time())
+                    f.write(buf.getbuffer())
+                    buf = None
+        finally:
+            if f is not None:
+                f.close()
+            else:
+                self.files[name] = (buf.getvalue(), time.time())
+
+    def names(self):
+        return sorted(self.files)
+
+    def spilled(self):
+        """The number of files written to temporary files."""
+        return sum(1 for contents, _ in self.files.values() if isinstance(contents, str))
+
+    def read(self, name):
+        """Contents of the member name, or None."""
+        if name not in self.files:
+            return None
+        contents, _ = self.files[name]
+        if isinstance(contents, str):
+            with open(contents, 'rb') as f:
+                return f.read()
+        return contents
+
+    def add_to(self, ar):
+        """Add the members, preceded by their directories (like
+           TarFile.add of a directory), to the open TarFile ar."""
+        owner = _owner()
+        now = time.time()
+        if self.files:
+            ar.addfile(_tarinfo(self.ext_id, now, owner, directory=True))
+        directory = None
+        for name in self.names():
+            if os.path.dirname(name) != directory:
+                directory = os.path.dirname(name)
+                ar.addfile(_tarinfo(directory, now, owner, directory=True))
+            contents, mtime = self.files[name]
+            if isinstance(contents, str):
+                with open(contents, 'rb') as f:
+                    ar.addfile(_tarinfo(name, mtime, owner, size=os.fstat(f.fileno()).st_size), f)
+            else:
+                ar.addfile(_tarinfo(name, mtime, owner, size=len(contents)), io.BytesIO(contents))
+
+    def extract(self, directory):
+        """Write the members as files below directory (e.g., for the
+           database update); returns the directory of the extension."""
+        for name in self.names():
+            path = os.path.join(directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            contents, mtime = self.files[name]
+            if isinstance(contents, str):
+                shutil.copyfile(contents, path)
+            else:
+                with open(path, 'wb') as f:
+                    f.write(contents)
+            os.utime(path, (mtime, mtime))
+        return os.path.join(directory, self.ext_id)
+
+    def cleanup(self):
+        """Remove the temporary files."""
+        for name in list(self.files):
+            self._discard(name)
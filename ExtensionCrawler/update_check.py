@@ -0,0 +1,144 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Python module for checking the current crx versions of many extensions
+   with a few requests to the update service."""
+
+import threading
+from xml.etree.ElementTree import fromstring
+from functools import partial
+from pebble import ThreadPool
+from ExtensionCrawler import config
+from ExtensionCrawler.request_manager import RequestManager
+from ExtensionCrawler.session_manager import SessionManager
+from ExtensionCrawler.util import log_info, log_exception
+
+
+class CrxVersion:
+    def __init__(self, version, hash_sha256=None):
+        self.version = version
+        self.hash_sha256 = hash_sha256
+
+    def matches(self, version, hash_sha256=None):
+        """Check if a previously recorded version/hash is still current."""
+        if version is None or version != self.version:
+            return False
+        if hash_sha256 and self.hash_sha256:
+            return hash_sha256 == self.hash_sha256
+        return True
+
+
+def update_check_url(ext_ids):
+    """URL for checking the versions of all ext_ids in one request."""
+    return "&".join([config.const_update_check_url()] + [
+        config.const_update_check_param().format(ext_id) for ext_id in ext_ids])
+
+
+def parse_update_check(doc):
+    """Map extension ids to CrxVersion objects, skipping extensions for
+       which the update service reported an error or no crx."""
+    scheme = config.const_update_check_scheme()
+    versions = {}
+    for app in fromstring(doc).iterfind(r"{{{}}}app".format(scheme)):
+        if app.get("status") != "ok":
+            continue
+        updatecheck = app.find(r"{{{}}}updatecheck".format(scheme))
+        if updatecheck is None or updatecheck.get("status") != "ok" or not updatecheck.get("version"):
+            continue
+        versions[app.get("appid")] = CrxVersion(updatecheck.get("version"), updatecheck.get("hash_sha256"))
+    return versions
+
+
+def check_batch(session_manager, request_manager, ext_ids):
+    try:
+        with request_manager.normal_request("download") as egress:
+            res = session_manager.get(update_check_url(ext_ids), egress=egress, timeout=30)
+            request_manager.report("download", res.status_code, egress)
+        res.raise_for_status()
+        return parse_update_check(res.text)
+    except Exception:
+        log_exception("Exception when checking versions of {} extensions".format(len(ext_ids)), 1)
+        return {}
+
+
+def check_crx_versions(ext_ids, batch_size=None, session_manager=None, request_manager=None):
+    """Current crx versions of ext_ids. Extensions missing from the result
+       need to be checked individually. The requests are scheduled by
+       request_manager (like the downloads of the crawl it is shared with),
+       so that they are rate limited and back off like any other request to
+       the update service."""
+    if batch_size is None:
+        batch_size = config.const_update_check_batch_size()
+    if session_manager is None:
+        session_manager = SessionManager(threads=16)
+    if request_manager is None:
+        request_manager = RequestManager(16, egresses=session_manager.egresses)
+    ext_ids = list(ext_ids)
+    batches = [ext_ids[i:i + batch_size] for i in range(0, len(ext_ids), batch_size)]
+
+    versions = {}
+    with ThreadPool(16) as pool:
+        future = pool.map(partial(check_batch, session_manager, request_manager), batches, chunksize=1)
+        for batch_versions in future.result():
+            versions.update(batch_versions)
+    log_info("Checked versions of {} extensions with {} requests, {} versions found".format(
+        len(ext_ids), len(batches), len(versions)), 1)
+    return versions
+
+
+class CheckedFeed:
+    """Feed (see UpdateQueue) of the (ext_id, forums) pairs of tups, whose
+       crx versions are checked (by check_versions) chunk by chunk while
+       the extensions fed before are updated, instead of all of them before
+       the crawl starts. At most max_in_flight extensions are fed ahead of
+       their results."""
+
+    def __init__(self, tups, check_versions, max_in_flight, on_result, chunk_size=None):
+        self.tups = tups
+        self.check_versions = check_versions
+        self.max_in_flight = max_in_flight
+        self.on_result = on_result
+        if chunk_size is None:
+            # One request per thread of check_crx_versions
+            chunk_size = 16 * config.const_update_check_batch_size()
+        self.chunk_size = chunk_size
+        # Passed to the crawl engine, and updated for every chunk
+        self.crx_versions = {}
+        self.in_flight = 0
+        self.lock = threading.Condition()
+
+    def feed(self):
+        """The (ext_id, forums) pairs to update."""
+        for i in range(0, len(self.tups), self.chunk_size):
+            chunk = self.tups[i:i + self.chunk_size]
+            versions = self.check_versions([ext_id for ext_id, _ in chunk])
+            with self.lock:
+                self.crx_versions.update(versions)
+            for tup in chunk:
+                with self.lock:
+                    while self.in_flight >= self.max_in_flight:
+                        self.lock.wait(1)
+                    self.in_flight += 1
+                yield tup
+
+    def finished(self, result):
+        """The UpdateResult of a fed extension (on_result of the engine)."""
+        with self.lock:
+            self.in_flight -= 1
+            self.crx_versions.pop(result.ext_id, None)
+            self.on_result(result)
+            self.lock.notify_all()
@@ -19,6 +19,7 @@
 
 import traceback
 import logging
+import threading
 import sys
 
 from ExtensionCrawler.config import const_log_format
@@ -54,10 +55,25 @@ def log_exception(msg, indent_level=0):
         logging.error(4 * indent_level * " " + line)
 
 
+_logger_tag = threading.local()
+
+
+class LoggerTagFilter(logging.Filter):
+    """Adds the extension id of the current thread to log records, so
+       that several extensions can be processed within one process."""
+
+    def filter(self, record):
+        record.ext_id = getattr(_logger_tag, "ext_id", "-" * 32)
+        return True
+
+
 def set_logger_tag(ext_id):
+    _logger_tag.ext_id = ext_id
     logger = logging.getLogger()
     for handler in logger.handlers:
-        handler.setFormatter(logging.Formatter(const_log_format(ext_id)))
+        if not any(isinstance(f, LoggerTagFilter) for f in handler.filters):
+            handler.addFilter(LoggerTagFilter())
+            handler.setFormatter(logging.Formatter(const_log_format("%(ext_id)s")))
 
 
 def setup_logger(verbose):
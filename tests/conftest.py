@@ -0,0 +1,68 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Fixtures for testing the crawler against the stand-in store (see
+   scripts/testing/store-standin), which is served from a thread of the
+   test process."""
+
+import importlib.machinery
+import importlib.util
+import os
+import threading
+
+import pytest
+
+import ExtensionCrawler.archive
+from ExtensionCrawler.request_manager import RequestManager
+from ExtensionCrawler.session_manager import SessionManager
+
+STANDIN = os.path.join(os.path.dirname(__file__), os.pardir, "scripts", "testing", "store-standin")
+
+
+def load_standin():
+    loader = importlib.machinery.SourceFileLoader("store_standin", STANDIN)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    """The Store of a stand-in serving 20 extensions (with 5 reviews each)
+       on a free port, which the crawler is pointed to."""
+    module = load_standin()
+    store = module.Store(20, 2, 5, [])
+    handler = type("Handler", (module.StandinHandler,), {"store": store})
+    server = module.StandinServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+    monkeypatch.setenv("EXTENSION_STORE_BASE_URL", url)
+    monkeypatch.setenv("EXTENSION_UPDATE_BASE_URL", url)
+    yield store
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def managers():
+    """A RequestManager and a SessionManager, with which this process is
+       initialized like a worker (see archive.init_process)."""
+    rm = RequestManager(4)
+    sm = SessionManager(threads=4)
+    ExtensionCrawler.archive.init_process(False, False, rm, sm)
+    yield rm, sm
+    ExtensionCrawler.archive.init_process(False, False, None, None)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of inserting overview pages that are unchanged since an earlier
+   date (stored as links) into the database."""
+
+import os
+
+from ExtensionCrawler.db import parse_and_insert_overview
+
+EXT_ID = "a" * 32
+FIRST = "2019-01-01T00:00:00.000000+00:00"
+SECOND = "2019-01-02T00:00:00.000000+00:00"
+
+
+class Connection:
+    """Records the rows inserted (and copied) instead of a database."""
+
+    def __init__(self):
+        self.inserted = []
+        self.copied = []
+
+    def insert(self, table, **kwargs):
+        self.inserted.append((table, kwargs))
+
+    def copy_rows(self, table, extid, date, new_date):
+        self.copied.append((table, extid, date, new_date))
+
+
+def write_dates(tmp_path, dates):
+    for date in dates:
+        os.makedirs(os.path.join(str(tmp_path), date))
+    with open(os.path.join(str(tmp_path), FIRST, "overview.html"), 'w') as f:
+        f.write('<meta itemprop="name" content="Example"/>'
+                '<Attribute name="category">ext/22-accessibility</Attribute>')
+    with open(os.path.join(str(tmp_path), SECOND, "overview.html.link"), 'w') as f:
+        f.write(os.path.join("..", FIRST, "overview.html") + "\n")
+
+
+def test_linked_overview_is_parsed(tmp_path):
+    write_dates(tmp_path, [FIRST, SECOND])
+    con = Connection()
+    parse_and_insert_overview(EXT_ID, SECOND, os.path.join(str(tmp_path), SECOND), con)
+    assert [(table, row["date"]) for table, row in con.inserted] == [("extension", SECOND[:-6]),
+                                                                     ("category", SECOND[:-6])]
+    assert con.inserted[0][1]["name"] == "Example"
+    assert not con.copied
+
+
+def test_rows_of_linked_date_are_copied(tmp_path):
+    write_dates(tmp_path, [FIRST, SECOND])
+    os.remove(os.path.join(str(tmp_path), FIRST, "overview.html"))
+    con = Connection()
+    parse_and_insert_overview(EXT_ID, SECOND, os.path.join(str(tmp_path), SECOND), con)
+    assert not con.inserted
+    assert con.copied == [(table, EXT_ID, FIRST[:-6], SECOND[:-6]) for table in ["extension", "category"]]
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of discovering extensions with conditional requests of the
+   sitemap shards."""
+
+import json
+import os
+
+from ExtensionCrawler.discover import get_new_ids
+
+
+def test_unchanged_shards_are_not_downloaded(standin, managers, tmp_path):
+    rm, sm = managers
+    state_path = os.path.join(str(tmp_path), "sitemap.json")
+    assert sorted(get_new_ids([], session_manager=sm, state_path=state_path, request_manager=rm)) == sorted(
+        standin.ext_ids)
+    with open(state_path) as f:
+        assert len(json.load(f)) == standin.num_shards
+
+    # The ids of unchanged shards are taken from the state
+    known = standin.ext_ids[:5]
+    assert sorted(get_new_ids(known, session_manager=sm, state_path=state_path, request_manager=rm)) == sorted(
+        standin.ext_ids[5:])
+    stats = standin.stats()
+    assert stats["requests"]["sitemap"] == 2 * (1 + standin.num_shards)
+    assert stats["requests"]["sitemap-304"] == standin.num_shards
+
+    # Without a state, all shards are downloaded again
+    assert list(get_new_ids(standin.ext_ids, session_manager=sm, request_manager=rm)) == []
+    assert standin.stats()["requests"]["sitemap-304"] == standin.num_shards
+
+
+def test_max_ids(standin, managers):
+    rm, sm = managers
+    assert len(list(get_new_ids([], max_ids=3, session_manager=sm, request_manager=rm))) == 3
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of spreading the requests over several egresses (local addresses
+   of the loopback interface), each with its own rate limits."""
+
+import pytest
+
+import ExtensionCrawler.archive
+from ExtensionCrawler.archive import update_extension
+from ExtensionCrawler.config import const_rate_limits, const_rate_decrease
+from ExtensionCrawler.request_manager import RequestManager
+from ExtensionCrawler.session_manager import SessionManager
+
+EGRESSES = ["127.0.0.2", "127.0.0.3"]
+
+
+@pytest.fixture
+def egress_managers():
+    rm = RequestManager(4, egresses=EGRESSES)
+    sm = SessionManager(threads=4, egresses=EGRESSES)
+    ExtensionCrawler.archive.init_process(False, False, rm, sm)
+    yield rm, sm
+    ExtensionCrawler.archive.init_process(False, False, None, None)
+
+
+def test_requests_leave_via_all_egresses(standin, egress_managers, tmp_path):
+    rm, _ = egress_managers
+    for ext_id in standin.ext_ids[:4]:
+        assert update_extension((str(tmp_path), None, ext_id, True, None, None, None)).is_ok()
+
+    clients = standin.stats()["clients"]
+    assert set(clients) == set(EGRESSES)
+    assert sum(clients.values()) == sum(standin.stats()["requests"].values())
+    # Without back-off, the slots take turns
+    assert abs(clients[EGRESSES[0]] - clients[EGRESSES[1]]) <= 4
+    assert all(egress_slot.restricted_lane.requests.value > 0 for egress_slot in rm.slots)
+    assert rm.throttled() == 0
+
+
+def test_back_off_is_per_egress(standin, egress_managers, tmp_path):
+    rm, _ = egress_managers
+    standin.ddos_probability = 1.0
+    update_extension((str(tmp_path), None, standin.ext_ids[0], True, None, None, None))
+
+    assert rm.throttled() == standin.stats()["requests"]["ddos"] > 0
+    initial_rate = const_rate_limits()["reviews"][0]
+    for i, egress_slot in enumerate(rm.slots):
+        # One decrease per cooldown, however many 503s arrived
+        expected = initial_rate * const_rate_decrease() if egress_slot.throttled.value else initial_rate
+        assert rm.rates(i)["reviews"] == pytest.approx(expected)
+        assert rm.rates(i)["store"] >= const_rate_limits()["store"][0]
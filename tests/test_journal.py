@@ -0,0 +1,88 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of journaling the updates of a crawl, and of resuming it."""
+
+import datetime
+import os
+import subprocess
+import sys
+
+from ExtensionCrawler.archive import UpdateResult, RequestResult
+from ExtensionCrawler.journal import CrawlJournal, iter_journal
+from ExtensionCrawler.registry import registry_file
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+
+
+def result(ext_id, exception=None):
+    return UpdateResult(ext_id, False, None, RequestResult(http_status=200),
+                        RequestResult(http_status=304, exception=exception, saved_requests=1), None, None, None, True)
+
+
+def test_journal_is_resumed(tmp_path):
+    path = os.path.join(str(tmp_path), "journal.jsonl")
+    with CrawlJournal(path) as journal:
+        journal.append(result("a" * 32))
+        journal.append(result("b" * 32, IOError("connection reset")))
+    # The crawler died while writing a line
+    with open(path, 'a') as f:
+        f.write('{"ext_id": "cccc')
+
+    with CrawlJournal(path, resume=True) as journal:
+        assert journal.completed == {"a" * 32, "b" * 32}
+        results = list(journal.completed_results())
+        assert [res.res_crx.saved_requests for res in results] == [1, 1]
+        assert str(results[1].res_crx.exception) == "connection reset"
+        journal.append(result("c" * 32))
+
+    assert [res.ext_id for res in iter_journal(path)] == ["a" * 32, "b" * 32, "c" * 32]
+
+
+def test_journal_is_rotated(tmp_path):
+    path = os.path.join(str(tmp_path), "journal.jsonl")
+    with CrawlJournal(path) as journal:
+        journal.append(result("a" * 32))
+    with CrawlJournal(path) as journal:
+        assert not journal.completed
+    assert not list(iter_journal(path))
+    assert [res.ext_id for res in iter_journal(os.path.join(str(tmp_path), "journal.1.jsonl"))] == ["a" * 32]
+
+
+def run_crawler(basedir, *args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] + os.environ.get("PYTHONPATH", "").split(os.pathsep)))
+    subprocess.run([sys.executable, os.path.join(ROOT, "crawler"), "-a", basedir, "-p", "2"] + list(args), env=env,
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def test_crawl_is_resumed(standin, tmp_path):
+    basedir = str(tmp_path)
+    run_crawler(basedir, "-d")
+    assert standin.stats()["requests"]["overview"] == len(standin.ext_ids)
+    assert os.path.exists(registry_file(os.path.join(basedir, "data")))
+
+    # A crawl that died after updating some extensions
+    now = datetime.datetime.now(datetime.timezone.utc)
+    path = os.path.join(basedir, "log", now.strftime("%Y-%m"), now.date().isoformat() + "-journal.jsonl")
+    os.remove(path)
+    with CrawlJournal(path) as journal:
+        for ext_id in standin.ext_ids[:5]:
+            journal.append(result(ext_id))
+
+    run_crawler(basedir, "--resume")
+    assert standin.stats()["requests"]["overview"] == 2 * len(standin.ext_ids) - 5
+    assert {res.ext_id for res in iter_journal(path)} == set(standin.ext_ids)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of the leases of crawler nodes, and of feeding the extensions of
+   the leased ranges to the crawl engine of a node."""
+
+import os
+import threading
+import time
+
+import pytest
+
+import ExtensionCrawler.lease
+from ExtensionCrawler.lease import LeaseManager, all_ranges
+from ExtensionCrawler.node import LeasedFeed
+
+DATE = "2019-01-01"
+
+
+@pytest.fixture(autouse=True)
+def few_ranges(monkeypatch):
+    """16 ranges (of one letter), taken over as soon as they expire."""
+    monkeypatch.setattr(ExtensionCrawler.lease, "const_lease_prefix_length", lambda: 1)
+    monkeypatch.setattr(ExtensionCrawler.lease, "const_lease_grace", lambda: 0)
+
+
+class Result:
+    def __init__(self, ext_id):
+        self.ext_id = ext_id
+
+
+def test_lease_is_exclusive(tmp_path):
+    a = LeaseManager(str(tmp_path), "a", duration=60)
+    b = LeaseManager(str(tmp_path), "b", duration=60)
+    assert a.acquire("c")
+    assert not b.acquire("c")
+    assert a.holds("c" * 32) and not b.holds("c" * 32)
+    a.release("c")
+    assert b.acquire("c")
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    a = LeaseManager(str(tmp_path), "a", duration=0.2)
+    b = LeaseManager(str(tmp_path), "b", duration=60)
+    assert a.acquire("c")
+    time.sleep(0.3)
+    assert not a.holds("c" * 32)
+    assert b.acquire("c")
+    a.renew()
+    assert not a.has("c")
+    assert b.holds("c" * 32)
+    # Releasing the lost lease leaves the one of b alone
+    a.release("c")
+    assert b.holds("c" * 32)
+
+
+def test_leases_are_renewed(tmp_path):
+    b = LeaseManager(str(tmp_path), "b", duration=60)
+    with LeaseManager(str(tmp_path), "a", duration=0.6) as a:
+        assert a.acquire("c")
+        time.sleep(1.0)
+        assert a.has("c") and a.holds("c" * 32)
+        assert not b.acquire("c")
+    assert b.acquire("c")
+
+
+def test_next_range_skips_done_and_held_ranges(tmp_path):
+    a = LeaseManager(str(tmp_path), "a", duration=60)
+    for prefix_range in all_ranges()[2:]:
+        a.mark_done(prefix_range, DATE)
+    assert {a.next_range(DATE), a.next_range(DATE)} == set(all_ranges()[:2])
+    assert a.next_range(DATE) is None
+
+
+def test_leased_feed(tmp_path):
+    ext_ids = ["a" * 32, "ab" * 16, "c" * 32]
+    discovered_ids = ["d" * 32, "cd" * 16]
+    late_id = "a" + "b" * 31
+    range_a_finished = threading.Event()
+
+    def discover():
+        yield from discovered_ids
+        assert range_a_finished.wait(10)
+        yield late_id
+
+    results = []
+
+    def on_result(result):
+        results.append(result.ext_id)
+        if sorted(ext_id for ext_id in results if ext_id.startswith("a")) == ["a" * 32, "ab" * 16]:
+            range_a_finished.set()
+
+    with LeaseManager(str(tmp_path), "a", duration=60) as leases:
+        feed = LeasedFeed(leases, DATE, ext_ids, ["c" * 32], 2, on_result, discover(), lambda ids: {})
+        fed = []
+        for ext_id, forums in feed.feed():
+            fed.append((ext_id, forums))
+            feed.finished(Result(ext_id))
+
+        assert sorted(fed) == sorted([(ext_id, ext_id == "c" * 32) for ext_id in ext_ids]
+                                     + [(ext_id, False) for ext_id in discovered_ids + [late_id]])
+        assert sorted(results) == sorted(ext_id for ext_id, _ in fed)
+        assert all(os.path.exists(os.path.join(str(tmp_path), DATE, prefix_range + ".done"))
+                   for prefix_range in all_ranges())
+        assert not leases.held
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of several crawler nodes (separate processes running the crawler
+   script) sharing an archive."""
+
+import datetime
+import glob
+import os
+import sqlite3
+import subprocess
+import sys
+import tarfile
+
+import ExtensionCrawler.lease
+from ExtensionCrawler.lease import LeaseManager, range_of
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+
+# Runs the crawler with 16 ranges (of one letter), whose leases expire
+# after a few seconds and are taken over right away
+NODE = """
+import runpy
+import sys
+import ExtensionCrawler.lease
+ExtensionCrawler.lease.const_lease_prefix_length = lambda: 1
+ExtensionCrawler.lease.const_lease_duration = lambda: 3
+ExtensionCrawler.lease.const_lease_grace = lambda: 0
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def start_node(basedir, node):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] + os.environ.get("PYTHONPATH", "").split(os.pathsep)))
+    return subprocess.Popen([sys.executable, "-c", NODE, os.path.join(ROOT, "crawler"), "-a", basedir, "-d",
+                             "-p", "2", "--node", node], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+
+
+def registry_ids(basedir, node):
+    con = sqlite3.connect(os.path.join(basedir, "data", "registry-{}.sqlite".format(node)))
+    try:
+        return {row[0] for row in con.execute("SELECT extid FROM extension")}
+    finally:
+        con.close()
+
+
+def test_nodes_share_archive(standin, tmp_path, monkeypatch):
+    monkeypatch.setattr(ExtensionCrawler.lease, "const_lease_prefix_length", lambda: 1)
+    basedir = str(tmp_path)
+    # A node that died while holding a lease
+    dead_range = range_of(standin.ext_ids[0])
+    assert LeaseManager(os.path.join(basedir, "leases"), "dead", duration=0).acquire(dead_range)
+
+    nodes = {node: start_node(basedir, node) for node in ["n1", "n2"]}
+    logs = {node: process.communicate(timeout=300)[0] for node, process in nodes.items()}
+    assert all(process.returncode == 0 for process in nodes.values()), logs
+
+    # Every extension was crawled by exactly one node, i.e., no archive was
+    # appended to by both
+    ids = {node: registry_ids(basedir, node) for node in nodes}
+    assert not ids["n1"] & ids["n2"]
+    assert ids["n1"] | ids["n2"] == set(standin.ext_ids)
+    for tar in glob.glob(os.path.join(basedir, "data", "*", "*.tar")):
+        with tarfile.open(tar) as f:
+            assert len({member.name.split("/")[1] for member in f.getmembers() if "/" in member.name}) == 1
+
+    # All ranges are done, each by the node that crawled its extensions
+    date = datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+    for node, node_ids in ids.items():
+        for ext_id in node_ids:
+            with open(os.path.join(basedir, "leases", date, range_of(ext_id) + ".done")) as f:
+                assert f.read().strip() == node
+    assert sum("Taking over expired lease of {} from dead".format(dead_range) in log for log in logs.values()) == 1
+    assert not glob.glob(os.path.join(basedir, "leases", "*.lease"))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of the registry of archived extensions, of the registries of
+   several crawler nodes, and of rebuilding them from the archive."""
+
+import os
+import tarfile
+
+from ExtensionCrawler.archive import UpdateResult, RequestResult, get_local_archive_dir
+from ExtensionCrawler.registry import Registry, registry_file, registry_files
+
+A, B, C, D = (letter * 32 for letter in "abcd")
+FIRST = "2019-01-01T00:00:00+00:00"
+SECOND = "2019-01-02T00:00:00+00:00"
+
+
+def create_tar(archivedir, ext_id, suffix=".tar"):
+    directory = os.path.join(archivedir, get_local_archive_dir(ext_id))
+    os.makedirs(directory, exist_ok=True)
+    with tarfile.open(os.path.join(directory, ext_id + suffix), 'w'):
+        pass
+
+
+def ok_result(ext_id):
+    return UpdateResult(ext_id, False, None, RequestResult(http_status=200), RequestResult(http_status=304),
+                        None, None, None, True)
+
+
+def test_registry_records_crawls(tmp_path):
+    archivedir = str(tmp_path)
+    for ext_id in [A, B]:
+        create_tar(archivedir, ext_id)
+    with Registry(archivedir) as registry:
+        registry.record([ok_result(A), ok_result(C)], FIRST)
+        registry.record([ok_result(A), ok_result(B)], SECOND)
+
+    with Registry(archivedir) as registry:
+        rows = registry.rows()
+        assert sorted(rows) == [A, B]
+        assert (rows[A]["first_crawl"], rows[A]["last_crawl"], rows[A]["last_status"]) == (
+            FIRST, SECOND, "not-modified")
+        assert registry.paths("a*") == [os.path.join(archivedir, get_local_archive_dir(A), A + ".tar")]
+
+
+def test_node_registries_are_merged(tmp_path):
+    archivedir = str(tmp_path)
+    for ext_id in [A, B]:
+        create_tar(archivedir, ext_id)
+    with Registry(archivedir, "n1") as registry:
+        registry.record([ok_result(A)], FIRST)
+    with Registry(archivedir, "n2") as registry:
+        registry.record([ok_result(A), ok_result(B)], SECOND)
+    assert registry_files(archivedir) == sorted(registry_file(archivedir, node) for node in ["n1", "n2"])
+
+    with Registry(archivedir) as registry:
+        rows = registry.rows()
+        assert sorted(registry.ids()) == [A, B]
+        assert (rows[A]["first_crawl"], rows[A]["last_crawl"]) == (FIRST, SECOND)
+
+        registry.rebuild(merge=True)
+        assert registry_files(archivedir) == [registry_file(archivedir)]
+        assert registry.rows() == rows
+
+
+def test_rebuild(tmp_path):
+    archivedir = str(tmp_path)
+    for ext_id in [A, B, D]:
+        create_tar(archivedir, ext_id)
+    with Registry(archivedir) as registry:
+        registry.record([ok_result(A), ok_result(D)], FIRST)
+    # Archives added (and removed) without crawling them
+    create_tar(archivedir, C)
+    os.remove(os.path.join(archivedir, get_local_archive_dir(D), D + ".tar"))
+    # Older generations of A
+    create_tar(archivedir, A, ".000.tar.xz")
+    create_tar(archivedir, A, ".001.tar.xz")
+
+    with Registry(archivedir) as registry:
+        registry.rebuild()
+        rows = registry.rows()
+        assert sorted(rows) == [A, B, C]
+        assert (rows[A]["first_crawl"], rows[A]["last_status"]) == (FIRST, "not-modified")
+        assert rows[C]["first_crawl"] is None and rows[C]["last_crawl"] is not None
+        tar = os.path.join(archivedir, get_local_archive_dir(A), A)
+        assert registry.paths("a*") == [tar + ".000.tar.xz", tar + ".001.tar.xz", tar + ".tar"]
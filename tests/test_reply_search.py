@@ -0,0 +1,59 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of combining the reply searches of several extensions."""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from ExtensionCrawler.reply_search import ReplySearchBatcher
+
+
+def specs_of(ext_id):
+    return [(ext_id, "author{}".format(i), 0, 10, ["chrome_webstore"]) for i in range(2)]
+
+
+def search_all(batcher, ext_ids):
+    with ThreadPoolExecutor(len(ext_ids)) as pool:
+        return dict(zip(ext_ids, pool.map(lambda ext_id: batcher.search(specs_of(ext_id)), ext_ids)))
+
+
+def test_batched_searches_get_their_results(standin, managers):
+    rm, sm = managers
+    ext_ids = standin.ext_ids[:6]
+    with ReplySearchBatcher(rm, sm, batch_size=4, delay=0.5) as batcher:
+        replies = search_all(batcher, ext_ids)
+
+    for ext_id, reply in replies.items():
+        assert reply.status_code == 200
+        results = json.loads(reply.text)["searchResults"]
+        assert [(result["annotations"][0]["entity"]["author"], result["annotations"][0]["comment"])
+                for result in results] == [("dev-" + ext_id, "Reply to " + author)
+                                           for _, author, _, _, _ in specs_of(ext_id)]
+    requests = standin.stats()["requests"]["search"]
+    assert requests < len(ext_ids)
+    assert batcher.stats_summary() == "6 searches (12 specs) in {} requests".format(requests)
+
+
+def test_failed_batched_search_is_answered_for_all(standin, managers):
+    rm, sm = managers
+    standin.ddos_probability = 1.0
+    with ReplySearchBatcher(rm, sm, batch_size=4, delay=0.5) as batcher:
+        replies = search_all(batcher, standin.ext_ids[:2])
+
+    assert [reply.status_code for reply in replies.values()] == [503, 503]
+    assert standin.stats()["requests"]["ddos"] == 1
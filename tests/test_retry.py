@@ -0,0 +1,86 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of retrying the failed phases of extension updates."""
+
+import pytest
+
+import ExtensionCrawler.archive
+from ExtensionCrawler.archive import UpdateQueue, UpdateResult, RequestResult
+
+EXT_ID = "a" * 32
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(ExtensionCrawler.archive, "const_retry_delay", lambda: 0)
+
+
+def ok():
+    return RequestResult(http_status=200)
+
+
+def failed():
+    return RequestResult(exception=ConnectionResetError())
+
+
+def result(res_overview, res_crx, res_reviews, res_support, tar_exception=None):
+    return UpdateResult(EXT_ID, False, tar_exception, res_overview, res_crx, res_reviews, res_support, None, False)
+
+
+def test_failed_phases():
+    assert result(ok(), failed(), ok(), failed()).failed_phases() == {"crx", "support"}
+    assert result(ok(), ok(), None, None).failed_phases() == set()
+    # Nothing was stored
+    assert result(None, None, None, None).failed_phases() is None
+    assert result(ok(), failed(), None, None, IOError()).failed_phases() is None
+
+
+def test_retry_of_phases_is_merged_under_first_date():
+    update_queue = UpdateQueue([(EXT_ID, True)])
+    ext_id, forums, phases, date = update_queue.get()
+    assert (ext_id, forums, phases) == (EXT_ID, True, None)
+    assert update_queue.finish(result(ok(), failed(), ok(), failed()), forums) is None
+
+    assert update_queue.get(block=True) == (EXT_ID, True, {"crx", "support"}, date)
+    assert update_queue.finish(result(None, ok(), None, failed()), forums) is None
+
+    assert update_queue.get(block=True) == (EXT_ID, True, {"support"}, date)
+    merged = update_queue.finish(result(None, None, None, ok()), forums)
+    assert not merged.has_exception()
+    assert [res.http_status for res in [merged.res_overview, merged.res_crx, merged.res_reviews,
+                                        merged.res_support]] == [200] * 4
+    assert update_queue.done()
+    assert update_queue.retries_summary() == "2 retries of 1 extensions"
+
+
+def test_repeated_update_gets_new_date():
+    update_queue = UpdateQueue([(EXT_ID, False)])
+    _, forums, _, date = update_queue.get()
+    assert update_queue.finish(result(ok(), failed(), None, None, IOError()), forums) is None
+    _, _, phases, retry_date = update_queue.get(block=True)
+    assert phases is None and retry_date != date
+
+
+def test_retries_end(monkeypatch):
+    monkeypatch.setattr(ExtensionCrawler.archive, "const_max_retries", lambda: 1)
+    update_queue = UpdateQueue([(EXT_ID, False)])
+    update_queue.get()
+    assert update_queue.finish(result(ok(), failed(), None, None), False) is None
+    update_queue.get(block=True)
+    assert update_queue.finish(result(None, failed(), None, None), False).res_crx.has_exception()
+    assert update_queue.done()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of scheduling the recrawls of extensions based on their crawl
+   history."""
+
+import os
+
+from ExtensionCrawler.archive import UpdateResult, RequestResult
+from ExtensionCrawler.config import (const_recrawl_interval, const_recrawl_max_interval,
+                                     const_recrawl_max_missing_interval, const_recrawl_popular_downloads)
+from ExtensionCrawler.schedule import CrawlHistory
+
+A, B, C, D = (letter * 32 for letter in "abcd")
+DAY = const_recrawl_interval()
+
+
+def result(ext_id, overview_status=200, crx_status=304, downloads=None, exception=None):
+    return UpdateResult(ext_id, False, None, RequestResult(http_status=overview_status, downloads=downloads),
+                        RequestResult(http_status=crx_status, exception=exception), None, None, None, True)
+
+
+def test_intervals(tmp_path):
+    history = CrawlHistory(os.path.join(str(tmp_path), "history.json"))
+    assert history.interval(A) == DAY
+
+    # Changes every ten days, i.e., crawled every five days
+    for day in [0, 10, 20]:
+        history.record(result(A, crx_status=200), now=day * DAY)
+    history.record(result(A), now=21 * DAY)
+    assert history.interval(A) == 5 * DAY
+    # Not having changed for a long time
+    history.record(result(A), now=60 * DAY)
+    assert history.interval(A) == const_recrawl_max_interval()
+
+    # Popular extensions are crawled every day
+    for day in [0, 10, 20]:
+        history.record(result(B, crx_status=200, downloads=const_recrawl_popular_downloads()), now=day * DAY)
+    assert history.interval(B) == DAY
+
+    # Exponential back-off for missing extensions
+    for missing in range(1, 4):
+        history.record(result(C, overview_status=404, crx_status=404), now=missing * DAY)
+        assert history.interval(C) == 2**missing * DAY
+    for day in range(4, 12):
+        history.record(result(C, overview_status=404, crx_status=404), now=day * DAY)
+    assert history.interval(C) == const_recrawl_max_missing_interval()
+    history.record(result(C), now=12 * DAY)
+    assert history.interval(C) == DAY
+
+    # Failed crawls are retried after the shortest interval
+    history.record(result(D, crx_status=200), now=0)
+    history.record(result(D, crx_status=200), now=30 * DAY)
+    history.record(result(D, crx_status=None, exception=IOError("connection reset")), now=31 * DAY)
+    assert history.interval(D) == DAY
+
+
+def test_due(tmp_path):
+    history = CrawlHistory(os.path.join(str(tmp_path), "history.json"))
+    for day in [0, 10]:
+        history.record(result(A, crx_status=200), now=day * DAY)
+        history.record(result(B, crx_status=200, downloads=const_recrawl_popular_downloads()), now=day * DAY)
+    now = 12 * DAY
+    # A is due in three days (besides the slack), B is overdue, C is new
+    assert history.due([A, B, C], now=now, slack=0) == [C, B]
+    assert history.due([A, B, C], now=now, slack=3 * DAY) == [C, B, A]
+    assert history.due([A, B, C], budget=1, now=now, slack=0) == [C]
+    assert history.due([A, B, C], budget=1, always=[A], now=now, slack=0) == [C, A]
+    assert history.elapsed(B, now=now) == 2 * DAY
+    assert history.elapsed(C, now=now) == float("inf")
+
+
+def test_saved_histories_are_merged(tmp_path):
+    path = os.path.join(str(tmp_path), "history.json")
+    node1, node2 = CrawlHistory(path), CrawlHistory(path)
+    node1.record(result(A), now=DAY)
+    node2.record(result(B), now=2 * DAY)
+    node1.save()
+    node2.save()
+
+    history = CrawlHistory(path)
+    assert history.elapsed(A, now=3 * DAY) == 2 * DAY
+    assert history.elapsed(B, now=3 * DAY) == DAY
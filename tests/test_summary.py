@@ -0,0 +1,66 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of summarizing the results of a crawl in log files."""
+
+import os
+
+from ExtensionCrawler.archive import UpdateResult, RequestResult
+from ExtensionCrawler.summary import CrawlSummary
+
+DAY = "2019-01-01"
+
+
+def ok_result(ext_id):
+    return UpdateResult(ext_id, False, None, RequestResult(http_status=200), RequestResult(http_status=200),
+                        None, None, None, True)
+
+
+def corrupt_result(ext_id):
+    return UpdateResult(ext_id, False, IOError("bad\nheader"), RequestResult(http_status=200),
+                        RequestResult(http_status=304), None, None, None, True)
+
+
+def read_log(dirname, name):
+    with open(os.path.join(dirname, "{}-{}.log".format(DAY, name))) as f:
+        return f.read()
+
+
+def test_logs_are_sorted(tmp_path):
+    with CrawlSummary(str(tmp_path), DAY) as summary:
+        for ext_id in ["c" * 32, "a" * 32, "b" * 32]:
+            summary.add(ok_result(ext_id))
+        summary.add(corrupt_result("d" * 32))
+        summary.log_summary()
+
+    assert summary.counts["total"] == 4 and summary.counts["file-corruption"] == 1
+    assert read_log(str(tmp_path), "updated") == "".join(ext_id * 32 + "\n" for ext_id in "abc")
+    assert read_log(str(tmp_path), "file-corruption") == "d" * 32 + "\n"
+    assert read_log(str(tmp_path), "file-corruption-exceptions") == "d" * 32 + ": bad header\n"
+
+
+def test_logs_are_continued(tmp_path):
+    # As closed by earlier versions, without a final newline
+    with open(os.path.join(str(tmp_path), "{}-updated.log".format(DAY)), 'w') as f:
+        f.write("b" * 32 + "\n" + "d" * 32)
+
+    with CrawlSummary(str(tmp_path), DAY, append=True) as summary:
+        summary.add(ok_result("c" * 32))
+    with CrawlSummary(str(tmp_path), DAY, append=True) as summary:
+        summary.add(ok_result("a" * 32))
+
+    assert read_log(str(tmp_path), "updated") == "".join(ext_id * 32 + "\n" for ext_id in "abcd")
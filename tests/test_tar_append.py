@@ -0,0 +1,82 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of appending to tar archives at the end recorded in their .end
+   sidecar."""
+
+import json
+import os
+import tarfile
+
+from ExtensionCrawler.tar_append import append_to_tar, end_file, read_end
+from ExtensionCrawler.tar_staging import TarStaging
+
+EXT_ID = "a" * 32
+DATES = ["2019-01-0{}T00:00:00.000000+00:00".format(day) for day in range(1, 4)]
+
+
+def staging(date):
+    staging = TarStaging(EXT_ID)
+    staging.write_text(date, "overview.html", "Overview of " + date)
+    staging.write(date, "a.crx", os.urandom(3000))
+    return staging
+
+
+def contents(tar):
+    with tarfile.open(tar) as t:
+        return {member.name: t.extractfile(member).read() if member.isfile() else None for member in t}
+
+
+def test_append_at_recorded_end(tmp_path):
+    tar = os.path.join(str(tmp_path), EXT_ID + ".tar")
+    assert append_to_tar(tar, staging(DATES[0]))
+    assert not append_to_tar(tar, staging(DATES[1]))
+
+    with tarfile.open(tar) as t:
+        members = t.getmembers()
+        offset = t.offset
+    assert read_end(tar) == (offset, members[-1].offset)
+    assert [member.name for member in members if member.isfile()] == [
+        "/".join([EXT_ID, date, fname]) for date in DATES[:2] for fname in ["a.crx", "overview.html"]]
+    assert contents(tar)["/".join([EXT_ID, DATES[1], "overview.html"])] == b"Overview of " + DATES[1].encode()
+
+
+def test_modified_archive_is_scanned(tmp_path):
+    tar = os.path.join(str(tmp_path), EXT_ID + ".tar")
+    append_to_tar(tar, staging(DATES[0]))
+    # Appended to without updating the sidecar
+    with tarfile.open(tar, 'a') as t:
+        t.add(__file__, arcname=EXT_ID + "/other")
+    assert read_end(tar) is None
+
+    assert append_to_tar(tar, staging(DATES[1]))
+    assert EXT_ID + "/other" in contents(tar)
+    assert read_end(tar) is not None
+
+
+def test_invalid_offset_is_not_trusted(tmp_path):
+    tar = os.path.join(str(tmp_path), EXT_ID + ".tar")
+    append_to_tar(tar, staging(DATES[0]))
+    with open(end_file(tar)) as f:
+        end = json.load(f)
+    for offset, last_header in [(end["offset"] - 512, end["last_header"]), (end["offset"], end["offset"] - 512)]:
+        with open(end_file(tar), 'w') as f:
+            json.dump(dict(end, offset=offset, last_header=last_header), f)
+        assert read_end(tar) is None
+
+    assert append_to_tar(tar, staging(DATES[1]))
+    assert len([name for name in contents(tar) if name.endswith(".crx")]) == 2
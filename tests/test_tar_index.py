@@ -0,0 +1,85 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of the .idx index of the members of tar archives."""
+
+import datetime
+import os
+import tarfile
+
+from ExtensionCrawler.tar_append import append_to_tar
+from ExtensionCrawler.tar_index import (read_index, load_index, index_file, crx_entries, last_crx_entry,
+                                        first_crx_entry, find_entry, tarinfo_at)
+from ExtensionCrawler.tar_staging import TarStaging
+
+EXT_ID = "a" * 32
+DATES = ["2019-01-0{}T00:00:00.000000+00:00".format(day) for day in range(1, 4)]
+
+
+def append(tar, date, crx=True):
+    staging = TarStaging(EXT_ID)
+    staging.write_text(date, "overview.html", "Overview of " + date)
+    if crx:
+        staging.write(date, "a.crx", date.encode())
+        staging.write_text(date, "a.crx.headers", str({"ETag": "etag-" + date[:10]}))
+    append_to_tar(tar, staging)
+
+
+def archive(tmp_path):
+    tar = os.path.join(str(tmp_path), EXT_ID + ".tar")
+    append(tar, DATES[0])
+    append(tar, DATES[1], crx=False)
+    append(tar, DATES[2])
+    return tar
+
+
+def test_index_matches_members(tmp_path):
+    tar = archive(tmp_path)
+    entries = read_index(tar)
+    with tarfile.open(tar) as t:
+        members = t.getmembers()
+        assert [(entry["name"], entry["offset"], entry["size"]) for entry in entries] == [
+            (member.name, member.offset, member.size) for member in members]
+        # Members are read at their offset
+        entry = find_entry(entries, "/".join([EXT_ID, DATES[1], "overview.html"]))
+        assert t.extractfile(tarinfo_at(t, entry)).read() == b"Overview of " + DATES[1].encode()
+
+
+def test_crx_entries(tmp_path):
+    crxs = crx_entries(read_index(archive(tmp_path)))
+    assert [(entry["date"], entry["etag"]) for entry in crxs] == [
+        (datetime.datetime.fromisoformat(date).isoformat(), "etag-" + date[:10]) for date in [DATES[0], DATES[2]]]
+    second = datetime.datetime.fromisoformat(DATES[1])
+    assert last_crx_entry(crxs, second) == crxs[0]
+    assert first_crx_entry(crxs, second) == crxs[1]
+    assert last_crx_entry(crxs) == crxs[1]
+
+
+def test_index_is_rebuilt(tmp_path):
+    tar = archive(tmp_path)
+    entries = read_index(tar)
+    # Appended to without extending the index
+    with tarfile.open(tar, 'a') as t:
+        t.add(__file__, arcname=EXT_ID + "/other")
+    assert read_index(tar) is None
+    assert [entry["name"] for entry in load_index(tar)] == [entry["name"] for entry in entries] + [EXT_ID + "/other"]
+    assert read_index(tar) == load_index(tar)
+
+    os.remove(index_file(tar))
+    append(tar, DATES[2])
+    with tarfile.open(tar) as t:
+        assert [entry["name"] for entry in read_index(tar)] == t.getnames()
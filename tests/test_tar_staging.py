@@ -0,0 +1,87 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of staging downloaded files in memory, and of spilling large ones
+   to temporary files."""
+
+import os
+import tarfile
+
+import pytest
+
+from ExtensionCrawler.tar_staging import TarStaging, remove_spilled
+
+EXT_ID = "a" * 32
+DATE = "2019-01-01T00:00:00.000000+00:00"
+
+
+def test_large_downloads_are_spilled(tmp_path):
+    staging = TarStaging(EXT_ID, spill_size=1000)
+    chunks = [os.urandom(300) for _ in range(5)]
+    staging.write_chunks(DATE, "a.crx", chunks)
+    staging.write_chunks(DATE, "small.crx", chunks[:2])
+    staging.write_text(DATE, "overview.html", "Overview")
+    assert staging.spilled() == 1
+    path = staging.files["/".join([EXT_ID, DATE, "a.crx"])][0]
+    assert os.path.exists(path)
+
+    tar = os.path.join(str(tmp_path), EXT_ID + ".tar")
+    with tarfile.open(tar, 'w') as ar:
+        staging.add_to(ar)
+    with tarfile.open(tar) as ar:
+        assert ar.getnames() == [EXT_ID, EXT_ID + "/" + DATE] + staging.names()
+        assert ar.extractfile(EXT_ID + "/" + DATE + "/a.crx").read() == b"".join(chunks)
+        assert ar.extractfile(EXT_ID + "/" + DATE + "/small.crx").read() == b"".join(chunks[:2])
+
+    extdir = staging.extract(os.path.join(str(tmp_path), "extracted"))
+    with open(os.path.join(extdir, DATE, "a.crx"), 'rb') as f:
+        assert f.read() == b"".join(chunks)
+
+    staging.cleanup()
+    assert not os.path.exists(path)
+
+
+def test_interrupted_download_is_kept(tmp_path):
+    def chunks():
+        yield os.urandom(600)
+        yield os.urandom(600)
+        raise IOError("connection reset")
+
+    staging = TarStaging(EXT_ID, spill_size=1000)
+    with pytest.raises(IOError):
+        staging.write_chunks(DATE, "a.crx", chunks())
+    name = "/".join([EXT_ID, DATE, "a.crx"])
+    assert len(staging.read(name)) == 1200
+
+    # Writing the file again replaces the spilled one
+    path = staging.files[name][0]
+    staging.write(DATE, "a.crx", b"crx")
+    assert not os.path.exists(path)
+    assert staging.read(name) == b"crx" and staging.spilled() == 0
+
+
+def test_spilled_files_of_killed_workers_are_removed():
+    staging = TarStaging(EXT_ID, spill_size=0)
+    staging.write_chunks(DATE, "a.crx", [b"crx"])
+    path = staging.files["/".join([EXT_ID, DATE, "a.crx"])][0]
+    other = TarStaging("b" * 32, spill_size=0)
+    other.write_chunks(DATE, "a.crx", [b"crx"])
+
+    remove_spilled(EXT_ID)
+    assert not os.path.exists(path)
+    assert other.spilled() == 1 and os.path.exists(other.files["/".join(["b" * 32, DATE, "a.crx"])][0])
+    other.cleanup()
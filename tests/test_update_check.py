@@ -0,0 +1,90 @@
+#!/usr/bin/env python3.7
+#
+# Copyright (C) 2016-2019 The University of Sheffield, UK
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests of the batched update check, of checking the versions of fed
+   extensions chunk by chunk, and of skipping the download of crxs whose
+   version did not change."""
+
+import io
+import zipfile
+
+from ExtensionCrawler.archive import update_extension
+from ExtensionCrawler.update_check import check_crx_versions, CheckedFeed
+
+
+def test_standin_crx_is_deterministic(standin):
+    crx = standin.crx(standin.ext_ids[0])
+    with zipfile.ZipFile(io.BytesIO(crx[16:])) as f:
+        assert {info.date_time for info in f.infolist()} == {(2019, 1, 1, 0, 0, 0)}
+    assert crx == standin.crx(standin.ext_ids[0])
+
+
+def test_check_crx_versions(standin, managers):
+    rm, sm = managers
+    unknown_id = "p" * 32
+    versions = check_crx_versions(standin.ext_ids[:5] + [unknown_id], batch_size=2, session_manager=sm,
+                                  request_manager=rm)
+    assert set(versions) == set(standin.ext_ids[:5])
+    assert all(version.version == "1.0" and version.hash_sha256 for version in versions.values())
+    assert standin.stats()["requests"]["update2-updatecheck"] == 3
+
+
+def test_unchanged_crx_is_not_requested(standin, managers, tmp_path):
+    rm, sm = managers
+    ext_id = standin.ext_ids[0]
+
+    def update():
+        versions = check_crx_versions([ext_id], session_manager=sm, request_manager=rm)
+        return update_extension((str(tmp_path), None, ext_id, False, versions[ext_id], None, None))
+
+    result = update()
+    assert result.is_ok() and result.crx_saved_requests() == 0
+    crx_requests = standin.stats()["requests"]["crx-get"]
+
+    result = update()
+    assert result.is_ok() and result.crx_saved_requests() == 1
+    assert standin.stats()["requests"]["crx-get"] == crx_requests
+
+
+class Result:
+    def __init__(self, ext_id):
+        self.ext_id = ext_id
+
+
+def test_checked_feed_checks_chunk_by_chunk():
+    tups = [(chr(ord("a") + i) * 32, i == 0) for i in range(5)]
+    checked = []
+    results = []
+
+    def check_versions(ext_ids):
+        checked.append(ext_ids)
+        return {ext_id: ext_id[0] for ext_id in ext_ids}
+
+    feed = CheckedFeed(tups, check_versions, 2, results.append, chunk_size=2)
+    fed = []
+    for ext_id, forums in feed.feed():
+        # The versions of an extension are known when it is fed, but not
+        # those of later chunks
+        assert feed.crx_versions[ext_id] == ext_id[0]
+        assert len(checked) == len(fed) // 2 + 1
+        fed.append((ext_id, forums))
+        feed.finished(Result(ext_id))
+
+    assert fed == tups
+    assert checked == [[ext_id for ext_id, _ in tups[i:i + 2]] for i in range(0, 5, 2)]
+    assert [result.ext_id for result in results] == [ext_id for ext_id, _ in tups]
+    assert feed.crx_versions == {}